@@ -0,0 +1,268 @@
+"""
+Rebuilds speed tables from the measurements in the FleetStore, for a whole
+roster at once, without JMRI, the GUI or a locomotive on the track.
+
+Changing the target speed or the scale for many locomotives would
+otherwise mean a GUI session per locomotive with Load Measurements
+checked. Here every selected run gets a table and trims for each SMPH
+target, and the results go to one CSV file that can be programmed later
+(or looked at in a spreadsheet).
+
+The runs are independent, so they're spread over a pool of workers:
+threads under Jython, which has no GIL, and processes under CPython,
+where threads would take turns.
+
+From the SpeedMatch-JMRI directory:
+    python -m BatchRebuild --smph 45 60 --output tables.csv
+"""
+import os
+import sys
+import time
+import threading
+
+from FleetStore import FleetStore
+from LayoutBlocks import LayoutProfile
+from SpeedTableBuilder import SpeedTableBuilder
+from Utils import dataFolder, setDataFolder
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+CSV_COLUMNS = (["DCC Address", "Filename Suffix", "Run", "Date", "Maximum Speed",
+                "Scale", "CV66", "CV95"] + ["CV" + str(67 + i) for i in range(28)])
+
+"""
+A stored run, with the data dict keys and getters of LayoutBlocks that
+SpeedTableBuilder uses (see also Benchmarks.SyntheticMeasurements).
+"""
+class StoredMeasurements:
+    def __init__(self, data, forwardMeasurements, reverseMeasurements):
+        self.data = data
+        self.timeSecPerBlockMeasurementsForward = forwardMeasurements
+        self.timeSecPerBlockMeasurementsReverse = reverseMeasurements
+        # same as LayoutBlocks.computeMeasuredBlockTopSpeedTime
+        inchesPerSecond = 17.6 * data["Maximum Speed"] * 1.0 / data["Scale"]
+        self.topSpeedTimeSecPerBlock = {}
+        for i in range(len(data["Measured Block Sensors"])):
+            self.topSpeedTimeSecPerBlock[data["Measured Block Sensors"][i]] = \
+                data["Measured Block Lengths (Inches)"][i] / inchesPerSecond
+
+    def getForwardMeasurements(self):
+        return self.timeSecPerBlockMeasurementsForward
+
+    def getReverseMeasurements(self):
+        return self.timeSecPerBlockMeasurementsReverse
+
+    def getTopSpeedTimePerMeasuredBlock(self):
+        return self.topSpeedTimeSecPerBlock
+
+"""
+One run to rebuild: the settings the table needs, taken from the run
+record, the command line, or the layout profile for runs from before the
+fleet store recorded them.
+"""
+class RebuildJob:
+    def __init__(self, record, smphTargets, scale=None, measuredBlocks=None):
+        self.record = record
+        self.smphTargets = list(smphTargets)
+        self.scale = scale if scale is not None else record.get("Scale")
+        self.vStart = record.get("vStart") or 0
+        self.measuredSensors = record.get("Measured Block Sensors")
+        self.measuredLengths = record.get("Measured Block Lengths (Inches)")
+        if not self.measuredSensors and measuredBlocks:
+            self.measuredSensors = sorted(measuredBlocks.keys())
+            self.measuredLengths = [measuredBlocks[el] for el in self.measuredSensors]
+
+    """
+    returns: a reason the run can't be rebuilt, or None
+    """
+    def problem(self):
+        if not self.scale:
+            return "no scale recorded - use --scale"
+        if not self.measuredSensors:
+            return "no measured blocks recorded or in the layout profile"
+        return None
+
+"""
+Builds the tables of one job.
+
+returns: list of CSV rows (dicts), one per SMPH target
+"""
+def rebuild(store, job):
+    run = job.record["Run"]
+    forwardMeasurements = store.loadMeasurements(run, True)
+    reverseMeasurements = store.loadMeasurements(run, False)
+    rows = []
+    for smph in job.smphTargets:
+        data = {"vStart" : job.vStart,
+                "Maximum Speed" : smph,
+                "Scale" : job.scale,
+                "Measured Block Sensors" : job.measuredSensors,
+                "Measured Block Lengths (Inches)" : job.measuredLengths}
+        stb = SpeedTableBuilder(StoredMeasurements(data, forwardMeasurements,
+                                                   reverseMeasurements))
+        table28Steps = stb.buildSpeedTableForAllBlocks()
+        forwardTrim, reverseTrim = stb.getTrimCvValues()
+        row = {"DCC Address" : job.record["DCC Address"],
+               "Filename Suffix" : job.record["Filename Suffix"],
+               "Run" : run,
+               "Date" : time.strftime("%Y-%m-%d %H:%M",
+                                      time.localtime(job.record["Timestamp"])),
+               "Maximum Speed" : smph,
+               "Scale" : job.scale,
+               "CV66" : forwardTrim,
+               "CV95" : reverseTrim}
+        for i in range(28):
+            row["CV" + str(67 + i)] = int(table28Steps[i])
+        rows.append(row)
+    return rows
+
+def _isJython():
+    return sys.platform.startswith("java")
+
+def _rebuildWithThreads(store, jobs, workers):
+    pending = queue.Queue()
+    for i in range(len(jobs)):
+        pending.put(i)
+    results = [None] * len(jobs)
+
+    def work():
+        while True:
+            try:
+                i = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[i] = rebuild(store, jobs[i])
+            except Exception as err:
+                results[i] = err
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+# each worker process opens the store once, see _rebuildWithProcesses
+_processStore = None
+
+def _initializeProcess(folder):
+    global _processStore
+    setDataFolder(folder)
+    _processStore = FleetStore()
+
+def _rebuildInProcess(job):
+    try:
+        return rebuild(_processStore, job)
+    except Exception as err:
+        return err
+
+def _rebuildWithProcesses(store, jobs, workers):
+    import multiprocessing
+    # the data folder is passed on explicitly, as spawned processes don't
+    # inherit a setDataFolder() from this one
+    pool = multiprocessing.Pool(workers, _initializeProcess, (dataFolder(),))
+    try:
+        return pool.map(_rebuildInProcess, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+"""
+Rebuilds the tables of many runs in parallel.
+
+jobs: list of RebuildJob
+workers: number of threads or processes, one per processor by default
+
+returns: list of CSV rows, and a list of (run record, error) for the runs
+         that couldn't be rebuilt
+"""
+def rebuildAll(store, jobs, workers=None):
+    if workers is None:
+        try:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            workers = 4
+    workers = max(1, min(workers, len(jobs)))
+
+    if _isJython() or workers == 1:
+        results = _rebuildWithThreads(store, jobs, workers)
+    else:
+        results = _rebuildWithProcesses(store, jobs, workers)
+
+    rows = []
+    errors = []
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            errors.append((job.record, result))
+        else:
+            rows.extend(result)
+    return rows, errors
+
+def writeCsv(rows, filename):
+    f = open(filename, "w")
+    try:
+        f.write(",".join(CSV_COLUMNS) + "\n")
+        for row in rows:
+            f.write(",".join([str(row[el]) for el in CSV_COLUMNS]) + "\n")
+    finally:
+        f.close()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Rebuild speed tables from stored measurements")
+    parser.add_argument("--smph", type=float, nargs="+", required=True,
+                        help="one or more maximum speeds to build tables for")
+    parser.add_argument("--scale", type=float, default=None,
+                        help="scale ratio, e.g. 87.1 for HO, instead of each run's own")
+    parser.add_argument("--address", type=int, action="append",
+                        help="only this locomotive; may be given more than once")
+    parser.add_argument("--all-runs", action="store_true",
+                        help="every run, not just the latest of each locomotive")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default=None,
+                        help="CSV file, speedTables.csv in the data folder by default")
+    args = parser.parse_args()
+
+    startTime = time.time()
+    store = FleetStore()
+    records = store.findRuns()
+    if args.address:
+        records = [el for el in records if el["DCC Address"] in args.address]
+    if not args.all_runs:
+        latest = {}
+        for record in records:
+            latest[(record["DCC Address"], record["Filename Suffix"])] = record
+        records = sorted(latest.values(), key=lambda el: el["Run"])
+
+    layoutProfile = LayoutProfile()
+    layoutProfile.load()
+    jobs = []
+    for record in records:
+        job = RebuildJob(record, args.smph, args.scale, layoutProfile.measuredBlocks)
+        if job.problem():
+            print("Skipping run " + str(record["Run"]) + ": " + job.problem())
+        else:
+            jobs.append(job)
+    if not jobs:
+        print("No runs to rebuild")
+        sys.exit(1)
+
+    rows, errors = rebuildAll(store, jobs, args.workers)
+    for record, error in errors:
+        print("Run " + str(record["Run"]) + " failed: " + str(error))
+
+    output = args.output or os.path.join(dataFolder(), "speedTables.csv")
+    writeCsv(rows, output)
+    print("Rebuilt " + str(len(jobs) - len(errors)) + " runs, " + str(len(rows)) +
+          " tables in " + str(round(time.time() - startTime, 1)) + " seconds. Written to: " +
+          output)
+    if errors:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+from .BatchRebuild import rebuild, rebuildAll, RebuildJob, StoredMeasurements
@@ -0,0 +1,3 @@
+from .BatchRebuild import main
+
+main()
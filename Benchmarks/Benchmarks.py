@@ -0,0 +1,294 @@
+"""
+Times the table building pipeline on synthetic measurements, so changes to
+SpeedTableBuilder can be checked for speed as the number of blocks,
+samples and measured CV values grows. Runs under plain Python; no JMRI.
+
+Each scenario generates one SyntheticMeasurements set and runs every stage
+in STAGES on it. A stage is timed several times and the fastest run kept,
+as the others are mostly noise from the rest of the computer. Peak memory
+is measured in a separate run with tracemalloc, which slows things down
+too much to time at the same time (and isn't available in Jython).
+
+Results can be saved as a baseline JSON file and later runs compared
+against it. The comparison also checks that the speed table built for
+each scenario hasn't changed.
+
+--backend times the plain Python or the numpy code (see
+SpeedTableBuilder.Backend); --golden checks that both build exactly the
+tables and trims in golden.json for every scenario. After a change that
+is meant to change the tables, --save-golden writes them anew from the
+plain Python code.
+
+From the SpeedMatch-JMRI directory:
+    python -m Benchmarks --save baseline.json
+    (change something)
+    python -m Benchmarks --compare baseline.json
+    python -m Benchmarks --golden
+"""
+import json
+import os
+import platform
+import sys
+
+from SpeedTableBuilder import SpeedTableBuilder, setBackend, backendName
+from Utils import monotonicTimeSec
+from .SyntheticMeasurements import SyntheticMeasurements
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+"""
+Scenarios: name, then SyntheticMeasurements arguments. The first is a
+typical home layout; the others grow one thing at a time from there.
+"""
+SCENARIOS = [
+    ("typical", {"numBlocks" : 24, "samplesPerCv" : 4, "cvValues" : 10}),
+    ("blocks-100", {"numBlocks" : 100, "samplesPerCv" : 4, "cvValues" : 10}),
+    ("blocks-1000", {"numBlocks" : 1000, "samplesPerCv" : 4, "cvValues" : 10}),
+    ("blocks-3000", {"numBlocks" : 3000, "samplesPerCv" : 4, "cvValues" : 10}),
+    ("samples-16", {"numBlocks" : 24, "samplesPerCv" : 16, "cvValues" : 10}),
+    ("samples-64", {"numBlocks" : 24, "samplesPerCv" : 64, "cvValues" : 10}),
+    ("cvs-30", {"numBlocks" : 24, "samplesPerCv" : 4, "cvValues" : 30}),
+    ("cvs-100", {"numBlocks" : 24, "samplesPerCv" : 4, "cvValues" : 100}),
+    ("measured-10", {"numBlocks" : 100, "samplesPerCv" : 4, "cvValues" : 10,
+                     "measuredBlocks" : 10}),
+]
+
+QUICK_SCENARIOS = ["typical", "blocks-100", "samples-16", "cvs-30"]
+
+# tables and trims every backend has to build for each scenario
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden.json")
+
+
+def _preprocess(measurements, state):
+    state["builder"] = SpeedTableBuilder(measurements)
+    state["builder"].preprocessCvToBlockTimeDataTables()
+
+def _buildTable(measurements, state):
+    state["table"] = state["builder"].buildSpeedTableForMeasuredBlocks()
+
+def _buildTableForAllBlocks(measurements, state):
+    state["allBlocksTable"] = SpeedTableBuilder(measurements).buildSpeedTableForAllBlocks()
+
+"""
+Pipeline stages, in order: name and function(measurements, state). state
+is a dict passed from one stage to the next.
+"""
+STAGES = [
+    ("preprocess", _preprocess),
+    ("buildTable", _buildTable),
+    ("allBlocks", _buildTableForAllBlocks),
+]
+
+
+def _runStages(measurements, timings, peakMemory=None):
+    state = {}
+    for name, stage in STAGES:
+        if peakMemory is not None:
+            tracemalloc.start()
+        startTime = monotonicTimeSec()
+        stage(measurements, state)
+        seconds = monotonicTimeSec() - startTime
+        if peakMemory is not None:
+            peakMemory[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        timings.setdefault(name, []).append(seconds)
+    return state
+
+"""
+returns: dict with the best time and peak memory of each stage, and the
+         speed table built
+"""
+def runScenario(arguments, repeats=3):
+    measurements = SyntheticMeasurements(**arguments)
+    timings = {}
+    for i in range(repeats):
+        state = _runStages(measurements, timings)
+
+    peakMemory = None
+    if tracemalloc is not None:
+        peakMemory = {}
+        _runStages(measurements, {}, peakMemory)
+
+    result = {"stages" : {}, "table" : state.get("table"),
+              "allBlocksTable" : state.get("allBlocksTable")}
+    for name, stage in STAGES:
+        result["stages"][name] = {"seconds" : min(timings[name])}
+        if peakMemory is not None:
+            result["stages"][name]["peakKiB"] = peakMemory[name] // 1024
+    return result
+
+def runBenchmarks(scenarioNames=None, repeats=3):
+    results = {"python" : platform.python_implementation() + " " +
+                          platform.python_version(),
+               "backend" : backendName(),
+               "scenarios" : {}}
+    for name, arguments in SCENARIOS:
+        if scenarioNames is not None and name not in scenarioNames:
+            continue
+        result = runScenario(arguments, repeats)
+        results["scenarios"][name] = result
+        line = name.ljust(14)
+        for stage, stageResult in sorted(result["stages"].items()):
+            line += "  " + stage + " " + str(round(stageResult["seconds"] * 1000, 1)) + " ms"
+            if "peakKiB" in stageResult:
+                line += " / " + str(stageResult["peakKiB"]) + " KiB"
+        print(line)
+    return results
+
+def saveBaseline(results, filename):
+    json.dump(results, open(filename, "w"), indent=1, sort_keys=True)
+    print("Baseline written to: " + filename)
+
+"""
+Compares results to a baseline saved earlier. A stage counts as slower if
+it takes more than slowdownTolerance times as long as in the baseline.
+
+returns: list of problems found; empty if none
+"""
+def compareToBaseline(results, filename, slowdownTolerance=1.25):
+    baseline = json.load(open(filename, "r"))
+    problems = []
+    if not baseline["python"] == results["python"]:
+        print("Note: baseline was made with " + baseline["python"] +
+              ", this run is " + results["python"])
+    if not baseline.get("backend", "python") == results["backend"]:
+        print("Note: baseline was made with the " + baseline.get("backend", "python") +
+              " backend, this run uses " + results["backend"])
+    for name in sorted(results["scenarios"].keys()):
+        if name not in baseline["scenarios"]:
+            print(name + ": not in baseline")
+            continue
+        result = results["scenarios"][name]
+        old = baseline["scenarios"][name]
+        for key in ["table", "allBlocksTable"]:
+            if key in old and not result[key] == old[key]:
+                problems.append(name + ": " + key + " changed from " + str(old[key]) +
+                                " to " + str(result[key]))
+        for stage in sorted(result["stages"].keys()):
+            if stage not in old["stages"]:
+                continue
+            ratio = result["stages"][stage]["seconds"] / max(old["stages"][stage]["seconds"], 1e-9)
+            line = name.ljust(14) + "  " + stage + " x" + str(round(ratio, 2))
+            if "peakKiB" in result["stages"][stage] and "peakKiB" in old["stages"][stage]:
+                line += ", memory " + str(old["stages"][stage]["peakKiB"]) + " -> " + \
+                        str(result["stages"][stage]["peakKiB"]) + " KiB"
+            print(line)
+            if ratio > slowdownTolerance:
+                problems.append(name + ": " + stage + " is " + str(round(ratio, 2)) +
+                                " times slower than the baseline")
+    for problem in problems:
+        print("PROBLEM: " + problem)
+    return problems
+
+"""
+returns: the tables and trims built for one scenario, as
+         {"table" : ..., "trims" : [CV66, CV95], "allBlocksTable" : ...,
+          "allBlocksTrims" : ...}
+"""
+def buildTables(arguments):
+    measurements = SyntheticMeasurements(**arguments)
+    builder = SpeedTableBuilder(measurements)
+    builder.preprocessCvToBlockTimeDataTables()
+    result = {"table" : builder.buildSpeedTableForMeasuredBlocks(),
+              "trims" : list(builder.getTrimCvValues())}
+    builder = SpeedTableBuilder(measurements)
+    result["allBlocksTable"] = builder.buildSpeedTableForAllBlocks()
+    result["allBlocksTrims"] = list(builder.getTrimCvValues())
+    return result
+
+"""
+Writes the tables and trims of every scenario, built by the plain Python
+code, to filename
+"""
+def saveGolden(filename=GOLDEN_FILE):
+    from SpeedTableBuilder.Backend import PYTHON
+    setBackend(PYTHON)
+    try:
+        golden = {}
+        for name, arguments in SCENARIOS:
+            golden[name] = buildTables(arguments)
+    finally:
+        setBackend(None)
+    json.dump(golden, open(filename, "w"), indent=1, sort_keys=True)
+    print("Golden tables written to: " + filename)
+
+"""
+Builds the tables of every scenario with each backend there is and
+compares them to the ones in the golden file. Tables and trims have to
+match exactly.
+
+returns: list of problems found; empty if none
+"""
+def checkBackends(scenarioNames=None, filename=GOLDEN_FILE):
+    from SpeedTableBuilder.Backend import PYTHON, NUMPY, numpyAvailable
+    golden = json.load(open(filename, "r"))
+    backends = [PYTHON]
+    if numpyAvailable():
+        backends.append(NUMPY)
+    else:
+        print("numpy isn't installed, checking only the plain Python backend")
+    problems = []
+    for name, arguments in SCENARIOS:
+        if scenarioNames is not None and name not in scenarioNames:
+            continue
+        if name not in golden:
+            problems.append(name + ": not in " + filename)
+            continue
+        for backend in backends:
+            setBackend(backend)
+            try:
+                result = buildTables(arguments)
+            finally:
+                setBackend(None)
+            for key in sorted(golden[name].keys()):
+                if not result[key] == golden[name][key]:
+                    problems.append(name + ": " + backend + " built " + key + " " +
+                                    str(result[key]) + ", expected " + str(golden[name][key]))
+        print(name.ljust(14) + "  " + ", ".join(backends) + " checked")
+    for problem in problems:
+        print("PROBLEM: " + problem)
+    return problems
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark speed table building")
+    parser.add_argument("--save", metavar="FILE", help="save results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare results to a baseline")
+    parser.add_argument("--quick", action="store_true", help="only the small scenarios")
+    parser.add_argument("--scenario", action="append", help="run only this scenario")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--backend", choices=["python", "numpy"], default=None,
+                        help="table building code to time, numpy if installed by default")
+    parser.add_argument("--golden", action="store_true",
+                        help="check that both backends build the tables in golden.json, then stop")
+    parser.add_argument("--save-golden", action="store_true",
+                        help="write the tables built now to golden.json, then stop")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="slowdown factor that counts as a problem")
+    args = parser.parse_args()
+
+    scenarioNames = args.scenario
+    if args.quick:
+        scenarioNames = QUICK_SCENARIOS
+    if args.save_golden:
+        saveGolden()
+        return
+    if args.golden:
+        if checkBackends(scenarioNames):
+            sys.exit(1)
+        return
+    setBackend(args.backend)
+    results = runBenchmarks(scenarioNames, args.repeats)
+    if args.save:
+        saveBaseline(results, args.save)
+    if args.compare:
+        if compareToBaseline(results, args.compare, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
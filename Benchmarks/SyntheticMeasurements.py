@@ -0,0 +1,102 @@
+"""
+Made-up block time measurements, in the same format LayoutBlocks produces,
+for benchmarking the table building code without a layout or JMRI.
+
+SyntheticMeasurements stands in for a LayoutBlocks instance: it has the
+same data dict keys and getters that SpeedTableBuilder uses. Block lengths
+are random; the locomotive's speed follows a typical motor curve, a little
+different in reverse, and every sample gets some timing noise. A few
+samples are stalls, many times too long, as happens on a real layout.
+"""
+import random
+
+"""
+numBlocks: number of blocks on the loop
+samplesPerCv: block time samples per block, CV value and direction
+cvValues: speed table CV values measured, or the number of CV values to
+          spread between the bottom and the top of the table
+measuredBlocks: how many blocks have a measured length
+vStart: CV2
+maximumSpeed: SMPH the table is built for
+seed: random seed, so runs are repeatable
+"""
+class SyntheticMeasurements:
+    def __init__(self, numBlocks=24, samplesPerCv=4, cvValues=10,
+                 measuredBlocks=1, vStart=0, maximumSpeed=60, seed=1):
+        self.random = random.Random(seed)
+        if isinstance(cvValues, int):
+            cvValues = self._spreadCvValues(cvValues, vStart)
+        self.cvValues = sorted(cvValues)
+        self.sensors = ["LS" + str(1 + 2 * i) for i in range(numBlocks)]
+        self.blockLengths = {}
+        for sensor in self.sensors:
+            self.blockLengths[sensor] = self.random.uniform(15.0, 60.0)
+
+        measuredSensors = self.sensors[:measuredBlocks]
+        self.data = {"vStart" : vStart,
+                     "Maximum Speed" : maximumSpeed,
+                     "Scale" : 87.1,
+                     "Measured Block Sensors" : measuredSensors,
+                     "Measured Block Lengths (Inches)" :
+                         [self.blockLengths[el] for el in measuredSensors]}
+
+        # inches per second at CV value 255, forward; the requested maximum
+        # speed is reached around CV value 200
+        inchesPerSecond = 17.6 * maximumSpeed / self.data["Scale"]
+        self.topSpeed = inchesPerSecond / self._relativeSpeed(200, vStart)
+        self.topSpeedTimeSecPerBlock = {}
+        for sensor in measuredSensors:
+            self.topSpeedTimeSecPerBlock[sensor] = self.blockLengths[sensor] / inchesPerSecond
+
+        self.timeSecPerBlockMeasurementsForward = self._measurements(samplesPerCv, vStart, 1.0)
+        self.timeSecPerBlockMeasurementsReverse = self._measurements(samplesPerCv, vStart, 0.93)
+        self.nextSensorForward = {}
+        self.nextSensorReverse = {}
+        for i in range(numBlocks):
+            self.nextSensorForward[self.sensors[i]] = self.sensors[(i + 1) % numBlocks]
+            self.nextSensorReverse[self.sensors[i]] = self.sensors[(i - 1) % numBlocks]
+
+    def _spreadCvValues(self, count, vStart):
+        low = vStart + int(16 * (255 - vStart) / 255.0)
+        return sorted(set([int(round(low + (255 - low) * i * 1.0 / (count - 1)))
+                           for i in range(count)]))
+
+    """
+    speed at a CV value as a fraction of the speed at 255: motor needs a
+    little voltage to get going, then speed rises a bit faster than linear
+    """
+    def _relativeSpeed(self, cvValue, vStart):
+        effective = max(cvValue - vStart - 4, 1) * 1.0 / (255 - vStart)
+        return effective ** 1.1
+
+    def _measurements(self, samplesPerCv, vStart, gain):
+        measurements = {}
+        for cv in self.cvValues:
+            speed = self.topSpeed * gain * self._relativeSpeed(cv, vStart)
+            measurements[cv] = {}
+            for sensor in self.sensors:
+                blockTime = self.blockLengths[sensor] / speed
+                samples = []
+                for i in range(samplesPerCv):
+                    sample = blockTime * (1.0 + self.random.gauss(0.0, 0.02))
+                    if self.random.random() < 0.01:
+                        # stalled
+                        sample *= self.random.uniform(2.0, 10.0)
+                    samples.append(sample)
+                measurements[cv][sensor] = samples
+        return measurements
+
+    def getForwardMeasurements(self):
+        return self.timeSecPerBlockMeasurementsForward
+
+    def getReverseMeasurements(self):
+        return self.timeSecPerBlockMeasurementsReverse
+
+    def getNextSensorForward(self):
+        return self.nextSensorForward
+
+    def getNextSensorReverse(self):
+        return self.nextSensorReverse
+
+    def getTopSpeedTimePerMeasuredBlock(self):
+        return self.topSpeedTimeSecPerBlock
@@ -0,0 +1,3 @@
+from .SyntheticMeasurements import SyntheticMeasurements
+from .Benchmarks import runBenchmarks, runScenario, saveBaseline, compareToBaseline
+from .Benchmarks import buildTables, saveGolden, checkBackends
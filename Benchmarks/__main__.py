@@ -0,0 +1,3 @@
+from .Benchmarks import main
+
+main()
@@ -0,0 +1,118 @@
+"""
+Runs one complete calibration of a locomotive: programs the decoder for
+measuring, warms up the engine, measures block times, computes the speed
+table and programs it.
+
+speedMatchInstance is whatever provides the JMRI automaton calls (waitMsec,
+getThrottle, addressedProgrammers) - the running SpeedMatch automaton on a
+real layout, or the Simulator. Everything here has to run on that
+automaton's thread, see the notes in Throttle.py. Layout power and the GUI
+are left to the caller.
+
+The time each phase takes is recorded by data["Run Profiler"] if there is
+one (see RunProfiler).
+"""
+from Throttle import Throttle, EngineWarmer, Program
+from LayoutBlocks import LayoutBlocks
+from SpeedTableBuilder import SpeedTableBuilder
+from RunProfiler import RunProfiler
+
+class Calibration:
+    def __init__(self, speedMatchInstance, data):
+        self.speedMatchInstance = speedMatchInstance
+        self.data = data
+
+    """
+    returns: the 28 step speed table that was programmed
+    """
+    def run(self):
+        profiler = self.data.get("Run Profiler") or RunProfiler()
+
+        # get throttle
+        t = Throttle(speedMatchInstance=self.speedMatchInstance, dccaddress=self.data["DCC Address"],
+                     profiler=profiler)
+        p = Program(speedMatchInstance=self.speedMatchInstance, throttleInstance = t)
+        profiler.begin("Programming for measuring")
+        if self.data["Use Roster CVs"]:
+            p.loadCvValuesFromRoster()
+
+        # set momentum CVs to 1 for measurements
+        p.programCv(cvNumber=3, cvValue=1)
+        p.programCv(cvNumber=4, cvValue=1)
+        p.programCv(cvNumber=2, cvValue=int(self.data["vStart"]))
+        p.disableTrim()
+        p.disableManufacturerSpeedTables()
+        profiler.end()
+
+        # warm up engine, either for a fixed time, or by driving laps until
+        # the lap times settle, as part of measuring the block times
+        ew = EngineWarmer(speedMatchInstance=self.speedMatchInstance, throttleInstance=t)
+        warmUpMinutes = None
+        if not self.data["Load Measurements"]:
+            profiler.begin("Warm-up")
+            if self.data.get("Warm Up Until Stable"):
+                ew.wakeUp()
+                warmUpMinutes = 20
+            else:
+                ew.warmUp(minutes=5)
+            profiler.end()
+
+        # measure layout blocks
+        profiler.begin("Measuring")
+        p.enableSpeedTable()
+        lb = LayoutBlocks(speedMatchInstance=self.speedMatchInstance, throttleInstance=t, data=self.data)
+        lb.computeMeasuredBlockTopSpeedTime()
+        # move between CV values by throttle step instead of programming
+        # each one, see PlateauTable
+        plateauWidth = None
+        if self.data.get("Plateau Speed Table"):
+            plateauWidth = self.data.get("Plateau Width", 3)
+        lb.measureBlockTimes(warmUpMinutes=warmUpMinutes, plateauWidth=plateauWidth)
+        profiler.end()
+
+        # refine the detector latencies with this run's data
+        profiler.begin("Computing the table")
+        latencyProfile = self.data["Detector Latency Profile"]
+        if latencyProfile and not self.data["Load Measurements"]:
+            if latencyProfile.learn(
+                    [(lb.getForwardMeasurements(), lb.getNextSensorForward()),
+                     (lb.getReverseMeasurements(), lb.getNextSensorReverse())]):
+                latencyProfile.save()
+
+        # Compute speed table
+        # Every block is a speed sample once its length is estimated from
+        # the measured blocks
+        stb = SpeedTableBuilder(layoutBlocksInstance = lb)
+        table28Steps = stb.buildSpeedTableForAllBlocks()
+        forwardTrim, reverseTrim = stb.getTrimCvValues()
+        print("Computed Speed Table: ", table28Steps)
+        print("Forward trim (CV66): " + str(forwardTrim) +
+              ", reverse trim (CV95): " + str(reverseTrim))
+
+        # remember the block lengths for the next locomotive
+        layoutProfile = self.data.get("Layout Profile")
+        if layoutProfile and not self.data["Load Measurements"]:
+            measuredLengths = dict(zip(self.data["Measured Block Sensors"],
+                                       self.data["Measured Block Lengths (Inches)"]))
+            layoutProfile.update(stb.getBlockLengthSolver(),
+                                 lb.getNextSensorForward(), lb.getNextSensorReverse(),
+                                 measuredLengths, self.data.get("Ignored Sensors"),
+                                 lb.getQuarantinedSensors(), lb.getSensorSequence())
+            layoutProfile.save()
+
+        profiler.end()
+
+        # Program speed table, trims and requested momentum cvs
+        profiler.begin("Programming the table")
+        p.programSpeedTable(table28Steps)
+        p.programTrim(forwardTrim, reverseTrim)
+        p.programCv(cvNumber=3, cvValue=self.data["CV3"])
+        p.programCv(cvNumber=4, cvValue=self.data["CV4"])
+        profiler.end()
+        print("Table programming complete. Locomotive programmed to " +
+              str(self.data["Maximum Speed"]) + "SMPH")
+        print("CV writes sent: " + str(t.cvShadow.writesSent) +
+              ", skipped as unchanged: " + str(t.cvShadow.writesSkipped))
+        t.programmingQueue.saveLatency()
+
+        return table28Steps
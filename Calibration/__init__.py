@@ -0,0 +1 @@
+from .Calibration import Calibration
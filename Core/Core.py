@@ -0,0 +1,51 @@
+"""
+Checks that the Core package still loads without JMRI: in a fresh
+interpreter, imports Core and reports how long that took and whether any
+JMRI, Swing or live driver module came along with it. The live driver
+(SpeedMatch.py, GUI, Throttle, SensorMonitor, Calibration) is the only
+place JMRI gets imported.
+
+From the SpeedMatch-JMRI directory:
+    python -m Core
+"""
+import os
+import subprocess
+import sys
+
+# modules that only the live driver may import
+DRIVER_MODULES = ["jmri", "javax", "GUI", "Throttle", "SensorMonitor",
+                  "Calibration", "SpeedMatch"]
+
+_CHECK_SCRIPT = """
+import sys, time
+start = time.time()
+import Core
+print(time.time() - start)
+print(' '.join(sorted(set([el.split('.')[0] for el in sys.modules.keys()]))))
+"""
+
+"""
+returns: (import time in seconds, list of driver modules that got loaded)
+"""
+def checkImports():
+    packageFolder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, "-c", _CHECK_SCRIPT],
+                               cwd=packageFolder, stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    output = process.communicate()[0].split("\n")
+    if process.returncode:
+        raise Exception("Importing Core failed")
+    importTimeSec = float(output[0])
+    loaded = output[1].split()
+    return importTimeSec, [el for el in DRIVER_MODULES if el in loaded]
+
+def main(maximumImportTimeSec=1.0):
+    importTimeSec, driverModules = checkImports()
+    print("Core imported in " + str(round(importTimeSec, 3)) + " seconds")
+    if driverModules:
+        print("Core loaded live driver modules: " + ", ".join(driverModules))
+    if driverModules or importTimeSec > maximumImportTimeSec:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+"""
+The parts of SpeedMatch that only compute, store and load: statistics,
+the measurement model, interpolation, the table builder and the stored
+data. None of it imports JMRI, Java or Swing, so it loads in a fraction of
+a second under Jython 2.7 or CPython 3, for offline tools and for running
+the heavy computation on a faster Python. See Core.py for the check.
+"""
+from Utils import median, inliers, robustMean, dataFolder, setDataFolder
+from SpeedTableBuilder import SpeedTableBuilder, LogInterpolator, TrimSolver, BlockLengthSolver
+from LayoutBlocks.BlockTimeSampler import BlockTimeEstimator, CvValueSampler
+from LayoutBlocks.CvGridPlanner import CvGridPlanner, FixedCvGrid
+from LayoutBlocks.LayoutProfile import LayoutProfile
+from LayoutBlocks.MeasurementJournal import MeasurementJournal
+from FleetStore import FleetStore
+from BatchRebuild import StoredMeasurements
+from .Core import checkImports
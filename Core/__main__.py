@@ -0,0 +1,3 @@
+from .Core import main
+
+main()
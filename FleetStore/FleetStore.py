@@ -0,0 +1,339 @@
+"""
+Keeps the measurements of every calibration run of every locomotive, so
+that fleet-wide tools (matching locomotives to each other, checking for
+drift over time, rebuilding tables in bulk) can find and load them quickly.
+
+The store is a folder in the data folder:
+
+    Fleet/index.pkl      one record per run: address, suffix, date,
+                         decoder, settings, CV values measured, a snapshot
+                         of the layout profile, and where its data is
+    Fleet/<run>.fmr      the run's block times, one pickled chunk per CV
+                         value and direction
+
+The index is small even for hundreds of runs, so queries only read it.
+Loading one direction or a range of CV values seeks to just those chunks
+and never unpickles the rest of the run.
+
+Jython has no sqlite3, so this is plain pickle files like the rest of the
+data folder. The index is rewritten to a temporary file and renamed over
+the old one, so a crash while saving leaves the previous index in place.
+Calibration sessions running side by side (see Sessions) each have their
+own FleetStore, so adding a run rereads the index under a lock shared by
+all of them, and no run number is handed out twice.
+
+From the SpeedMatch-JMRI directory, to list the runs and import the
+measurement files from before the store:
+    python -m FleetStore --migrate
+"""
+import os
+import pickle
+import threading
+import time
+
+from Utils import dataFolder
+
+# keys of a run record, in the style of the SpeedMatch data dict
+RUN = "Run"
+TIMESTAMP = "Timestamp"
+ADDRESS = "DCC Address"
+SUFFIX = "Filename Suffix"
+SOURCE = "Source"
+CV_VALUES_FORWARD = "CV Values Forward"
+CV_VALUES_REVERSE = "CV Values Reverse"
+LAYOUT_PROFILE = "Layout Profile"
+# settings copied from the data dict when a run is added
+METADATA_KEYS = ["Decoder", "Scale", "Maximum Speed", "vStart", "CV3", "CV4",
+                 "Measured Block Sensors", "Measured Block Lengths (Inches)"]
+
+# shared by every FleetStore in this JMRI instance, see above
+_storeLock = threading.RLock()
+
+"""
+folder: where the store is kept, Fleet in the data folder by default
+"""
+class FleetStore:
+    def __init__(self, folder=None):
+        if folder is None:
+            folder = os.path.join(dataFolder(), "Fleet")
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        self.folder = folder
+        self.indexFilename = os.path.join(folder, "index.pkl")
+        # run number : run record
+        self.runs = {}
+        # run number : {(forward, cvValue) : (offset, length)} in its data file
+        self.chunks = {}
+        self.nextRun = 1
+        # (address, suffix) : run numbers, oldest first
+        self.byLocomotive = {}
+        self._loadIndex()
+
+    def _loadIndex(self):
+        if not os.path.exists(self.indexFilename):
+            return
+        f = open(self.indexFilename, "rb")
+        try:
+            state = pickle.load(f)
+        finally:
+            f.close()
+        self.runs = state["runs"]
+        self.chunks = state["chunks"]
+        self.nextRun = state["nextRun"]
+        self._buildLookup()
+
+    def _saveIndex(self):
+        temporary = self.indexFilename + ".tmp"
+        f = open(temporary, "wb")
+        try:
+            pickle.dump({"runs" : self.runs, "chunks" : self.chunks,
+                         "nextRun" : self.nextRun}, f, 2)
+        finally:
+            f.close()
+        # os.rename won't replace a file on Windows
+        if os.path.exists(self.indexFilename):
+            os.remove(self.indexFilename)
+        os.rename(temporary, self.indexFilename)
+
+    def _buildLookup(self):
+        self.byLocomotive = {}
+        for run in sorted(self.runs.keys(), key=lambda el: self.runs[el][TIMESTAMP]):
+            record = self.runs[run]
+            key = (record[ADDRESS], record[SUFFIX])
+            self.byLocomotive.setdefault(key, []).append(run)
+
+    def _dataFilename(self, run):
+        return os.path.join(self.folder, str(run) + ".fmr")
+
+    """
+    Adds the measurements of one calibration run.
+
+    data: the SpeedMatch data dict of the run, for the address, suffix and
+          settings (see METADATA_KEYS)
+    forwardMeasurements, reverseMeasurements: {cvValue : {sensor : [times]}}
+    nextSensorForward, nextSensorReverse: {sensor : next sensor}
+    layoutProfile: LayoutProfile the run used, if any. Its sequence,
+                   measured blocks and bad detectors are kept with the run.
+    timestamp: seconds since the epoch, now by default
+    source: where the measurements came from, for runs that were imported
+
+    returns: the run number
+    """
+    def addRun(self, data, forwardMeasurements, reverseMeasurements,
+               nextSensorForward=None, nextSensorReverse=None,
+               layoutProfile=None, timestamp=None, source=None):
+        _storeLock.acquire()
+        try:
+            # another session may have added runs since we read the index
+            self._loadIndex()
+            return self._addRun(data, forwardMeasurements, reverseMeasurements,
+                                nextSensorForward, nextSensorReverse,
+                                layoutProfile, timestamp, source)
+        finally:
+            _storeLock.release()
+
+    def _addRun(self, data, forwardMeasurements, reverseMeasurements,
+                nextSensorForward, nextSensorReverse, layoutProfile, timestamp, source):
+        run = self.nextRun
+        chunks = {}
+        f = open(self._dataFilename(run), "wb")
+        try:
+            for forward, measurements in [(True, forwardMeasurements),
+                                          (False, reverseMeasurements)]:
+                for cvValue in sorted((measurements or {}).keys()):
+                    chunks[(forward, cvValue)] = self._writeChunk(f, measurements[cvValue])
+            chunks["Next Sensor"] = self._writeChunk(
+                f, {True : nextSensorForward or {}, False : nextSensorReverse or {}})
+        finally:
+            f.close()
+
+        record = {RUN : run,
+                  TIMESTAMP : time.time() if timestamp is None else timestamp,
+                  ADDRESS : data["DCC Address"],
+                  SUFFIX : str(data.get("Filename Suffix", "")),
+                  SOURCE : source,
+                  CV_VALUES_FORWARD : sorted((forwardMeasurements or {}).keys()),
+                  CV_VALUES_REVERSE : sorted((reverseMeasurements or {}).keys()),
+                  LAYOUT_PROFILE : None}
+        for key in METADATA_KEYS:
+            record[key] = data.get(key)
+        if layoutProfile:
+            record[LAYOUT_PROFILE] = {"sequence" : list(layoutProfile.getSequence()),
+                                      "measuredBlocks" : dict(layoutProfile.measuredBlocks),
+                                      "badDetectors" : layoutProfile.getBadDetectors()}
+
+        self.runs[run] = record
+        self.chunks[run] = chunks
+        self.nextRun = run + 1
+        self._saveIndex()
+        self._buildLookup()
+        return run
+
+    def _writeChunk(self, f, value):
+        offset = f.tell()
+        pickle.dump(value, f, 2)
+        return (offset, f.tell() - offset)
+
+    def _readChunk(self, f, location):
+        offset, length = location
+        f.seek(offset)
+        return pickle.loads(f.read(length))
+
+    """
+    Finds runs, oldest first.
+
+    address, suffix: only this locomotive. None matches any.
+    since, until: only runs from this time on / before this time, in
+                  seconds since the epoch
+    decoder: only runs with this decoder
+
+    returns: list of run records (dicts, see the keys at the top)
+    """
+    def findRuns(self, address=None, suffix=None, since=None, until=None, decoder=None):
+        if address is not None and suffix is not None:
+            candidates = self.byLocomotive.get((address, str(suffix)), [])
+        else:
+            candidates = [run for key in self.byLocomotive.keys()
+                          for run in self.byLocomotive[key]
+                          if address is None or key[0] == address]
+        records = []
+        for run in candidates:
+            record = self.runs[run]
+            if suffix is not None and not record[SUFFIX] == str(suffix):
+                continue
+            if since is not None and record[TIMESTAMP] < since:
+                continue
+            if until is not None and record[TIMESTAMP] >= until:
+                continue
+            if decoder is not None and not record["Decoder"] == decoder:
+                continue
+            records.append(record)
+        return sorted(records, key=lambda el: el[TIMESTAMP])
+
+    """
+    returns: the most recent run record of one locomotive, or None
+    """
+    def latestRun(self, address, suffix=""):
+        runs = self.byLocomotive.get((address, str(suffix)), [])
+        if not runs:
+            return None
+        return self.runs[runs[-1]]
+
+    def getRun(self, run):
+        return self.runs[run]
+
+    """
+    Loads the block times of one run in one direction, optionally only for
+    CV values from cvMinimum to cvMaximum inclusive.
+
+    returns: {cvValue : {sensor : [times]}}
+    """
+    def loadMeasurements(self, run, forward, cvMinimum=None, cvMaximum=None):
+        locations = [(key[1], self.chunks[run][key]) for key in self.chunks[run].keys()
+                     if isinstance(key, tuple) and key[0] == forward
+                     and (cvMinimum is None or key[1] >= cvMinimum)
+                     and (cvMaximum is None or key[1] <= cvMaximum)]
+        measurements = {}
+        if not locations:
+            return measurements
+        f = open(self._dataFilename(run), "rb")
+        try:
+            # in file order, so the reads go forward through the file
+            for cvValue, location in sorted(locations, key=lambda el: el[1][0]):
+                measurements[cvValue] = self._readChunk(f, location)
+        finally:
+            f.close()
+        return measurements
+
+    """
+    returns: {sensor : next sensor} seen in one direction of a run
+    """
+    def loadNextSensors(self, run, forward):
+        f = open(self._dataFilename(run), "rb")
+        try:
+            return self._readChunk(f, self.chunks[run]["Next Sensor"])[forward]
+        finally:
+            f.close()
+
+    """
+    Imports measurement files from before the store: .mbt pickles and
+    finished .mbj journals in the data folder, dated by when the file was
+    last changed. Files already imported are skipped.
+
+    returns: list of the new run numbers
+    """
+    def migrate(self, folder=None):
+        from LayoutBlocks import MeasurementJournal
+        if folder is None:
+            folder = dataFolder()
+        imported = set([self.runs[el][SOURCE] for el in self.runs.keys()])
+        newRuns = []
+        for name in sorted(os.listdir(folder)):
+            stem, extension = os.path.splitext(name)
+            if extension not in (".mbt", ".mbj"):
+                continue
+            filename = os.path.join(folder, name)
+            if filename in imported:
+                continue
+            address, suffix = _splitLocomotive(stem)
+            if address is None:
+                print("Skipping " + filename + ": no DCC address in the name")
+                continue
+
+            nextForward, nextReverse = {}, {}
+            if extension == ".mbj":
+                journal = MeasurementJournal(filename)
+                journal.load()
+                if not journal.isFinished():
+                    print("Skipping unfinished measurement journal: " + filename)
+                    continue
+                forward, nextForward = journal.getMeasurements(True)
+                reverse, nextReverse = journal.getMeasurements(False)
+            else:
+                f = open(filename, "rb")
+                try:
+                    forward, reverse = pickle.load(f)[:2]
+                finally:
+                    f.close()
+
+            run = self.addRun({ADDRESS : address, SUFFIX : suffix}, forward, reverse,
+                              nextForward, nextReverse,
+                              timestamp=os.path.getmtime(filename), source=filename)
+            newRuns.append(run)
+            print("Imported " + filename + " as run " + str(run))
+        return newRuns
+
+"""
+splits a measurement file name like 4012A into address 4012 and suffix A
+
+returns: (address, suffix), or (None, None) if it doesn't start with digits
+"""
+def _splitLocomotive(stem):
+    digits = 0
+    while digits < len(stem) and stem[digits].isdigit():
+        digits += 1
+    if digits == 0:
+        return None, None
+    return int(stem[:digits]), stem[digits:]
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="List and import fleet measurement runs")
+    parser.add_argument("--migrate", action="store_true",
+                        help="import .mbt and .mbj files from the data folder first")
+    parser.add_argument("--address", type=int, default=None)
+    args = parser.parse_args()
+
+    store = FleetStore()
+    if args.migrate:
+        store.migrate()
+    for record in store.findRuns(address=args.address):
+        print(str(record[RUN]) + "\t" +
+              time.strftime("%Y-%m-%d %H:%M", time.localtime(record[TIMESTAMP])) + "\t" +
+              str(record[ADDRESS]) + str(record[SUFFIX]) + "\t" +
+              str(record["Decoder"]) + "\t" + str(record["Maximum Speed"]) + " smph\t" +
+              str(len(record[CV_VALUES_FORWARD])) + "/" +
+              str(len(record[CV_VALUES_REVERSE])) + " CV values")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+from .FleetStore import FleetStore
@@ -0,0 +1,3 @@
+from .FleetStore import main
+
+main()
@@ -56,6 +56,29 @@ class GUI:
             savePanel.add(self.saveMeasurementsToDisk)
             savePanel.add(self.loadMeasurementsFromDisk)
 
+            # carry on with measurements that were interrupted
+            self.resumeMeasurements = javax.swing.JCheckBox(text="Resume Interrupted Measurements", selected=False)
+            resumePanel = javax.swing.JPanel()
+            resumePanel.add(self.resumeMeasurements)
+
+            # warm up until lap times settle instead of for 5 minutes
+            self.warmUpUntilStable = javax.swing.JCheckBox(text="Warm Up Until Lap Times Settle", selected=True)
+            resumePanel.add(self.warmUpUntilStable)
+
+            # skip writing CVs that the roster says the decoder already holds
+            self.useRosterCvs = javax.swing.JCheckBox(text="Trust Roster CV Values", selected=False)
+            rosterPanel = javax.swing.JPanel()
+            rosterPanel.add(self.useRosterCvs)
+
+            # measure on a plateau speed table instead of programming every CV value
+            self.plateauSpeedTable = javax.swing.JCheckBox(text="Measure on Plateau Speed Table", selected=False)
+            rosterPanel.add(self.plateauSpeedTable)
+            # decoders that interpolate over more speed steps need wider plateaus
+            self.plateauWidth = javax.swing.JTextField(2)
+            self.plateauWidth.setText("3")
+            rosterPanel.add(javax.swing.JLabel(" steps per plateau"))
+            rosterPanel.add(self.plateauWidth)
+
             # create the momentum value fields
             self.cv3 = javax.swing.JTextField(3)    # sized to hold 3 characters, initially empty
             self.cv4 = javax.swing.JTextField(3)    # sized to hold 3 characters, initially empty
@@ -109,6 +132,8 @@ class GUI:
             f.contentPane.add(dccAddressPanel)
             f.contentPane.add(filenameSuffixPanel)
             f.contentPane.add(savePanel)
+            f.contentPane.add(resumePanel)
+            f.contentPane.add(rosterPanel)
             f.contentPane.add(self.scale)
             f.contentPane.add(self.decoder)
             f.contentPane.add(momentumPanel)
@@ -140,6 +165,15 @@ class GUI:
 
                 self.saveMeasurementsToDisk = self.saveMeasurementsToDisk.isSelected()
                 self.loadMeasurementsFromDisk = self.loadMeasurementsFromDisk.isSelected()
+                self.resumeMeasurements = self.resumeMeasurements.isSelected()
+                self.warmUpUntilStable = self.warmUpUntilStable.isSelected()
+                self.useRosterCvs = self.useRosterCvs.isSelected()
+                self.plateauSpeedTable = self.plateauSpeedTable.isSelected()
+
+                if not self.plateauWidth.text.isdigit() or \
+                   not 1 <= int(self.plateauWidth.text) <= 9:
+                    raise Exception("Invalid Plateau Width")
+                self.plateauWidth = int(self.plateauWidth.text)
 
                 self.decoder = str(self.decoder.getSelectedItem())
 
@@ -184,6 +218,11 @@ class GUI:
                     "Filename Suffix" : self.filenameSuffix,
                     "Save Measurements" : self.saveMeasurementsToDisk,
                     "Load Measurements" : self.loadMeasurementsFromDisk,
+                    "Resume Measurements" : self.resumeMeasurements,
+                    "Warm Up Until Stable" : self.warmUpUntilStable,
+                    "Use Roster CVs" : self.useRosterCvs,
+                    "Plateau Speed Table" : self.plateauSpeedTable,
+                    "Plateau Width" : self.plateauWidth,
                     "Decoder" : self.decoder,
                     "Scale" : self.scale,
                     "CV3" : self.cv3,
@@ -193,7 +232,7 @@ class GUI:
 
         @RedirectStdErr
         def updateStatus(self, text):
-            self.status = text
+            self.status.setText(text)
 
         # TODO: Re-enabling the start button and clicking on
         # 'start' again doesn't actually read new values if you
@@ -1 +1 @@
-from GUI import GUI
+from .GUI import GUI
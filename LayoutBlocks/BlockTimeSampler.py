@@ -0,0 +1,178 @@
+"""
+Decides when we have measured a speed table CV value well enough to move on.
+
+Instead of driving a fixed number of laps at every CV value, we keep a
+running estimate of each block time as samples come in. Samples far from
+the median (an engine stall, dirty wheel pickups) are rejected as outliers,
+and the remaining samples give a mean and a standard error. Once every
+measured block has its minimum number of good samples and a confidence
+interval that is tight enough, the CV value is done. Noisy blocks keep
+sampling until they settle down or reach the maximum number of samples.
+
+Once the lengths of the other blocks are known (see BlockLengthSolver),
+every block is a speed sample, not just the measured ones: dividing a
+block time by the block's length gives the time per inch, and those are
+pooled over all blocks. One lap then gives one sample per block instead
+of one sample in total, and the CV value is done as soon as the pooled
+estimate is tight enough - usually well within the first lap.
+"""
+from math import sqrt
+
+from Utils import inliers
+
+# two-sided 95% Student-t quantiles by degrees of freedom. With only a few
+# samples, the standard deviation is itself a rough guess, and the interval
+# has to be much wider than the normal 1.96 standard errors.
+T_QUANTILES_95 = [(1, 12.706), (2, 4.303), (3, 3.182), (4, 2.776), (5, 2.571),
+                  (6, 2.447), (7, 2.365), (8, 2.306), (9, 2.262), (10, 2.228),
+                  (12, 2.179), (15, 2.131), (20, 2.086), (30, 2.042), (60, 2.000),
+                  (120, 1.980)]
+
+"""
+returns: the two-sided 95% Student-t quantile for degreesOfFreedom, from
+         the next smaller tabulated entry, so it errs on the wide side
+"""
+def tQuantile95(degreesOfFreedom):
+    quantile = T_QUANTILES_95[0][1]
+    for df, value in T_QUANTILES_95:
+        if df > degreesOfFreedom:
+            break
+        quantile = value
+    return quantile
+
+"""
+Streaming estimate of the travel time through one block, for one CV value
+in one direction.
+"""
+class BlockTimeEstimator:
+    def __init__(self):
+        self.samples = []
+        self.goodSamples = []
+
+    """
+    adds a block time in seconds
+
+    returns: True if the sample is accepted, False if it's an outlier
+    """
+    def addSample(self, timeSec):
+        self.samples.append(timeSec)
+        # earlier samples can become outliers as the median settles,
+        # so reclassify all of them
+        self.goodSamples = inliers(self.samples)
+        return timeSec in self.goodSamples
+
+    def numSamples(self):
+        return len(self.samples)
+
+    def numGoodSamples(self):
+        return len(self.goodSamples)
+
+    def mean(self):
+        if not self.goodSamples:
+            return None
+        return sum(self.goodSamples) * 1.0 / len(self.goodSamples)
+
+    """
+    half width of the 95% confidence interval of the mean, relative to the
+    mean, from the Student-t distribution. Returns None with fewer than two
+    good samples.
+    """
+    def relativeHalfWidth(self):
+        n = len(self.goodSamples)
+        if n < 2:
+            return None
+        m = self.mean()
+        variance = sum([(el - m) ** 2 for el in self.goodSamples]) * 1.0 / (n - 1)
+        return tQuantile95(n - 1) * sqrt(variance / n) / m
+
+
+"""
+Collects the block time samples for one CV value in one direction and
+applies the stopping rule.
+
+measuredSensors: sensors of the blocks the speed table is built from
+minimumSamples: fewest good samples for each measured block
+maximumSamples: stop once any block has this many samples, even if the
+                estimate still isn't tight
+relativeTolerance: stop once the confidence interval of every measured
+                   block is within this fraction of its mean time
+blockLengths: dict of sensor : length in inches for this direction, for
+              blocks whose length is known well enough to pool them. None
+              or empty to use only the measured blocks.
+minimumPooledSamples: fewest good pooled samples when pooling
+"""
+class CvValueSampler:
+    def __init__(self, measuredSensors, minimumSamples=2, maximumSamples=8,
+                 relativeTolerance=0.02, blockLengths=None, minimumPooledSamples=8):
+        self.measuredSensors = list(measuredSensors)
+        self.minimumSamples = minimumSamples
+        self.maximumSamples = maximumSamples
+        self.relativeTolerance = relativeTolerance
+        self.estimators = {}
+        self.blockLengths = blockLengths or {}
+        self.minimumPooledSamples = minimumPooledSamples
+        # time per inch, over all blocks with a known length
+        self.pooledEstimator = BlockTimeEstimator()
+
+    """
+    returns: True if the sample is accepted, False if it's an outlier
+    """
+    def addSample(self, sensor, timeSec):
+        if sensor not in self.estimators:
+            self.estimators[sensor] = BlockTimeEstimator()
+        accepted = self.estimators[sensor].addSample(timeSec)
+        if self._isPooling() and sensor in self.blockLengths:
+            # across blocks, outliers show up much sooner than within one
+            accepted = self.pooledEstimator.addSample(timeSec / self.blockLengths[sensor])
+        return accepted
+
+    def _isPooling(self):
+        return len(self.blockLengths) > 1
+
+    def getEstimator(self, sensor):
+        return self.estimators.get(sensor)
+
+    """
+    returns: True if we should stop measuring this CV value
+    """
+    def isComplete(self):
+        for estimator in self.estimators.values():
+            if estimator.numSamples() >= self.maximumSamples:
+                return True
+
+        if self._isPooling():
+            if self.pooledEstimator.numGoodSamples() < self.minimumPooledSamples:
+                return False
+            return self.pooledEstimator.relativeHalfWidth() <= self.relativeTolerance
+
+        # without any measured blocks, every block we've seen has to settle
+        sensors = self.measuredSensors or list(self.estimators.keys())
+        if not sensors:
+            return False
+        for sensor in sensors:
+            estimator = self.estimators.get(sensor)
+            if estimator is None:
+                return False
+            if estimator.numGoodSamples() < self.minimumSamples:
+                return False
+            halfWidth = estimator.relativeHalfWidth()
+            if (halfWidth is not None) and (halfWidth > self.relativeTolerance):
+                return False
+        return True
+
+    """
+    robust mean time in seconds for each measured block seen so far. When
+    pooling, the pooled time per inch times the block's length, for every
+    measured block, seen or not.
+    """
+    def measuredBlockTimes(self):
+        times = {}
+        pooledTimePerInch = None
+        if self._isPooling():
+            pooledTimePerInch = self.pooledEstimator.mean()
+        for sensor in self.measuredSensors:
+            if pooledTimePerInch is not None and sensor in self.blockLengths:
+                times[sensor] = pooledTimePerInch * self.blockLengths[sensor]
+            elif sensor in self.estimators:
+                times[sensor] = self.estimators[sensor].mean()
+        return times
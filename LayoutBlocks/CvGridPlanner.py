@@ -0,0 +1,240 @@
+"""
+Picks which speed table CV values to measure, one at a time, from the
+measurements collected so far.
+
+All planners look at observations in the same form: a dict of CV value to
+relative block time, which is the measured block time divided by the block
+time at the requested maximum speed. A relative time of 1.0 means the
+locomotive runs at exactly the requested speed; above 1.0 it is slower.
+
+FixedCvGrid walks the same list of CV values we have always used, upwards,
+until the locomotive is fast enough.
+
+CvGridPlanner does the same job with fewer points. Travel time is roughly
+inversely proportional to (CV value - vStart), so it predicts the CV value
+for the maximum speed with a secant in log-log space and jumps straight
+there, slightly on the fast side so that the target speed is bracketed.
+It then only adds points where they help the table. SpeedTableBuilder
+interpolates log(time) linearly in CV value, while the log-log model says
+the curve bends, most of all at slow speeds. So we add a point to an
+interval when the two disagree by more than speedTolerance inside it, and
+around measurements that bend away from the log-log line through their
+neighbors. Errors are judged as a fraction of the maximum speed, so a 10%
+error at a crawl counts for much less than 10% near the top. That's also
+where the laps are cheap: slow points cost the most time, and intervals
+slower than the first speed step don't affect the table at all.
+
+An observation of None is a CV value that was measured without a usable
+block time. Planners never ask for it again, and plan around it with the
+usable ones.
+"""
+from math import log, exp
+
+"""
+CV value of the slowest measurement, scaled for vStart like the rest of
+the fixed grid
+"""
+def lowestCvValue(vStart):
+    return vStart + int(16 * (255 - vStart) / 255.0)
+
+
+class FixedCvGrid:
+    def __init__(self, vStart=0):
+        unscaledCvValuesToMeasure = [16, 32, 56, 80, 112, 144, 176, 208, 240, 255]
+        # account for vStart
+        self.cvValuesToMeasure = [vStart + int( el * (255 - vStart) / 255.0 )
+                                  for el in unscaledCvValuesToMeasure]
+
+    """
+    observations: dict of CV value to relative block time
+    refine: unused, the grid is fixed
+
+    returns: the next CV value to measure, or None if we're done
+    """
+    def nextCvValue(self, observations, refine=True):
+        for cvValue in self.cvValuesToMeasure:
+            if cvValue not in observations:
+                return cvValue
+            if observations[cvValue] is not None and observations[cvValue] <= 1.0:
+                return None
+        return None
+
+
+"""
+vStart: CV2 setting; the speed table starts here
+maximumPoints: never measure more CV values than this
+minimumSpacing: smallest distance between two measured CV values
+speedTolerance: add a point to an interval where the log-log model and
+                the interpolation differ by more than this fraction of the
+                maximum speed, and around measurements that are this far
+                off the log-log line through their neighbors
+overshoot: aim this fraction faster than the maximum speed when looking
+           for the top of the table, so that the target is bracketed.
+           Within this fraction below the maximum speed is close enough.
+"""
+class CvGridPlanner:
+    def __init__(self, vStart=0, maximumPoints=10, minimumSpacing=4,
+                 speedTolerance=0.03, overshoot=0.05):
+        self.vStart = vStart
+        self.lowestCv = lowestCvValue(vStart)
+        self.maximumPoints = maximumPoints
+        self.minimumSpacing = minimumSpacing
+        self.speedTolerance = speedTolerance
+        self.overshoot = overshoot
+
+    """
+    observations: dict of CV value to relative block time, None for CV
+                  values that gave no usable block time
+    refine: if False, only look for the top of the table
+
+    returns: the next CV value to measure, or None if we're done. Never one
+             that's already in observations.
+    """
+    def nextCvValue(self, observations, refine=True):
+        measured = observations
+        observations = self._validObservations(observations)
+        if len(observations) >= self.maximumPoints:
+            return None
+        lowCv = self._lowCv(measured)
+        if lowCv not in measured:
+            return lowCv
+        if not observations:
+            return None
+
+        if self._topCv(observations) is None:
+            return self._untried(self._predictTopCv(observations), measured)
+        if refine:
+            return self._refinementCv(observations, measured)
+        return None
+
+    """
+    returns: where the slowest usable measurement should be: lowestCv, or
+             if that gave no usable block time (e.g. the locomotive stalls
+             at a crawl), twice as far above vStart, and so on
+    """
+    def _lowCv(self, measured):
+        cvValue = self.lowestCv
+        while cvValue in measured and measured[cvValue] is None and cvValue < 255:
+            cvValue = min(self.vStart + 2 * (cvValue - self.vStart), 255)
+        return cvValue
+
+    """
+    returns: cvValue, or the next CV value up that hasn't been measured.
+             None if there's none left up to 255.
+    """
+    def _untried(self, cvValue, measured):
+        while cvValue in measured:
+            if cvValue >= 255:
+                return None
+            cvValue = min(cvValue + self.minimumSpacing, 255)
+        return cvValue
+
+    def _validObservations(self, observations):
+        valid = {}
+        for cv in observations.keys():
+            if observations[cv] is not None and observations[cv] > 0:
+                valid[cv] = observations[cv]
+        return valid
+
+    """
+    smallest CV value that's (close to) fast enough, or 255 if we got there
+    without being fast enough. None if we haven't found the top of the
+    table yet. SpeedTableBuilder extrapolates the last little bit.
+    """
+    def _topCv(self, observations):
+        fastEnough = [cv for cv in observations.keys()
+                      if observations[cv] <= 1.0 + self.overshoot]
+        if fastEnough:
+            return min(fastEnough)
+        if 255 in observations:
+            return 255
+        return None
+
+    """
+    secant through the two fastest measurements in log(time) vs.
+    log(CV value - vStart) space, solved for the target speed
+    """
+    def _predictTopCv(self, observations):
+        cvs = sorted(observations.keys())
+        highCv = cvs[-1]
+        x2 = log(max(highCv - self.vStart, 1))
+        y2 = log(observations[highCv])
+        # until we have two points, assume time falls a bit faster than
+        # 1 / (cv - vStart), as most motors need some voltage to get going.
+        # This errs on the slow side of the maximum speed.
+        slope = -1.5
+        if len(cvs) > 1:
+            lowCv = cvs[-2]
+            x1 = log(max(lowCv - self.vStart, 1))
+            y1 = log(observations[lowCv])
+            if x2 > x1 and y2 < y1:
+                slope = (y2 - y1) / (x2 - x1)
+
+        targetY = log(1.0 - self.overshoot)
+        predictedCv = self.vStart + exp(x2 + (targetY - y2) / slope)
+        predictedCv = int(predictedCv + 0.999)
+        predictedCv = max(predictedCv, highCv + self.minimumSpacing)
+        return min(predictedCv, 255)
+
+    """
+    midpoint of the interval that most needs another measurement, or None
+    if every interval up to the top of the table is good enough
+    """
+    def _refinementCv(self, observations, measured):
+        topCv = self._topCv(observations)
+        cvs = sorted([cv for cv in observations.keys() if cv <= topCv])
+        logTimes = [log(observations[cv]) for cv in cvs]
+
+        # score > 1 means the interval [cvs[i], cvs[i+1]] needs a point.
+        # Dividing a log time error by the relative time turns it into a
+        # speed error as a fraction of the maximum speed.
+        scores = [0.0] * (len(cvs) - 1)
+        for i in range(len(cvs) - 1):
+            error = self._interpolationError(cvs[i], logTimes[i],
+                                             cvs[i+1], logTimes[i+1])
+            scores[i] = error / exp(logTimes[i+1]) / self.speedTolerance
+
+        # bends: compare each point to the log-log model through its
+        # neighbors. Where the data doesn't follow the model, the model based
+        # error estimate above can't be trusted either.
+        logCvs = [log(max(cv - self.vStart, 1)) for cv in cvs]
+        for i in range(1, len(cvs) - 1):
+            fraction = (logCvs[i] - logCvs[i-1]) / (logCvs[i+1] - logCvs[i-1])
+            line = logTimes[i-1] + fraction * (logTimes[i+1] - logTimes[i-1])
+            bend = abs(logTimes[i] - line) / exp(logTimes[i]) / self.speedTolerance
+            scores[i-1] = max(scores[i-1], bend)
+            scores[i] = max(scores[i], bend)
+
+        bestScore = 1.0
+        bestCv = None
+        for i in range(len(cvs) - 1):
+            if cvs[i+1] - cvs[i] < 2 * self.minimumSpacing:
+                continue
+            # slower than the first speed step all the way through
+            if logTimes[i+1] > log(28.0):
+                continue
+            # measured already, without a usable block time
+            if (cvs[i] + cvs[i+1]) // 2 in measured:
+                continue
+            if scores[i] > bestScore:
+                bestScore = scores[i]
+                bestCv = (cvs[i] + cvs[i+1]) // 2
+        return bestCv
+
+    """
+    largest difference in log time between the log-log model through two
+    measurements and the straight line SpeedTableBuilder interpolates with
+    """
+    def _interpolationError(self, lowCv, lowLogTime, highCv, highLogTime):
+        x1 = log(max(lowCv - self.vStart, 1))
+        x2 = log(max(highCv - self.vStart, 1))
+        if x2 <= x1:
+            return 0.0
+        slope = (highLogTime - lowLogTime) / (x2 - x1)
+        error = 0.0
+        for i in range(1, 8):
+            cv = lowCv + (highCv - lowCv) * i / 8.0
+            model = lowLogTime + slope * (log(max(cv - self.vStart, 1)) - x1)
+            line = lowLogTime + (highLogTime - lowLogTime) * i / 8.0
+            error = max(error, abs(model - line))
+        return error
@@ -0,0 +1,216 @@
+"""
+Sits between the SensorMonitor and the measurements, and keeps detector
+noise out of the block times instead of letting it spoil a long run:
+
+- Chatter: a detector with dirty wheels or a marginal diode drop flickers
+  while the locomotive is in its block, and reports the same sensor again
+  and again. An activation of one of the last two sensors the locomotive
+  passed, or of a sensor that went active less than debounceSec ago, is
+  dropped.
+- Sequence: once the sensors around the loop are known (setSequence), an
+  activation has to be one of the next lookAhead sensors the locomotive
+  can reach. Anything else is dropped as out of order. Skipping sensors
+  on the way is allowed - those detections were missed.
+- Quarantine: a sensor that fires out of order quarantineStrikes times, or
+  is missed missedStrikes laps in a row, is taken out of the sequence and
+  no longer watched for the rest of the run. Blocks that ended at it are
+  dropped from then on, since they'd now be measured to the sensor after
+  it. The sensors of the measured blocks are never quarantined.
+
+report() says what happened to each sensor, for the end of the run.
+"""
+
+class DetectionFilter:
+    """
+    monitor: the SensorMonitor to read activations from
+    """
+    def __init__(self, monitor, debounceSec=2.0, lookAhead=3, quarantineStrikes=5,
+                 missedStrikes=3):
+        self.monitor = monitor
+        self.debounceSec = debounceSec
+        self.lookAhead = lookAhead
+        self.quarantineStrikes = quarantineStrikes
+        self.missedStrikes = missedStrikes
+        # sensors around the loop, see setSequence
+        self.sequence = []
+        # forward (True / False) : {sensor : sensor that should end its block}
+        self.expectedNextSensor = {True : {}, False : {}}
+        # sensors that are never quarantined
+        self.protectedSensors = set()
+        # the last sensors accepted since the locomotive last changed speed
+        self.recentSensors = []
+        # sensor : time of its last activation, accepted or not
+        self.lastActivation = {}
+        self.outOfOrderInARow = 0
+        # sensor : number of activations dropped as chatter / out of order,
+        # and number of times it was missed
+        self.chatter = {}
+        self.outOfOrder = {}
+        self.missed = {}
+        self.missedInARow = {}
+        # sensors that were accepted at least once
+        self.seen = set()
+        # sensor : why it was quarantined
+        self.quarantined = {}
+        # (forward, sensor) of blocks that ended at a quarantined sensor
+        self.droppedBlocks = set()
+
+    """
+    sequence: sensors around the loop, in the order a locomotive driving
+              forward passes them. Only these are watched from now on.
+    protectedSensors: sensors that must not be quarantined, e.g. the
+                      measured blocks
+    """
+    def setSequence(self, sequence, protectedSensors=None):
+        n = len(sequence)
+        self.sequence = list(sequence)
+        self.expectedNextSensor = {True : {}, False : {}}
+        for i in range(n):
+            self.expectedNextSensor[True][sequence[i]] = sequence[(i + 1) % n]
+            self.expectedNextSensor[False][sequence[i]] = sequence[(i - 1) % n]
+        # the measured blocks need the sensors on either side of them too
+        self.protectedSensors = set()
+        for sensor in protectedSensors or []:
+            self.protectedSensors.add(sensor)
+            for forward in [True, False]:
+                if sensor in self.expectedNextSensor[forward]:
+                    self.protectedSensors.add(self.expectedNextSensor[forward][sensor])
+        self.monitor.watchOnly(sequence)
+
+    """
+    forgets where the locomotive was and the activations not read yet.
+    Call this once the locomotive runs at a new speed or direction.
+    """
+    def restart(self):
+        self.recentSensors = []
+        self.outOfOrderInARow = 0
+        self.monitor.clear()
+
+    """
+    returns (sensor name, activation time in seconds) of the next
+    activation that passes the checks above, waiting for one if needed
+    """
+    def waitForActivation(self, forward, timeoutSec=None):
+        while True:
+            sensor, timeSec = self.monitor.waitForActivation(timeoutSec)
+            if sensor in self.quarantined:
+                # queued before it was quarantined
+                continue
+            lastTime = self.lastActivation.get(sensor)
+            self.lastActivation[sensor] = timeSec
+            if sensor in self.recentSensors or \
+               (lastTime is not None and timeSec - lastTime < self.debounceSec):
+                self.chatter[sensor] = self.chatter.get(sensor, 0) + 1
+                continue
+
+            missed = self._missedOnTheWay(forward, sensor)
+            if missed is None:
+                self.outOfOrder[sensor] = self.outOfOrder.get(sensor, 0) + 1
+                if self.outOfOrder[sensor] >= self.quarantineStrikes:
+                    self._quarantine(sensor, "fired out of order " +
+                                     str(self.outOfOrder[sensor]) + " times")
+                self.outOfOrderInARow += 1
+                if self.outOfOrderInARow < self.lookAhead:
+                    continue
+                # we lost track of the locomotive, e.g. several detections
+                # in a row were missed. Carry on from here.
+                print("WARNING: " + str(self.outOfOrderInARow) + " sensors in a row out of "
+                      "order. Carrying on from " + sensor)
+                missed = []
+            self.outOfOrderInARow = 0
+
+            for el in missed:
+                self.missed[el] = self.missed.get(el, 0) + 1
+                self.missedInARow[el] = self.missedInARow.get(el, 0) + 1
+                if self.missedInARow[el] >= self.missedStrikes:
+                    self._quarantine(el, "missed " + str(self.missedInARow[el]) +
+                                     " times in a row")
+            self.missedInARow[sensor] = 0
+            self.seen.add(sensor)
+            self.recentSensors = (self.recentSensors + [sensor])[-2:]
+            return sensor, timeSec
+
+    """
+    returns: the sensors the locomotive passed without them reporting, on
+             its way from the last accepted sensor to this one, or None if
+             it can't have got to this one
+    """
+    def _missedOnTheWay(self, forward, sensor):
+        expectedNextSensor = self.expectedNextSensor[forward]
+        if not self.recentSensors or self.recentSensors[-1] not in expectedNextSensor:
+            return []
+        missed = []
+        following = expectedNextSensor[self.recentSensors[-1]]
+        while len(missed) < self.lookAhead:
+            if following == sensor:
+                return missed
+            missed.append(following)
+            following = expectedNextSensor.get(following)
+        return None
+
+    """
+    checks a block time against the sequence: a block should end at the
+    next sensor of the loop. If it ended elsewhere, a detection was missed
+    and the time isn't the time of this block.
+
+    returns: True if the block time can be used
+    """
+    def isExpectedBlock(self, forward, sensor, nextSensor):
+        if (forward, sensor) in self.droppedBlocks:
+            return False
+        expected = self.expectedNextSensor[forward].get(sensor)
+        if expected is None or expected == nextSensor:
+            return True
+        print("WARNING: block " + sensor + " ended at " + nextSensor + " rather than " +
+              expected + " (missed detection). Skipping this block time.")
+        return False
+
+    def _quarantine(self, sensor, reason):
+        if sensor in self.quarantined:
+            return
+        if sensor in self.protectedSensors:
+            print("WARNING: sensor " + sensor + " " + reason + ", but it's needed for a "
+                  "measured block. Still watching it.")
+            self.outOfOrder[sensor] = 0
+            self.missedInARow[sensor] = 0
+            return
+        self.quarantined[sensor] = reason
+        for forward in [True, False]:
+            expectedNextSensor = self.expectedNextSensor[forward]
+            for other in list(expectedNextSensor.keys()):
+                if expectedNextSensor[other] == sensor:
+                    expectedNextSensor[other] = expectedNextSensor.get(sensor)
+                    # a sensor that never reported wasn't really a block end
+                    # (e.g. it went active on the discovery laps by chance)
+                    if sensor in self.seen:
+                        self.droppedBlocks.add((forward, other))
+            expectedNextSensor.pop(sensor, None)
+        self.monitor.watchOnly([el for el in self.monitor.watchedSensors() if not el == sensor])
+        print("WARNING: sensor " + sensor + " " + reason + ". Quarantined for the rest "
+              "of the run.")
+
+    """
+    returns: the sensors around the loop without the quarantined ones
+    """
+    def getSequence(self):
+        return [el for el in self.sequence if el not in self.quarantined]
+
+    def getQuarantinedSensors(self):
+        return sorted(self.quarantined.keys())
+
+    """
+    returns: list of lines describing the detector trouble during the run,
+             empty if there was none
+    """
+    def report(self):
+        lines = []
+        sensors = set(self.chatter.keys()) | set(self.outOfOrder.keys()) | \
+                  set(self.missed.keys()) | set(self.quarantined.keys())
+        for sensor in sorted(sensors):
+            line = sensor + ": " + str(self.chatter.get(sensor, 0)) + " chatter, " + \
+                   str(self.outOfOrder.get(sensor, 0)) + " out of order, " + \
+                   str(self.missed.get(sensor, 0)) + " missed"
+            if sensor in self.quarantined:
+                line += " - quarantined, " + self.quarantined[sensor]
+            lines.append(line)
+        return lines
@@ -0,0 +1,300 @@
+"""
+Predicts how long the rest of a calibration run takes, so runs can be fit
+into the time there is - a slow locomotive can take all night.
+
+The prediction has three parts:
+
+- The speed curve: the relative block time (see CvGridPlanner) at any CV
+  value, from a least squares line in log(time) vs. log(CV value - vStart)
+  space through what was measured so far in that direction - or in the
+  other one, or in the locomotive's last run, as long as there's nothing
+  better.
+- The lap time at the maximum speed: lap times seen so far (two passes of
+  the first measured block at the same CV value) divided by the relative
+  time at their CV value. Until a lap has been seen, every block is taken
+  to be as long as the measured one.
+- The cost of a CV value: a fixed part for the CV writes and waiting for
+  the locomotive to settle, plus some number of laps. Both are fitted to
+  the wall time the CV values took so far; until there are two of them we
+  assume overheadSec and lapsPerCvValue.
+
+The CV values still to come are those the planner would pick if the speed
+curve were exactly right, in the order LayoutBlocks measures them: the rest
+of forward, then reverse at the forward CV values and whatever the planner
+adds for reverse. With interleaved, both directions are measured at every
+CV value the planner picks for either of them (see VisitScheduler).
+
+estimate() gives the remaining laps and seconds for each direction, and
+describe() a line for the script output and the GUI status.
+"""
+from math import log, exp
+
+from Utils import monotonicTimeSec, median
+
+class EtaPredictor:
+    """
+    planner: CvGridPlanner or FixedCvGrid of the run
+    vStart: CV2 setting, as for the planner
+    topSpeedTimeSec: block time of the first measured block at the maximum speed
+    sequenceLength: number of blocks around the loop, if known
+    clock: function returning the current time in seconds
+    interleaved: True if forward and reverse are measured back to back at
+                 each CV value, instead of all forward first
+    """
+    def __init__(self, planner, vStart, topSpeedTimeSec, sequenceLength=None,
+                 overheadSec=10.0, lapsPerCvValue=1.5, clock=monotonicTimeSec,
+                 interleaved=False):
+        self.planner = planner
+        self.vStart = vStart
+        self.topSpeedTimeSec = topSpeedTimeSec
+        self.sequenceLength = sequenceLength
+        self.overheadSec = overheadSec
+        self.lapsPerCvValue = lapsPerCvValue
+        self.clock = clock
+        self.interleaved = interleaved
+        # forward (True / False) : {cvValue : relative block time}
+        self.observations = {True : {}, False : {}}
+        # forward : CV values measured without a usable block time
+        self.unusable = {True : [], False : []}
+        # the same from the locomotive's last run, see useHistory
+        self.history = {True : {}, False : {}}
+        # list of (cvValue, lap time in seconds)
+        self.lapTimes = []
+        # (forward, cvValue) : time the first measured block last ended
+        self.lastLap = {}
+        # list of (forward, cvValue, wall time in seconds) of finished CV values
+        self.cvValueTimes = []
+        # (forward, cvValue, start time) of the CV value being measured
+        self.current = None
+        # whether the locomotive took samples at the current CV value, or
+        # they all came from the journal (see MeasurementJournal)
+        self.sampled = False
+
+    """
+    sets the CV values and speed curve of an earlier run of the locomotive
+    to predict with until this run has its own
+
+    forwardMeasurements, reverseMeasurements: {cvValue : {sensor : [times]}},
+                                              as stored in the FleetStore
+    measuredSensor: the first measured block
+    """
+    def useHistory(self, forwardMeasurements, reverseMeasurements, measuredSensor):
+        for forward, measurements in [(True, forwardMeasurements), (False, reverseMeasurements)]:
+            for cvValue in measurements.keys():
+                times = measurements[cvValue].get(measuredSensor)
+                if times:
+                    self.history[forward][cvValue] = median(times) / self.topSpeedTimeSec
+
+    def setSequenceLength(self, sequenceLength):
+        self.sequenceLength = sequenceLength
+
+    def beginCvValue(self, forward, cvValue):
+        self.current = (forward, cvValue, self.clock())
+        self.sampled = False
+
+    """
+    relativeTime: what _measureBlockTime returned, None if there were no
+                  usable samples
+    """
+    def endCvValue(self, forward, cvValue, relativeTime):
+        if self.current and self.current[:2] == (forward, cvValue) and self.sampled:
+            self.cvValueTimes.append((forward, cvValue, self.clock() - self.current[2]))
+        self.current = None
+        if relativeTime is not None and relativeTime > 0:
+            self.observations[forward][cvValue] = relativeTime
+        elif cvValue not in self.unusable[forward]:
+            self.unusable[forward].append(cvValue)
+
+    """
+    adds a block time sample, to find the laps
+
+    endTimeSec: activation time of the sensor that ended the block
+    lap: True if the block is the first measured block
+    """
+    def addSample(self, forward, cvValue, endTimeSec, lap):
+        self.sampled = True
+        if not lap:
+            return
+        key = (forward, cvValue)
+        if key in self.lastLap:
+            self.lapTimes.append((cvValue, endTimeSec - self.lastLap[key]))
+        self.lastLap[key] = endTimeSec
+
+    """
+    returns: {forward : (remaining laps, remaining seconds)}, or None if
+             there's nothing to predict the speed from yet
+    """
+    def estimate(self):
+        if self._curve(True) is None:
+            return None
+        lapTimeAtTop = self._lapTimeAtTop()
+        overheadSec, lapsPerCvValue = self._cvValueCost(lapTimeAtTop)
+        remaining = self._remainingCvValues()
+
+        result = {}
+        for forward in [True, False]:
+            laps = 0.0
+            seconds = 0.0
+            for cvValue in remaining[forward]:
+                lapTime = lapTimeAtTop * self._relativeTime(forward, cvValue)
+                laps += lapsPerCvValue
+                seconds += overheadSec + lapsPerCvValue * lapTime
+                # the CV value being measured is partly done
+                if self.current and self.current[:2] == (forward, cvValue):
+                    elapsed = self.clock() - self.current[2]
+                    done = min(1.0, elapsed / (overheadSec + lapsPerCvValue * lapTime))
+                    laps -= done * lapsPerCvValue
+                    seconds -= done * (overheadSec + lapsPerCvValue * lapTime)
+            result[forward] = (laps, seconds)
+        return result
+
+    """
+    returns: list of (forward, cvValue) still to measure, in the order they
+             are expected to come up. Empty if there's nothing to predict
+             from yet.
+    """
+    def upcomingCvValues(self):
+        if self._curve(True) is None:
+            return []
+        remaining = self._remainingCvValues()
+        return [(True, el) for el in remaining[True]] + [(False, el) for el in remaining[False]]
+
+    """
+    returns: {forward : CV values still to measure, in order}
+    """
+    def _remainingCvValues(self):
+        if self.interleaved:
+            return self._remainingInterleaved()
+        remaining = {True : [], False : []}
+        # forward isn't done until reverse has started
+        reverseStarted = bool([el for el in self.cvValueTimes if not el[0]]) or \
+                         (self.current is not None and not self.current[0])
+        plannedForward = dict(self.observations[True])
+        plannedReverse = dict(self.observations[False])
+        for cvValue in self.unusable[True]:
+            plannedForward[cvValue] = None
+        for cvValue in self.unusable[False]:
+            plannedReverse[cvValue] = None
+        if not reverseStarted:
+            remaining[True] = self._plannedCvValues(True, plannedForward)
+        for cvValue in sorted(plannedForward.keys()):
+            if cvValue not in plannedReverse:
+                plannedReverse[cvValue] = self._relativeTime(False, cvValue)
+                remaining[False].append(cvValue)
+        remaining[False] += self._plannedCvValues(False, plannedReverse)
+        return remaining
+
+    """
+    returns: {forward : CV values still to measure, in order}, each
+             direction getting the CV values planned for either one
+    """
+    def _remainingInterleaved(self):
+        # the ones measured in one direction only come first
+        cvValues = sorted(set(self.observations[True].keys()) | set(self.observations[False].keys()))
+        for forward in [True, False]:
+            for cvValue in self._plannedCvValues(forward, dict(self.observations[forward])):
+                if cvValue not in cvValues:
+                    cvValues.append(cvValue)
+        remaining = {}
+        for forward in [True, False]:
+            remaining[forward] = [el for el in cvValues if el not in self.observations[forward]
+                                  and el not in self.unusable[forward]]
+        return remaining
+
+    """
+    returns: the CV values the planner would add to planned, which gets
+             them with the relative times of the speed curve
+    """
+    def _plannedCvValues(self, forward, planned):
+        added = []
+        # the planner doesn't ask for these again
+        for cvValue in self.unusable[forward]:
+            if cvValue not in planned:
+                planned[cvValue] = None
+        # the CV value being measured isn't in the observations yet
+        if self.current and self.current[0] == forward and self.current[1] not in planned:
+            planned[self.current[1]] = self._relativeTime(forward, self.current[1])
+            added.append(self.current[1])
+        cvValue = self.planner.nextCvValue(planned)
+        while cvValue is not None and cvValue not in planned and len(added) < 30:
+            planned[cvValue] = self._relativeTime(forward, cvValue)
+            added.append(cvValue)
+            cvValue = self.planner.nextCvValue(planned)
+        return added
+
+    """
+    returns: (intercept, slope) of log(relative time) vs. log(CV value -
+             vStart) for one direction, or None without any measurements
+    """
+    def _curve(self, forward):
+        for observations in [self.observations[forward], self.observations[not forward],
+                             self.history[forward], self.history[not forward]]:
+            if observations:
+                return self._fit(observations)
+        return None
+
+    def _fit(self, observations):
+        points = [(log(max(cv - self.vStart, 1)), log(observations[cv]))
+                  for cv in observations.keys()]
+        meanX = sum([el[0] for el in points]) / len(points)
+        meanY = sum([el[1] for el in points]) / len(points)
+        denominator = sum([(el[0] - meanX) ** 2 for el in points])
+        # with one point, assume time falls a bit faster than 1 / (cv - vStart),
+        # like CvGridPlanner does
+        slope = -1.5
+        if denominator > 0:
+            slope = sum([(el[0] - meanX) * (el[1] - meanY) for el in points]) / denominator
+        return meanY - slope * meanX, slope
+
+    def _relativeTime(self, forward, cvValue):
+        curve = self._curve(forward)
+        return exp(curve[0] + curve[1] * log(max(cvValue - self.vStart, 1)))
+
+    def _lapTimeAtTop(self):
+        if self.lapTimes:
+            return median([lapTime / self._relativeTime(True, cvValue)
+                           for cvValue, lapTime in self.lapTimes])
+        return self.topSpeedTimeSec * (self.sequenceLength or 1)
+
+    """
+    returns: (overhead seconds, laps) per CV value, least squares over the
+             CV values measured so far
+    """
+    def _cvValueCost(self, lapTimeAtTop):
+        points = [(lapTimeAtTop * self._relativeTime(forward, cvValue), seconds)
+                  for forward, cvValue, seconds in self.cvValueTimes]
+        if len(points) < 2:
+            if points:
+                lapTime, seconds = points[0]
+                return self.overheadSec, max(seconds - self.overheadSec, 0.0) / lapTime
+            return self.overheadSec, self.lapsPerCvValue
+        meanX = sum([el[0] for el in points]) / len(points)
+        meanY = sum([el[1] for el in points]) / len(points)
+        denominator = sum([(el[0] - meanX) ** 2 for el in points])
+        # measuring both directions at the first CV value gives two points
+        # with about the same lap time, which can't tell laps from overhead
+        if denominator <= 0 or max([el[0] for el in points]) < 1.2 * min([el[0] for el in points]):
+            return self.overheadSec, max(meanY - self.overheadSec, 0.0) / meanX
+        laps = sum([(el[0] - meanX) * (el[1] - meanY) for el in points]) / denominator
+        laps = max(laps, 0.1)
+        return max(meanY - laps * meanX, 0.0), laps
+
+    """
+    returns: one line with the remaining time and laps, e.g. for the GUI
+             status, or None if there's no estimate yet
+    """
+    def describe(self):
+        estimate = self.estimate()
+        if estimate is None:
+            return None
+        laps = estimate[True][0] + estimate[False][0]
+        seconds = estimate[True][1] + estimate[False][1]
+        return ("About " + _duration(seconds) + " left (" + str(int(round(laps))) +
+                " laps: " + _duration(estimate[True][1]) + " forward, " +
+                _duration(estimate[False][1]) + " reverse)")
+
+def _duration(seconds):
+    minutes = int(round(seconds / 60.0))
+    if minutes < 60:
+        return str(minutes) + " min"
+    return str(minutes // 60) + " h " + str(minutes % 60) + " min"
@@ -9,13 +9,20 @@ we use a locomotive set at a steady throttle setting to calibrate the
 length of each block, with the user supplying one measured block (in inches)
 to facilitate calculations in scale miles per hour.
 """
-import jmri
-import java
 import pickle
 import os
-from os.path import expanduser
-
-from Utils import RedirectStdErr
+from math import exp
+
+from Utils import RedirectStdErr, dataFolder, median
+from .BlockTimeSampler import CvValueSampler
+from .CvGridPlanner import CvGridPlanner, FixedCvGrid
+from .DetectionFilter import DetectionFilter
+from .EtaPredictor import EtaPredictor
+from .MeasurementJournal import MeasurementJournal
+from .PlateauTable import PlateauTable
+from .VisitScheduler import VisitScheduler
+from SpeedTableBuilder import BlockLengthSolver
+from FleetStore import FleetStore
 
 class LayoutBlocks:
     def __init__(self, speedMatchInstance, throttleInstance, data):
@@ -25,13 +32,38 @@ class LayoutBlocks:
         self.topSpeedTimeSecPerBlock = None
         self.timeSecPerBlockMeasurementsForward = None
         self.timeSecPerBlockMeasurementsReverse = None
-        foldername = (expanduser("~") + "\\.SpeedMatchLocoTables\\")
-        if not os.path.exists(foldername):
-            os.mkdir(foldername)
-        self.filename = ( foldername
-                        + str(self.data["DCC Address"])
-                        + str(self.data["Filename Suffix"])
-                        + ".mbt" )
+        # sensor that ended each block, as seen while driving each direction
+        self.nextSensorForward = {}
+        self.nextSensorReverse = {}
+        # forward (True / False) : {sensor : length in inches}, for blocks
+        # whose length is known well enough to use them as speed samples
+        self.knownBlockLengths = {True : {}, False : {}}
+        self.poolBlocks = False
+        # carrying on with an interrupted run, see measureBlockTimes
+        self.resuming = False
+        # CV value the warm-up laps were driven at, see _warmUp
+        self.warmUpCvValue = None
+        # checks the sensor activations, see measureBlockTimes
+        self.detectionFilter = None
+        # predicts the time left, see measureBlockTimes
+        self.etaPredictor = None
+        # speed table of CV values on plateaus, see _programPlateauTable
+        self.plateauTable = None
+        # CV values of the fixed grid, in the order they'll be measured
+        self.plannedCvValues = []
+        # (forward, CV value) the locomotive was last driven at, see _driveAt
+        self.drivingAt = (True, None)
+        # sensors the detection filter quarantined during the run
+        self.quarantinedSensors = []
+        # sensors around the loop that were watched, without the quarantined ones
+        self.sensorSequence = []
+        basename = os.path.join(dataFolder(),
+                                str(self.data["DCC Address"])
+                                + str(self.data["Filename Suffix"]))
+        # measurements saved by earlier versions, all at once at the end.
+        # Saved measurements now go to the FleetStore.
+        self.filename = basename + ".mbt"
+        self.journal = MeasurementJournal(basename + ".mbj")
 
 
 
@@ -71,82 +103,275 @@ class LayoutBlocks:
     the blocks are different (i.e. on your railroad mainline) and therefore
     the speed of the engine changes due to hills, curves, etc.
 
+    How many samples each CV value gets is decided as we go (see
+    BlockTimeSampler), and so are the CV values themselves (see
+    CvGridPlanner, or FixedCvGrid without adaptiveGrid or with plateauWidth).
+    With poolBlocks, the other blocks of the loop count as samples too, once
+    their lengths are known to within maximumLengthError (see
+    _updateBlockLengths).
+
     One can optionall save to or load from disk, as this method is what takes
     most of the time in the SpeedMatch routine, waiting for the train to run
-    around in circles.
+    around in circles. Every sample goes to the measurement journal as it's
+    taken, so an interrupted run can be resumed (see _measureBlockTime), and
+    the finished run goes to the FleetStore.
+
+    The other options: scopeSensors (see _scopeSensors), warmUpMinutes (see
+    _warmUp), plateauWidth (see _programPlateauTable) and interleave (see
+    _measureInterleaved).
     """
-    def measureBlockTimes(self, minimumSamples=2, saveToFile=True):
+    def measureBlockTimes(self, minimumSamples=2, maximumSamples=8,
+                          relativeTolerance=0.02, adaptiveGrid=True,
+                          saveToFile=True, poolBlocks=True, maximumLengthError=0.01,
+                          scopeSensors=True, warmUpMinutes=None, warmUpTolerance=0.001,
+                          plateauWidth=None, interleave=True):
         if self.data["Load Measurements"]:
             self._loadBlockTimes()
             return
 
-        unscaledCvValuesToMeasure = [16, 32, 56, 80, 112, 144, 176, 208, 240, 255]
-        # account for vStart
+        self.resuming = False
+        if self.data.get("Resume Measurements"):
+            self.resuming = self.journal.resume(self._journalHeader())
+            if not self.resuming:
+                print("No measurement journal to resume at: " + self.journal.filename)
+        if not self.resuming:
+            self.journal.start(self._journalHeader())
+
         vStart = int(self.data["vStart"])
-        cvValuesToMeasure = [vStart + int( el * (255 - vStart) / 255.0 )
-                             for el in unscaledCvValuesToMeasure]
-        print("Measuring table cv speed settings: " + str(cvValuesToMeasure))
+        # CV values on a plateau table have to be known before measuring
+        if adaptiveGrid and not plateauWidth:
+            planner = CvGridPlanner(vStart)
+        else:
+            planner = FixedCvGrid(vStart)
+            print("Measuring table cv speed settings: " + str(planner.cvValuesToMeasure))
 
         self.timeSecPerBlockMeasurementsForward = {}
         self.timeSecPerBlockMeasurementsReverse = {}
 
-        # Forward
-        measuredCvSpeedValuesForward = []
-        for cvValue in cvValuesToMeasure:
-            measuredCvSpeedValuesForward.append(cvValue)
-            maxSpeedFlag = self._measureBlockTime(forward=True,
-                                                  cvValue=cvValue,
-                                                  minimumSamples=minimumSamples)
-            if maxSpeedFlag:
-                break
-
-        # Reverse
-        measuredCvSpeedValuesReverse = []
-        for cvValue in cvValuesToMeasure:
-            measuredCvSpeedValuesReverse.append(cvValue)
-            maxSpeedFlag = self._measureBlockTime(forward=False,
-                                                  cvValue=cvValue,
-                                                  minimumSamples=minimumSamples)
-            if maxSpeedFlag:
-                break
+        self.poolBlocks = poolBlocks
+        self.maximumLengthError = maximumLengthError
+        if poolBlocks:
+            self._loadKnownBlockLengths()
+
+        # with block lengths from the layout profile, every block is a
+        # sample and a CV value usually takes less than a lap
+        lapsPerCvValue = minimumSamples
+        if len(self.knownBlockLengths[True]) > len(self.data["Measured Block Sensors"]):
+            lapsPerCvValue = 0.5
+        measuredSensor = self.data["Measured Block Sensors"][0]
+        self.etaPredictor = EtaPredictor(planner, vStart, self.topSpeedTimeSecPerBlock[measuredSensor],
+                                         lapsPerCvValue=lapsPerCvValue,
+                                         clock=self.throttle.profiler.clock,
+                                         interleaved=interleave)
+        self._predictFromHistory(measuredSensor)
+        measuredSensors = list(self.topSpeedTimeSecPerBlock.keys())
+        def newSampler(forward):
+            blockLengths = None
+            if poolBlocks:
+                blockLengths = self.knownBlockLengths[forward]
+            return CvValueSampler(measuredSensors, minimumSamples,
+                                  maximumSamples, relativeTolerance,
+                                  blockLengths=blockLengths)
+
+        # about half of full speed, for finding the loop and warming up
+        cruiseCvValue = vStart + (255 - vStart) // 2
+        self.plateauTable = None
+        if plateauWidth:
+            self.plateauTable = PlateauTable(plateauWidth)
+            self.plannedCvValues = planner.cvValuesToMeasure
+            self._programPlateauTable(self.plannedCvValues[0])
+            # one of the grid, so it's usually on the table
+            cruiseCvValue = min(self.plannedCvValues,
+                                key=lambda el: abs(el - cruiseCvValue))
+        self.detectionFilter = DetectionFilter(self.data["Sensor Monitor"])
+        self.data["Sensor Monitor"].start()
+        try:
+            if scopeSensors:
+                self._scopeSensors(cruiseCvValue)
+            if warmUpMinutes:
+                self.warmUpCvValue = cruiseCvValue
+                for forward in [True, False]:
+                    self.throttle.profiler.begin("Warm-up laps " + ('Fwd' if forward else 'Rev'))
+                    self._warmUp(forward, self.warmUpCvValue, warmUpMinutes / 2.0,
+                                 warmUpTolerance)
+                    self.throttle.profiler.end()
+            if interleave:
+                self._measureInterleaved(planner, newSampler)
+            else:
+                self._measureBothDirections(planner, newSampler)
+            # the journal already holds everything - mark it complete
+            self.journal.finish()
+        finally:
+            self.data["Sensor Monitor"].stop()
+            self.journal.close()
+            self._reportDetection()
 
-        # Either forward or reverse might be missing some CVs, if the
-        # maxSpeedFlag breaks at different measurement CVs (which is common).
-        # Let's populate anything that's missing. Having the same set of
-        # CV measurement values is important for table creation later.
-        missingForward = [el for el in measuredCvSpeedValuesReverse
-                          if el not in measuredCvSpeedValuesForward]
-        for cvValue in missingForward:
-            self._measureBlockTime(forward=True,
-                                   cvValue=cvValue,
-                                   minimumSamples=minimumSamples)
+        if self.data["Save Measurements"]:
+            store = FleetStore()
+            run = store.addRun(self.data,
+                               self.timeSecPerBlockMeasurementsForward,
+                               self.timeSecPerBlockMeasurementsReverse,
+                               self.nextSensorForward, self.nextSensorReverse,
+                               self.data.get("Layout Profile"))
+            print("Time measurements stored as run " + str(run) +
+                  " in the fleet store at: " + store.folder)
+        os.remove(self.journal.filename)
 
-        missingReverse = [el for el in measuredCvSpeedValuesForward
-                          if el not in measuredCvSpeedValuesReverse]
-        for cvValue in missingReverse:
-            self._measureBlockTime(forward=False,
-                                   cvValue=cvValue,
-                                   minimumSamples=minimumSamples)
+        # stop the locomotive
+        self.throttle.driveCv(cvValue=0, forward=True)
 
+        return
 
+    """
+    measures all of forward first, then all of reverse, each on its own
+    grid of CV values. Used without interleave.
+    """
+    def _measureBothDirections(self, planner, newSampler):
+        # relative block times at each CV value, see CvGridPlanner
+        observationsForward = {}
+        observationsReverse = {}
 
+        # the warm-up laps already measured this one
+        if self.warmUpCvValue is not None:
+            observationsForward[self.warmUpCvValue] = self._measureBlockTime(
+                forward=True, cvValue=self.warmUpCvValue, sampler=newSampler(True))
 
-        # save the table to disk
-        if self.data["Save Measurements"]:
-            self._saveBlockTimes()
+        # Forward
+        cvValue = planner.nextCvValue(observationsForward)
+        while cvValue is not None:
+            observationsForward[cvValue] = self._measureBlockTime(
+                                           forward=True, cvValue=cvValue,
+                                           sampler=newSampler(True))
+            cvValue = planner.nextCvValue(observationsForward)
+
+        # Reverse - start with the forward CV values, then let the planner
+        # add more if reverse is slower or its curve bends differently
+        for cvValue in sorted(observationsForward.keys()):
+            observationsReverse[cvValue] = self._measureBlockTime(
+                                           forward=False, cvValue=cvValue,
+                                           sampler=newSampler(False))
+        cvValue = planner.nextCvValue(observationsReverse)
+        while cvValue is not None:
+            observationsReverse[cvValue] = self._measureBlockTime(
+                                           forward=False, cvValue=cvValue,
+                                           sampler=newSampler(False))
+            cvValue = planner.nextCvValue(observationsReverse)
+
+        # Reverse might have added CV values that forward is missing.
+        # Let's populate anything that's missing. Having the same set of
+        # CV measurement values is important for table creation later.
+        missingForward = [el for el in sorted(observationsReverse.keys())
+                          if el not in observationsForward]
+        for cvValue in missingForward:
+            observationsForward[cvValue] = self._measureBlockTime(
+                                           forward=True, cvValue=cvValue,
+                                           sampler=newSampler(True))
 
-        # stop the locomotive
-        self.throttle.driveCv(cvValue=0, forward=True)
+        self._checkUsable(True, observationsForward)
+        self._checkUsable(False, observationsReverse)
+        print("Measured table cv speed settings: " + str(sorted(observationsForward.keys())))
+        return
 
+    """
+    measures forward and reverse back to back at each CV value, so that
+    it's programmed once instead of once per direction.
+
+    The planner picks the next CV value for each direction from that
+    direction's measurements, and both directions are measured at all of
+    them. That way forward and reverse end up with the same CV values
+    without going back for the missing ones, and the VisitScheduler can
+    order each round's visits so that every CV value is programmed once
+    and the locomotive turns around as little as it can.
+    """
+    def _measureInterleaved(self, planner, newSampler):
+        # relative block times at each CV value, see CvGridPlanner
+        observations = {True : {}, False : {}}
+        scheduler = self._visitScheduler()
+        planPrinted = False
+
+        # the warm-up laps already measured this one
+        cvValues = []
+        if self.warmUpCvValue is not None:
+            cvValues.append(self.warmUpCvValue)
+        while True:
+            for forward in [True, False]:
+                cvValue = planner.nextCvValue(observations[forward])
+                if cvValue is not None and cvValue not in observations[forward] \
+                        and cvValue not in cvValues:
+                    cvValues.append(cvValue)
+            if not cvValues:
+                break
+            if not planPrinted:
+                planPrinted = self._printVisitPlan(scheduler)
+
+            for forward, cvValue in scheduler.plan(cvValues, self.drivingAt):
+                if cvValue not in observations[forward]:
+                    observations[forward][cvValue] = self._measureBlockTime(
+                        forward=forward, cvValue=cvValue, sampler=newSampler(forward))
+            cvValues = []
+
+        self._checkUsable(True, observations[True])
+        self._checkUsable(False, observations[False])
+        print("Measured table cv speed settings: " + str(sorted(observations[True].keys())))
         return
 
+    """
+    raises an exception if no CV value measured in this direction gave a
+    usable block time (see _finishCvValue), as there's no table to build
+    """
+    def _checkUsable(self, forward, observations):
+        if [el for el in observations.values() if el is not None]:
+            return
+        raise Exception("No usable block times measured " +
+                        ('forward' if forward else 'in reverse') + " at CV values " +
+                        str(sorted(observations.keys())) + ". Check the detectors of the " +
+                        "measured blocks: " + ", ".join(self.data["Measured Block Sensors"]))
+
+    """
+    returns: a VisitScheduler costing CV writes at the mean write time
+             seen with this command station and decoder, if we know it
+    """
+    def _visitScheduler(self):
+        queue = self.throttle.programmingQueue
+        writeSec = queue.latency.meanLatency(queue.latencyKey)
+        if writeSec is None:
+            return VisitScheduler()
+        return VisitScheduler(writeSec=writeSec)
 
-    def _measureBlockTime(self, forward, cvValue, minimumSamples):
-        self.throttle.driveCv(cvValue, forward=forward, speedTableStep=14)
-        self.speedMatchInstance.waitMsec(300) # wait for momentum #TODO make 3000
+    """
+    prints the order the CV values the EtaPredictor expects would be
+    visited in, and what that saves over measuring forward, then reverse
 
+    returns: False if there's nothing to predict the CV values from yet
+    """
+    def _printVisitPlan(self, scheduler):
+        cvValues = sorted(set([el[1] for el in self.etaPredictor.upcomingCvValues()]))
+        if not cvValues:
+            return False
+        visits = scheduler.plan(cvValues, self.drivingAt)
+        sequential = scheduler.sequentialPlan(cvValues, self.drivingAt[0])
+        print("Visit plan for the expected CV values: " + scheduler.describe(visits) +
+              ". About " + str(int(round(scheduler.cost(visits, self.drivingAt)))) +
+              " seconds programming and turning around, instead of " +
+              str(int(round(scheduler.cost(sequential, self.drivingAt)))) +
+              " measuring forward, then reverse")
+        return True
+
+    """
+    measures the block times at one CV value in one direction. The samples
+    already in the journal - from the warm-up laps, or from before the run
+    was interrupted and resumed with "Resume Measurements" - count first.
+    A CV value the journal has as finished is only replayed, not driven
+    again.
+
+    returns: the measured block time relative to the block time at the
+             maximum speed, averaged over the measured blocks. Below 1.0
+             means the locomotive is faster than the maximum speed.
+    """
+    def _measureBlockTime(self, forward, cvValue, sampler):
+        self.throttle.profiler.begin("CV value", forward, cvValue)
+        self.etaPredictor.beginCvValue(forward, cvValue)
         # do the measuring
-        maxSpeedFlag = False
         measurements = {}
 
         def addMeasurement(sensor, time):
@@ -156,42 +381,72 @@ class LayoutBlocks:
                 measurements[sensor].append(time)
             return
 
-        # drive around by modifying speed table cv's
-        # FYI: This adds some time delay to program the CVs,
-        # so make sure it's not in the while loop
-        self.throttle.driveCv(cvValue=cvValue, forward=forward)
+        nextSensor = self.nextSensorForward if forward else self.nextSensorReverse
+
+        # samples from the warm-up laps, or from before an interruption
+        journalSamples = self.journal.getSamples(forward, cvValue)
+        for sensor, following, timeSec in journalSamples:
+            nextSensor[sensor] = following
+            addMeasurement(sensor, timeSec)
+            sampler.addSample(sensor, timeSec)
+        if journalSamples:
+            print("Speed-" + ('Fwd' if forward else 'Rev') + " " + str(cvValue) +
+                  ". " + str(len(journalSamples)) + " samples from the journal.")
+        else:
+            self.journal.beginCvValue(forward, cvValue)
+
+        if not ( self.journal.isCvValueComplete(forward, cvValue) or
+                 sampler.isComplete() ):
+            self._sampleBlockTimes(forward, cvValue, sampler, addMeasurement,
+                                   measurements, nextSensor)
+        if not self.journal.isCvValueComplete(forward, cvValue):
+            self.journal.endCvValue(forward, cvValue)
+
+        result = self._finishCvValue(forward, cvValue, sampler, measurements)
+        self.etaPredictor.endCvValue(forward, cvValue, result)
+        self.throttle.profiler.end()
+        return result
 
-        newTime = 0
+    """
+    drives at one CV value and adds block time samples until the sampler
+    says the CV value is done
+    """
+    def _sampleBlockTimes(self, forward, cvValue, sampler, addMeasurement,
+                          measurements, nextSensor):
+        self._driveAt(forward, cvValue)
+
+        newTime = None
         newSensor = None
         while True:
-            # wait for sensor changes and measure time
+            # wait for sensor changes. The time is stamped when the
+            # sensor activates, not when we get around to reading it
             oldSensor = newSensor
-            newSensor = self._waitForBlockSensor()
-
-            # update times and add measurement
             oldTime = newTime
-            newTime = java.lang.System.currentTimeMillis()
+            newSensor, newTime = self._waitForBlockSensor(forward)
 
-            if oldSensor and not (oldTime == 0):
-                # stop if we have collected enough samples
-                if oldSensor in measurements.keys():
-                    samplesThisSensor = len(measurements[oldSensor]) + 1
-                    if samplesThisSensor > minimumSamples:
-                        break
-                else:
-                    samplesThisSensor = 1
+            if oldSensor and self.detectionFilter.isExpectedBlock(forward, oldSensor, newSensor):
+                nextSensor[oldSensor] = newSensor
 
                 # add the new sample
-                timeSec = (newTime - oldTime) * 1.0/1000.0
+                timeSec = newTime - oldTime
                 addMeasurement(oldSensor, timeSec)
+                self.journal.addSample(forward, cvValue, oldSensor, newSensor, timeSec)
+                accepted = sampler.addSample(oldSensor, timeSec)
+                lap = oldSensor == self.data["Measured Block Sensors"][0]
+                self.throttle.profiler.countSample(lap=lap)
+                self.etaPredictor.addSample(forward, cvValue, newTime, lap)
+                eta = self.etaPredictor.describe()
                 dirString = 'Fwd' if forward else 'Rev'
                 print("Speed-" + dirString + " " + str(cvValue) +
                       ". Adding " + str(oldSensor) + " / " + str(timeSec) +
-                      ". Block has " + str(samplesThisSensor) + " samples.")
+                      ("" if accepted else " (outlier)") +
+                      ". Block has " + str(len(measurements[oldSensor])) + " samples." +
+                      (" " + eta + "." if eta else ""))
+                if eta:
+                    self._showStatus("Speed-" + dirString + " " + str(cvValue) + ". " + eta)
 
-                # only if this is a measured block - check speed constraints
+                # only if this is a measured block - print out the current speed
                 if oldSensor in self.topSpeedTimeSecPerBlock.keys():
-                    # print out the current speed
                     measuredSpeed = ( self.data["Maximum Speed"] *
                                     self.topSpeedTimeSecPerBlock[oldSensor] *
                                     1.0 / timeSec )
@@ -199,81 +454,502 @@ class LayoutBlocks:
                           ". Sensor: " + str(oldSensor) + ". " +
                           "Current measured speed: " + str(measuredSpeed) + " smph.")
 
-                    # fast enough - stop checking higher speeds
-                    if self.topSpeedTimeSecPerBlock[oldSensor] > timeSec:
-                        maxSpeedFlag = True
-
-                    # engine can't go fast enough - throw exception
-                    # Note: quite often, an engine goes almost fast enough,
-                    # at which point we want to keep the calibration speed
-                    # and let the CV value "clip" at 255 towards the top
-                    # of the table. Therefore, this is a warning, not an
-                    # exception.
-                    if cvValue > 253:
-                        if self.topSpeedTimeSecPerBlock[oldSensor] < timeSec:
-                            print("Time this block: " + str(timeSec))
-                            print("Required time at desired SMPH: " + str(self.topSpeedTimeSecPerBlock[oldSensor]))
-                            print("WARNING: Measured maximum SMPH:" + str(measuredSpeed))
-                            # stop the locomotive
-                            #self.throttle.driveCv(cvValue=0, forward=True)
-                            #raise Exception("Locomotive cannot reach top speed in smph at full voltage. Try a lower smph calibration speed.")
+                # stop if the measured blocks are known well enough
+                if sampler.isComplete():
+                    break
+        return
+
+    """
+    gets the locomotive going at one CV value and forgets the sensor
+    activations from before it got there
+    """
+    def _driveAt(self, forward, cvValue):
+        step = None
+        if self.plateauTable is not None:
+            step = self.plateauTable.stepFor(cvValue)
+            if step is None:
+                step = self._programPlateauTable(cvValue)
+        if step is not None:
+            self.throttle.driveStep(step, forward=forward)
+        else:
+            if self.plateauTable is not None:
+                # driveCv overwrites the middle plateau
+                self.plateauTable.setCvValues([])
+            self.throttle.driveCv(cvValue, forward=forward, speedTableStep=14)
+            self.throttle.settle(300) # wait for momentum #TODO make 3000
+
+            # drive around by modifying speed table cv's
+            # FYI: This adds some time delay to program the CVs,
+            # so make sure it's not in the while loop
+            self.throttle.driveCv(cvValue=cvValue, forward=forward)
+        self.drivingAt = (forward, cvValue)
 
+        # drop activations from before the locomotive was at this speed
+        self.detectionFilter.restart()
 
-        if forward:
-            self.timeSecPerBlockMeasurementsForward[cvValue] = measurements
+    """
+    puts cvValue and the planned CV values after it on a plateau table (see
+    PlateauTable) and programs it, so that measuring them takes no more CV
+    writes - _driveAt only changes the throttle step between them. The
+    first table is programmed before measuring starts, with the fixed grid
+    from the bottom. With 3 steps per plateau, it holds all but the top CV
+    value, so a second table is only needed for a slow locomotive. Only the
+    steps that change are written. plateauWidth in measureBlockTimes is the
+    number of steps of each plateau.
+
+    returns: the throttle step for cvValue, or None if it's the only CV
+             value left - Throttle.driveCv programs a single one with fewer
+             writes
+    """
+    def _programPlateauTable(self, cvValue):
+        cvValues = [cvValue]
+        if cvValue in self.plannedCvValues:
+            cvValues += self.plannedCvValues[self.plannedCvValues.index(cvValue) + 1:]
+        if len(cvValues) < 2:
+            return None
+        self.plateauTable.setCvValues(cvValues)
+        print("Plateau speed table with CV values " + str(self.plateauTable.cvValues))
+        # the live driver, kept out of the import so Core doesn't load it
+        from Throttle import Program
+        Program(self.speedMatchInstance, self.throttle).programSpeedTable(
+            self.plateauTable.table())
+        return self.plateauTable.stepFor(cvValue)
+
+    """
+    Finds the sensors around the loop, in the order a locomotive driving
+    forward passes them, and watches only those from now on. The layout
+    profile knows them from earlier calibrations; otherwise we drive a lap
+    to find out (see _discoverSequence). A few dozen sensors are watched
+    instead of every sensor on the layout, and a train or a bad detector
+    elsewhere can't get into the block times.
+
+    The sequence also predicts which sensor ends each block, in either
+    direction. Block times that don't end at the next sensor are dropped,
+    chattering detectors are debounced, and sensors that keep firing out of
+    order or not at all are quarantined for the rest of the run instead of
+    stopping it (see DetectionFilter). _reportDetection prints what was
+    dropped at the end.
+    """
+    def _scopeSensors(self, cvValue):
+        monitoredSensors = list(self.data["JMRI Sensors"].keys())
+        sequence = []
+        layoutProfile = self.data.get("Layout Profile")
+        if layoutProfile:
+            sequence = [el for el in layoutProfile.getSequence() if el in monitoredSensors]
+        missing = [el for el in self.data["Measured Block Sensors"] if el not in sequence]
+        if len(sequence) < 3 or missing:
+            self.throttle.profiler.begin("Finding the loop")
+            sequence = self._discoverSequence(cvValue)
+            self.throttle.profiler.end()
         else:
-            self.timeSecPerBlockMeasurementsReverse[cvValue] = measurements
+            print("Sensor sequence from the layout profile")
 
-        return maxSpeedFlag
+        self.detectionFilter.setSequence(sequence, self.data["Measured Block Sensors"])
+        self.etaPredictor.setSequenceLength(len(sequence))
+        print("Watching " + str(len(sequence)) + " of " + str(len(monitoredSensors)) +
+              " sensors: " + ", ".join(sequence))
 
     """
-    returns name of the new sensor that became active
+    drives two laps forward, each from a measured block sensor back to it,
+    and returns the sensors around the loop in order, starting there.
+
+    A sensor elsewhere on the layout may go active during a lap, but not
+    at the same point of both laps, except by a rare coincidence. So the
+    sequence is the sensors that went active in both laps at the same
+    fraction of the lap, to within tolerance. A lap shorter than
+    minimumSensors is taken for the detector flickering on and off.
     """
-    def _waitForBlockSensor(self):
-        numChangedSensors = 0
-        oldSensorStatus = self._pollActiveSensors()
+    def _discoverSequence(self, cvValue, minimumSensors=3, tolerance=0.02,
+                          maximumMinutes=15):
+        print("Driving two laps to find the sensors around the loop")
+        self._driveAt(True, cvValue)
+        measuredSensors = self.data["Measured Block Sensors"]
+        startTime = None
+        # (sensor, activation time) of each lap, from its start to the
+        # start of the next one
+        laps = [[]]
+        while len(laps) < 3:
+            try:
+                sensor, timeSec = self._waitForBlockSensor(True, maximumMinutes * 60)
+            except Exception:
+                # no sensor went active at all - don't leave the
+                # locomotive running
+                self.throttle.driveCv(cvValue=0, forward=True)
+                raise
+            if startTime is None:
+                startTime = timeSec
+            elif timeSec - startTime > maximumMinutes * 60:
+                self.throttle.driveCv(cvValue=0, forward=True)
+                raise Exception("Measured block sensor(s) " + ", ".join(measuredSensors) +
+                                " didn't come around twice in " + str(maximumMinutes) +
+                                " minutes. Are they on the loop?")
+            if not laps[-1]:
+                # waiting for the start of the first lap
+                if sensor in measuredSensors:
+                    laps[-1].append((sensor, timeSec))
+                continue
+            laps[-1].append((sensor, timeSec))
+            if sensor == laps[-1][0][0] and len(laps[-1]) > minimumSensors:
+                laps.append([(sensor, timeSec)])
+
+        # the fraction of the lap each activation happened at
+        fractions = []
+        for lap in laps[:2]:
+            lapTime = lap[-1][1] - lap[0][1]
+            fractions.append([(sensor, (timeSec - lap[0][1]) / lapTime)
+                              for sensor, timeSec in lap[:-1]])
+        sequence = []
+        for sensor, fraction in fractions[0]:
+            if sensor in sequence:
+                continue
+            if [el for el in fractions[1]
+                if el[0] == sensor and abs(el[1] - fraction) <= tolerance]:
+                sequence.append(sensor)
+
+        missing = [el for el in measuredSensors if el not in sequence]
+        if missing:
+            self.throttle.driveCv(cvValue=0, forward=True)
+            raise Exception("Measured block sensor(s) " + ", ".join(missing) +
+                            " didn't go active in two laps around the loop. Sensors seen: " +
+                            ", ".join(sequence))
+        return sequence
+
+    """
+    prints what the detection filter dropped and quarantined during the run
+    """
+    def _reportDetection(self):
+        self.quarantinedSensors = self.detectionFilter.getQuarantinedSensors()
+        self.sensorSequence = self.detectionFilter.getSequence()
+        lines = self.detectionFilter.report()
+        if not lines:
+            return
+        print("Detector report:")
+        for line in lines:
+            print("    " + line)
+        if self.quarantinedSensors:
+            print("Quarantined sensors: " + ", ".join(self.quarantinedSensors) +
+                  ". Check their detectors, or add them to ignoredSensors in SpeedMatch.py.")
 
-        # JMRI fires a sensor change on either going active or non-active.
-        # We only want the active ones, hence this loop.
-        while numChangedSensors == 0:
-            self.speedMatchInstance.waitChange(self.data["JMRI Sensors"].values())
-            newSensorStatus = self._pollActiveSensors()
+    """
+    Drives laps at one CV value until the locomotive is warmed up: until
+    the last lap took less than tolerance (a fraction) longer than a lap of
+    the warm locomotive, or maximumMinutes have gone by. A cold motor and
+    cold lubricant make a locomotive run slower at first.
+
+    We don't wait for whole laps to compare them. After the first lap,
+    every sensor activation gives the time of the lap that just ended at
+    that sensor. The same sensor starts and ends each lap, so detector
+    latencies cancel. Only activations that end a block the detection
+    filter expected count, for lap times as well as block times, and a lap
+    time more than stallTolerance off the median of the last recentLapTimes
+    is dropped: a flaky detector or a stall would otherwise pass for a lap.
+    Warming up slows down as the locomotive gets close to warm, so a small
+    change from one lap to the next doesn't mean it's nearly done - a slow
+    warm-up can still have more to go than it changes per lap. Instead, we fit the lap times as they decay towards the warm
+    lap time (see _warmUpExcess), and stop once the last lap is close
+    enough to it. An engine that's already warm is done after about a lap
+    and a half.
+
+    The block times of the last lap are kept in the journal as samples of
+    this CV value, so the warm-up counts towards the measurements. If the
+    locomotive didn't get warm within maximumMinutes, they aren't: they'd
+    make this CV value slower than the others. It's measured afresh then.
+
+    measureBlockTimes warms up at about half of full speed, in each
+    direction, for at most half of warmUpMinutes each.
+    """
+    def _warmUp(self, forward, cvValue, maximumMinutes, tolerance, minimumLapTimes=4,
+                stallTolerance=0.05, recentLapTimes=5):
+        dirString = 'Fwd' if forward else 'Rev'
+        self._driveAt(forward, cvValue)
+        oldSensor, oldTime = self._waitForBlockSensor(forward)
+        # whether the last activation ended a block the way the detection
+        # filter expected. Only then is it the locomotive passing the sensor.
+        oldExpected = False
+        startTime = oldTime
+        # when each sensor last ended a block that was driven as expected
+        lastSeen = {}
+        # (activation time, lap time ending then)
+        lapTimes = []
+        # every lap time, including the ones that were dropped
+        candidates = []
+        # (sensor, next sensor, block time, activation time ending the block)
+        samples = []
+        excess = None
+        settled = False
+        while True:
+            newSensor, newTime = self._waitForBlockSensor(forward)
+            expected = self.detectionFilter.isExpectedBlock(forward, oldSensor, newSensor)
+            if expected and oldExpected:
+                samples.append((oldSensor, newSensor, newTime - oldTime, newTime))
+                lap = oldSensor == self.data["Measured Block Sensors"][0]
+                self.throttle.profiler.countSample(lap=lap)
+                self.etaPredictor.addSample(forward, cvValue, newTime, lap)
+            if expected:
+                if newSensor in lastSeen:
+                    lapTime = newTime - lastSeen[newSensor]
+                    candidates.append(lapTime)
+                    # lap times change slowly while warming up, so one well
+                    # off the ones just before had a stall or a bad
+                    # activation in it
+                    recent = median(candidates[-recentLapTimes:])
+                    if len(candidates) >= 3 and abs(lapTime - recent) <= recent * stallTolerance:
+                        lapTimes.append((newTime, lapTime))
+                lastSeen[newSensor] = newTime
+            else:
+                # a flaky detector or a missed activation - a lap timed
+                # from here would be too short or too long
+                lastSeen.pop(newSensor, None)
+            oldSensor, oldTime, oldExpected = newSensor, newTime, expected
+
+            if lapTimes and newTime - lapTimes[0][0] >= lapTimes[-1][1] / 2 and \
+                    len(lapTimes) >= minimumLapTimes:
+                excess = self._warmUpExcess(lapTimes)
+                if excess <= tolerance:
+                    settled = True
+                    break
+            if newTime - startTime >= maximumMinutes * 60:
+                print("WARNING: Warm-up-" + dirString + " lap times didn't settle within " +
+                      str(maximumMinutes) + " minutes")
+                break
+
+        if lapTimes:
+            message = "Warm-up-" + dirString + " done after " + \
+                      str(round((oldTime - startTime) / 60.0, 1)) + " minutes. Lap time " + \
+                      str(round(lapTimes[-1][1], 2)) + " seconds"
+            if excess is not None:
+                message += ", " + str(round(100.0 * excess, 2)) + "% slower than when warm"
+            print(message)
+        if self.journal.getSamples(forward, cvValue) or not lapTimes or not settled:
+            # already measured before an interruption, not even one lap, or
+            # the locomotive is still warming up
+            return
+        self.journal.beginCvValue(forward, cvValue)
+        lastLap = {}
+        for sensor, following, timeSec, endTime in samples:
+            # likewise for a block time - it would spoil the block lengths
+            stalled = timeSec > lastLap.get(sensor, timeSec) * (1.0 + stallTolerance)
+            if endTime > oldTime - lapTimes[-1][1] and not stalled:
+                self.journal.addSample(forward, cvValue, sensor, following, timeSec)
+            lastLap[sensor] = timeSec
 
-            recentlyActivatedSensors = []
-            for sensor in oldSensorStatus.keys():
-                if (oldSensorStatus[sensor] == True) and (newSensorStatus[sensor] == False):
-                    continue
-                if (oldSensorStatus[sensor] == False) and (newSensorStatus[sensor] == True):
-                    recentlyActivatedSensors.append(sensor)
+    """
+    prints how long measuring took the locomotive's last run, predicted for
+    this run's settings, and has the EtaPredictor start out from its speed
+    curve
+    """
+    def _predictFromHistory(self, measuredSensor):
+        store = FleetStore()
+        record = store.latestRun(self.data["DCC Address"], self.data["Filename Suffix"])
+        if record is None:
+            return
+        run = record["Run"]
+        self.etaPredictor.useHistory(store.loadMeasurements(run, True),
+                                     store.loadMeasurements(run, False), measuredSensor)
+        layoutProfile = self.data.get("Layout Profile")
+        if layoutProfile and layoutProfile.getSequence():
+            self.etaPredictor.setSequenceLength(len(layoutProfile.getSequence()))
+        eta = self.etaPredictor.describe()
+        if eta:
+            print("Estimate from run " + str(run) + " of this locomotive. " + eta +
+                  ", plus the warm-up")
+            self._showStatus("Measuring. " + eta)
 
-            numChangedSensors = len(recentlyActivatedSensors)
+    """
+    shows text in the GUI status line, if there's a GUI
+    """
+    def _showStatus(self, text):
+        gui = self.data.get("GUI")
+        if gui is None:
+            return
+        if self.data.get("Session"):
+            text = self.data["Session"] + ": " + text
+        gui.updateStatus(text)
 
+    """
+    fits lapTime = a + b * exp(-t / tau) to the rolling lap times of the
+    warm-up, where a is the lap time of the warm locomotive, for time
+    constants tau from half a minute up to maximumTauSec
 
-        if not numChangedSensors == 1:
-            print("oldSensorStatus: ", oldSensorStatus)
-            print("newSensorStatus: ", newSensorStatus)
-            print("recentlyActivatedSensors: ", str(recentlyActivatedSensors))
-            raise Exception("More than one sensor changed state. Try ignoring broken sensors. Changed blocks include: ", str(recentlyActivatedSensors))
+    Over a lap or two, a fast decay that's nearly done and a slow one that
+    has a long way to go fit about equally well. So we don't trust the
+    best fit alone, but take the most warming up left of all the time
+    constants that fit nearly as well: within twice the best squared error,
+    plus lap time noise of noiseFraction.
 
+    lapTimes: list of (activation time, lap time ending then)
 
-        newSensor = recentlyActivatedSensors[0]
-        return newSensor
+    returns: how much longer (a fraction) the last lap took than a
+    """
+    def _warmUpExcess(self, lapTimes, maximumTauSec=600.0, noiseFraction=0.0001):
+        startTime = lapTimes[0][0]
+        lastTime = lapTimes[-1][0] - startTime
+        ys = [el[1] for el in lapTimes]
+        meanY = sum(ys) / len(ys)
+        # (squared error, excess of the last lap)
+        fits = []
+        tauSec = 30.0
+        while tauSec <= maximumTauSec:
+            xs = [exp(-(el[0] - startTime) / tauSec) for el in lapTimes]
+            meanX = sum(xs) / len(xs)
+            denominator = sum([(x - meanX) ** 2 for x in xs])
+            if denominator > 0:
+                b = sum([(xs[i] - meanX) * (ys[i] - meanY) for i in range(len(xs))]) / denominator
+                a = meanY - b * meanX
+                error = sum([(ys[i] - a - b * xs[i]) ** 2 for i in range(len(xs))])
+                # b <= 0 isn't getting any faster
+                fits.append((error, max(b, 0.0) * exp(-lastTime / tauSec) / a))
+            tauSec *= 1.25
+        if not fits:
+            return 0.0
+        bestError = min([el[0] for el in fits])
+        noise = len(ys) * (noiseFraction * meanY) ** 2
+        return max([excess for error, excess in fits if error <= 2 * bestError + noise])
 
     """
-    polls the jmri sensors to see which one are active
+    files the samples of one CV value and checks them against the maximum
+    speed
+
+    returns: see _measureBlockTime
     """
-    def _pollActiveSensors(self):
-        activeSensors = {}
-        for sensor in self.data["JMRI Sensors"].keys():
-            activeSensors[sensor] = (self.data["JMRI Sensors"][sensor].getKnownState() == self.data["JMRI Sensor Active Const"] )
-        return activeSensors
+    def _finishCvValue(self, forward, cvValue, sampler, measurements):
+        # check speed constraints on the outlier-free block times
+        blockTimes = sampler.measuredBlockTimes()
+        relativeTimes = []
+        for sensor in blockTimes.keys():
+            timeSec = blockTimes[sensor]
+            relativeTimes.append(timeSec / self.topSpeedTimeSecPerBlock[sensor])
+
+            # engine can't go fast enough - throw exception
+            # Note: quite often, an engine goes almost fast enough,
+            # at which point we want to keep the calibration speed
+            # and let the CV value "clip" at 255 towards the top
+            # of the table. Therefore, this is a warning, not an
+            # exception.
+            if cvValue > 253:
+                if self.topSpeedTimeSecPerBlock[sensor] < timeSec:
+                    measuredSpeed = ( self.data["Maximum Speed"] *
+                                    self.topSpeedTimeSecPerBlock[sensor] *
+                                    1.0 / timeSec )
+                    print("Time this block: " + str(timeSec))
+                    print("Required time at desired SMPH: " + str(self.topSpeedTimeSecPerBlock[sensor]))
+                    print("WARNING: Measured maximum SMPH:" + str(measuredSpeed))
+                    # stop the locomotive
+                    #self.throttle.driveCv(cvValue=0, forward=True)
+                    #raise Exception("Locomotive cannot reach top speed in smph at full voltage. Try a lower smph calibration speed.")
 
-    def _saveBlockTimes(self):
-        pickle.dump([self.timeSecPerBlockMeasurementsForward, self.timeSecPerBlockMeasurementsReverse],
-                    open(self.filename, "wb" ))
-        print("Time measurements written to disk at: " + self.filename)
+        if forward:
+            self.timeSecPerBlockMeasurementsForward[cvValue] = measurements
+        else:
+            self.timeSecPerBlockMeasurementsReverse[cvValue] = measurements
+        if self.poolBlocks:
+            self._updateBlockLengths(forward)
 
+        if not relativeTimes:
+            return None
+        return sum(relativeTimes) / len(relativeTimes)
+
+    """
+    starts from the block lengths in the layout profile, if there is one,
+    so that every block can be a speed sample from the first lap
+    """
+    def _loadKnownBlockLengths(self):
+        layoutProfile = self.data.get("Layout Profile")
+        if not layoutProfile:
+            return
+        monitoredSensors = list(self.data["JMRI Sensors"].keys())
+        for forward in [True, False]:
+            self.knownBlockLengths[forward] = layoutProfile.getBlockLengths(
+                forward, self.maximumLengthError, monitoredSensors)
+            for i in range(len(self.data["Measured Block Sensors"])):
+                self.knownBlockLengths[forward][self.data["Measured Block Sensors"][i]] = \
+                    self.data["Measured Block Lengths (Inches)"][i]
+        print("Block lengths from the layout profile: " +
+              str(len(self.knownBlockLengths[True])) + " forward, " +
+              str(len(self.knownBlockLengths[False])) + " reverse")
+
+    """
+    re-estimates the block lengths for one direction from everything
+    measured so far, and adds the blocks that are now known well enough to
+    knownBlockLengths
+    """
+    def _updateBlockLengths(self, forward):
+        if forward:
+            measurements = self.timeSecPerBlockMeasurementsForward
+        else:
+            measurements = self.timeSecPerBlockMeasurementsReverse
+        measuredLengths = {}
+        for i in range(len(self.data["Measured Block Sensors"])):
+            measuredLengths[self.data["Measured Block Sensors"][i]] = \
+                self.data["Measured Block Lengths (Inches)"][i]
+        seen = [sensor for cv in measurements.keys() for sensor in measurements[cv].keys()]
+        if not [el for el in measuredLengths.keys() if el in seen]:
+            return
+
+        solver = BlockLengthSolver(measuredLengths)
+        if forward:
+            solver.solve(measurements, None)
+        else:
+            solver.solve(None, measurements)
+        lengths = solver.getLengths(forward)
+        errors = solver.getLengthErrors(forward)
+        for sensor in lengths.keys():
+            if errors[sensor] <= self.maximumLengthError:
+                self.knownBlockLengths[forward][sensor] = lengths[sensor]
+        print("Blocks with known lengths, " + ("forward" if forward else "reverse") +
+              ": " + str(len(self.knownBlockLengths[forward])))
+
+    """
+    returns (name, activation time in seconds) of the new sensor that
+    became active
+
+    Activations are queued by the SensorMonitor as JMRI reports them, so we
+    just take the next one off the queue. If two sensors activate close
+    together, they are returned one after the other in the order they
+    happened. Chatter and activations out of sequence are left out (see
+    DetectionFilter). Raises an exception if no sensor goes active within
+    timeoutSec.
+    """
+    def _waitForBlockSensor(self, forward, timeoutSec=None):
+        return self.detectionFilter.waitForActivation(forward, timeoutSec)
+
+    """
+    settings that change which CV values get measured or what the samples
+    mean. Resuming a run with different ones would mix two runs.
+    """
+    def _journalHeader(self):
+        return {"DCC Address" : self.data["DCC Address"],
+                "Maximum Speed" : self.data["Maximum Speed"],
+                "Scale" : self.data["Scale"],
+                "vStart" : int(self.data["vStart"]),
+                "Measured Blocks" : sorted(zip(self.data["Measured Block Sensors"],
+                                               self.data["Measured Block Lengths (Inches)"]))}
+
+    """
+    loads the measurements of the locomotive's latest run from the fleet
+    store. Falls back to a finished journal, or the pickle file written by
+    earlier versions.
+    """
     def _loadBlockTimes(self):
+        store = FleetStore()
+        record = store.latestRun(self.data["DCC Address"], self.data["Filename Suffix"])
+        if record is not None:
+            run = record["Run"]
+            self.timeSecPerBlockMeasurementsForward = store.loadMeasurements(run, True)
+            self.timeSecPerBlockMeasurementsReverse = store.loadMeasurements(run, False)
+            self.nextSensorForward = store.loadNextSensors(run, True)
+            self.nextSensorReverse = store.loadNextSensors(run, False)
+            print("Time measurements loaded from run " + str(run) + " in the fleet store")
+            return
+        if self.journal.load():
+            if not self.journal.isFinished():
+                raise Exception("Measurements in " + self.journal.filename +
+                                " are incomplete. Use Resume Measurements to finish them.")
+            self.timeSecPerBlockMeasurementsForward, self.nextSensorForward = \
+                self.journal.getMeasurements(True)
+            self.timeSecPerBlockMeasurementsReverse, self.nextSensorReverse = \
+                self.journal.getMeasurements(False)
+            return
         r = pickle.load( open(self.filename, "rb") )
         self.timeSecPerBlockMeasurementsForward = r[0]
         self.timeSecPerBlockMeasurementsReverse = r[1]
@@ -284,5 +960,17 @@ class LayoutBlocks:
     def getReverseMeasurements(self):
         return self.timeSecPerBlockMeasurementsReverse
 
+    def getNextSensorForward(self):
+        return self.nextSensorForward
+
+    def getNextSensorReverse(self):
+        return self.nextSensorReverse
+
+    def getQuarantinedSensors(self):
+        return self.quarantinedSensors
+
+    def getSensorSequence(self):
+        return self.sensorSequence
+
     def getTopSpeedTimePerMeasuredBlock(self):
         return self.topSpeedTimeSecPerBlock
@@ -0,0 +1,224 @@
+"""
+What we know about the layout itself, kept from one calibration to the
+next: the order of the sensors around the loop, the length of every block
+with how well we know it, and which detectors are bad.
+
+The blocks are the same for every locomotive, so there's no reason for each
+calibration to learn them from scratch. Block lengths known well enough
+let LayoutBlocks use every block as a speed sample from the first lap (see
+BlockTimeSampler), and every run makes the lengths more accurate.
+
+Lengths are apparent lengths per direction, as BlockLengthSolver estimates
+them, and belong to a block as it was seen: from its sensor to the next
+sensor in that direction. If a detector gets ignored later, the block in
+front of it becomes longer, so lengths are only handed out for blocks
+whose next sensor is still the one the length was measured to.
+
+A detector is considered bad once the blocks on both sides of it have been
+much noisier than the rest (see BlockLengthSolver.getNoisyBlocks), or it
+was quarantined during the run (see DetectionFilter), in at least
+badDetectorRuns calibrations, and in at least half the calibrations it
+was seen in. Detectors listed as ignored in SpeedMatch.py are always bad.
+"""
+import os
+import pickle
+from math import log, exp, sqrt
+
+from Utils import dataFolder
+
+"""
+filename: where the profile is kept, in the data folder by default
+minimumLengthError: never consider a length better known than this. Each
+                    locomotive sees the blocks a little differently (grades,
+                    detector latency), so more runs don't make it perfect.
+badDetectorRuns: noisy in this many calibrations makes a detector bad
+"""
+class LayoutProfile:
+    def __init__(self, filename=None, minimumLengthError=0.003, badDetectorRuns=2):
+        if filename is None:
+            filename = os.path.join(dataFolder(), "Layout.lop")
+        self.filename = filename
+        self.minimumLengthError = minimumLengthError
+        self.badDetectorRuns = badDetectorRuns
+        # sensors in the order a locomotive driving forward passes them
+        self.sequence = []
+        # forward (True / False) : {sensor : next sensor in that direction}
+        self.nextSensor = {True : {}, False : {}}
+        # forward : {sensor : (length in inches, relative error, next sensor)}
+        self.blockLengths = {True : {}, False : {}}
+        # sensor : length in inches, as entered in SpeedMatch.py
+        self.measuredBlocks = {}
+        # sensor : why it's bad
+        self.badDetectors = {}
+        # sensor : number of calibrations it was seen in / it was noisy in
+        self.runsSeen = {}
+        self.runsNoisy = {}
+        self.calibrations = 0
+
+    def load(self):
+        if os.path.exists(self.filename):
+            self.__dict__.update(pickle.load(open(self.filename, "rb")))
+            print("Layout profile loaded from: " + self.filename + " (" +
+                  str(self.calibrations) + " calibrations, " +
+                  str(len(self.sequence)) + " sensors in sequence)")
+        return
+
+    def save(self):
+        state = {}
+        for key in ["sequence", "nextSensor", "blockLengths", "measuredBlocks",
+                    "badDetectors", "runsSeen", "runsNoisy", "calibrations"]:
+            state[key] = getattr(self, key)
+        pickle.dump(state, open(self.filename, "wb"))
+        print("Layout profile written to disk at: " + self.filename)
+
+    def getSequence(self):
+        return self.sequence
+
+    def getBadDetectors(self):
+        return sorted(self.badDetectors.keys())
+
+    """
+    sensor that should end the block starting at sensor, given which
+    sensors are monitored now. None if we don't know the sequence.
+    """
+    def expectedNextSensor(self, sensor, forward, monitoredSensors):
+        if sensor not in self.sequence:
+            return None
+        n = len(self.sequence)
+        i = self.sequence.index(sensor)
+        step = 1 if forward else -1
+        for j in range(1, n):
+            candidate = self.sequence[(i + step * j) % n]
+            if candidate in monitoredSensors:
+                return candidate
+        return None
+
+    """
+    block lengths known to within maximumError for one direction, that are
+    still valid with the sensors monitored now
+
+    returns: dict of sensor : length in inches
+    """
+    def getBlockLengths(self, forward, maximumError=0.01, monitoredSensors=None):
+        lengths = {}
+        for sensor in self.blockLengths[forward].keys():
+            length, error, nextSensor = self.blockLengths[forward][sensor]
+            if error > maximumError:
+                continue
+            if monitoredSensors is not None:
+                if sensor not in monitoredSensors:
+                    continue
+                expected = self.expectedNextSensor(sensor, forward, monitoredSensors)
+                if expected is not None and not expected == nextSensor:
+                    continue
+            lengths[sensor] = length
+        return lengths
+
+    """
+    Updates the profile after a calibration.
+
+    solver: BlockLengthSolver, solved with this run's measurements
+    nextSensorForward, nextSensorReverse: sensor that ended each block, as
+                                          recorded by LayoutBlocks
+    measuredLengths: dict of sensor : measured length in inches
+    ignoredSensors: sensors ignored in SpeedMatch.py
+    quarantinedSensors: sensors the DetectionFilter quarantined during the run
+    sequence: sensors around the loop that were watched, without the
+              quarantined ones. Followed from nextSensorForward if not given.
+    """
+    def update(self, solver, nextSensorForward, nextSensorReverse, measuredLengths,
+               ignoredSensors=None, quarantinedSensors=None, sequence=None):
+        self.calibrations += 1
+        self.measuredBlocks = dict(measuredLengths)
+        for sensor in ignoredSensors or []:
+            self.badDetectors[sensor] = "ignored in SpeedMatch.py"
+
+        for forward, nextSensor in [(True, nextSensorForward), (False, nextSensorReverse)]:
+            self.nextSensor[forward].update(nextSensor)
+            lengths = solver.getLengths(forward)
+            errors = solver.getLengthErrors(forward)
+            for sensor in lengths.keys():
+                if sensor not in nextSensor:
+                    continue
+                self._updateLength(forward, sensor, lengths[sensor], errors[sensor],
+                                   nextSensor[sensor])
+
+        # blocks that ended at a quarantined sensor weren't kept, so the
+        # next sensors alone may not get all the way around the loop
+        if not sequence:
+            sequence = self._sequenceFrom(nextSensorForward)
+        if len(sequence) >= len(self.sequence):
+            self.sequence = sequence
+
+        self._updateBadDetectors(solver, nextSensorForward, nextSensorReverse,
+                                 quarantinedSensors)
+        return
+
+    """
+    combines a new length estimate with the stored one, in log space,
+    weighted by the inverse variances
+    """
+    def _updateLength(self, forward, sensor, length, error, nextSensor):
+        if sensor in self.measuredBlocks:
+            self.blockLengths[forward][sensor] = (self.measuredBlocks[sensor], 0.0, nextSensor)
+            return
+        error = max(error, self.minimumLengthError)
+        if sensor in self.blockLengths[forward]:
+            oldLength, oldError, oldNextSensor = self.blockLengths[forward][sensor]
+            if oldNextSensor == nextSensor and oldError > 0:
+                weight = 1.0 / (error * error)
+                oldWeight = 1.0 / (oldError * oldError)
+                length = exp( (weight * log(length) + oldWeight * log(oldLength)) /
+                              (weight + oldWeight) )
+                error = max(1.0 / sqrt(weight + oldWeight), self.minimumLengthError)
+        self.blockLengths[forward][sensor] = (length, error, nextSensor)
+
+    """
+    follows the next sensors around the loop, starting from the first
+    measured block if there is one
+
+    returns: list of sensors, or as much of the loop as we can follow
+    """
+    def _sequenceFrom(self, nextSensor):
+        if not nextSensor:
+            return []
+        starts = [el for el in sorted(self.measuredBlocks.keys()) if el in nextSensor]
+        start = starts[0] if starts else sorted(nextSensor.keys())[0]
+        sequence = [start]
+        sensor = nextSensor[start]
+        while sensor in nextSensor and sensor not in sequence:
+            sequence.append(sensor)
+            sensor = nextSensor[sensor]
+        if sensor not in sequence:
+            sequence.append(sensor)
+        return sequence
+
+    """
+    a detector is noisy in this run if the blocks on both sides of it were
+    noisy, in either direction, or if it was quarantined
+    """
+    def _updateBadDetectors(self, solver, nextSensorForward, nextSensorReverse,
+                            quarantinedSensors=None):
+        noisy = set(quarantinedSensors or [])
+        for forward, nextSensor in [(True, nextSensorForward), (False, nextSensorReverse)]:
+            noisyBlocks = solver.getNoisyBlocks(forward)
+            for sensor in noisyBlocks:
+                # the block starting where this one ends; the detector
+                # between the two is the suspect
+                following = nextSensor.get(sensor)
+                if following in noisyBlocks:
+                    noisy.add(following)
+        seen = set(nextSensorForward.keys()) | set(nextSensorReverse.keys()) | noisy
+        for sensor in seen:
+            self.runsSeen[sensor] = self.runsSeen.get(sensor, 0) + 1
+        for sensor in noisy:
+            self.runsNoisy[sensor] = self.runsNoisy.get(sensor, 0) + 1
+            if ( self.runsNoisy[sensor] >= self.badDetectorRuns and
+                 self.runsNoisy[sensor] * 2 >= self.runsSeen[sensor] and
+                 sensor not in self.badDetectors ):
+                self.badDetectors[sensor] = ("noisy in " + str(self.runsNoisy[sensor]) +
+                                             " of " + str(self.runsSeen[sensor]) +
+                                             " calibrations")
+                print("WARNING: detector " + sensor + " looks bad (" +
+                      self.badDetectors[sensor] + ") and will be ignored from now on.")
+        return
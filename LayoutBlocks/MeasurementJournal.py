@@ -0,0 +1,234 @@
+"""
+Append-only record of every block time sample, written as it's taken.
+
+Measuring a locomotive takes hours. Instead of saving everything once both
+directions are done, each sample goes to the journal right away, so that
+a crash, a derailment or a lost sensor only costs the CV value that was
+being measured at the time. The journal is a text file with one
+tab-separated record per line:
+
+    H  key  value                               settings of the run
+    B  F|R  cvValue                             started measuring a CV value
+    S  F|R  cvValue  sensor  nextSensor  time   one block time sample
+    E  F|R  cvValue                             finished a CV value
+    D                                           all measurements done
+
+Lines are flushed to the operating system as they're written, and synced
+to disk every syncEveryRecords records or syncEverySec seconds, and at
+the end of every CV value. A line cut short by a crash is ignored when
+the journal is read back.
+"""
+import os
+
+from Utils import monotonicTimeSec
+
+VERSION = "1"
+
+def _directionString(forward):
+    return "F" if forward else "R"
+
+"""
+filename: where the journal is kept
+syncEveryRecords, syncEverySec: sync to disk at least this often
+"""
+class MeasurementJournal:
+    def __init__(self, filename, syncEveryRecords=20, syncEverySec=30.0):
+        self.filename = filename
+        self.syncEveryRecords = syncEveryRecords
+        self.syncEverySec = syncEverySec
+        self.file = None
+        self.unsyncedRecords = 0
+        self.lastSyncSec = None
+        self._clear()
+
+    def _clear(self):
+        # key : value, as strings
+        self.header = {}
+        # (forward, cvValue) : list of (sensor, next sensor, time in seconds)
+        self.samples = {}
+        # (forward, cvValue) pairs in the order they were started
+        self.cvValueOrder = []
+        self.completeCvValues = set()
+        self.finished = False
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    """
+    reads the journal back
+
+    returns: True if there was a journal to read
+    """
+    def load(self):
+        self._clear()
+        if not self.exists():
+            return False
+        f = open(self.filename, "r")
+        try:
+            for line in f:
+                # a crash can leave the last line half written
+                if not line.endswith("\n"):
+                    break
+                self._parseRecord(line[:-1].split("\t"))
+        finally:
+            f.close()
+        return True
+
+    def _parseRecord(self, fields):
+        kind = fields[0]
+        if kind == "H" and len(fields) == 3:
+            self.header[fields[1]] = fields[2]
+        elif kind in ("B", "E") and len(fields) == 3:
+            key = (fields[1] == "F", int(fields[2]))
+            if key not in self.samples:
+                self.samples[key] = []
+                self.cvValueOrder.append(key)
+            if kind == "E":
+                self.completeCvValues.add(key)
+        elif kind == "S" and len(fields) == 6:
+            key = (fields[1] == "F", int(fields[2]))
+            if key not in self.samples:
+                self.samples[key] = []
+                self.cvValueOrder.append(key)
+            self.samples[key].append((fields[3], fields[4], float(fields[5])))
+        elif kind == "D":
+            self.finished = True
+
+    """
+    starts a new journal. An unfinished journal that's in the way is kept
+    as a backup rather than thrown out.
+
+    header: dict of the settings that have to match to resume the run
+    """
+    def start(self, header):
+        if self.exists() and self.load() and not self.finished:
+            backup = self.filename + ".bak"
+            if os.path.exists(backup):
+                os.remove(backup)
+            os.rename(self.filename, backup)
+            print("Unfinished measurement journal moved to: " + backup)
+        self._clear()
+        self.file = open(self.filename, "w")
+        self._write(["#", "SpeedMatch measurement journal", VERSION])
+        for key in sorted(header.keys()):
+            self.header[key] = str(header[key])
+            self._write(["H", key, str(header[key])])
+        self.sync()
+
+    """
+    reopens an unfinished journal to carry on where it stopped. Raises an
+    exception if the run was started with different settings.
+
+    returns: False if there's no journal to resume
+    """
+    def resume(self, header):
+        if not self.load():
+            return False
+        for key in header.keys():
+            if not self.header.get(key) == str(header[key]):
+                raise Exception("Can't resume measurements: " + key + " was " +
+                                str(self.header.get(key)) + ", now " + str(header[key]))
+        self._dropPartialLine()
+        self.file = open(self.filename, "a")
+        print("Resuming measurements from: " + self.filename + " (" +
+              str(len(self.completeCvValues)) + " CV values done)")
+        return True
+
+    """
+    cuts off a line that a crash left half written, so that the records
+    appended after it don't end up on the same line
+    """
+    def _dropPartialLine(self):
+        f = open(self.filename, "rb")
+        try:
+            content = f.read()
+        finally:
+            f.close()
+        complete = content.rfind(b"\n") + 1
+        if complete < len(content):
+            f = open(self.filename, "r+b")
+            try:
+                f.truncate(complete)
+            finally:
+                f.close()
+
+    def beginCvValue(self, forward, cvValue):
+        key = (forward, cvValue)
+        if key not in self.samples:
+            self.samples[key] = []
+            self.cvValueOrder.append(key)
+        self._write(["B", _directionString(forward), str(cvValue)])
+
+    def addSample(self, forward, cvValue, sensor, nextSensor, timeSec):
+        self.samples[(forward, cvValue)].append((sensor, nextSensor, timeSec))
+        self._write(["S", _directionString(forward), str(cvValue),
+                     str(sensor), str(nextSensor), repr(timeSec)])
+
+    def endCvValue(self, forward, cvValue):
+        self.completeCvValues.add((forward, cvValue))
+        self._write(["E", _directionString(forward), str(cvValue)])
+        self.sync()
+
+    def finish(self):
+        self.finished = True
+        self._write(["D"])
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def _write(self, fields):
+        self.file.write("\t".join(fields) + "\n")
+        self.file.flush()
+        self.unsyncedRecords += 1
+        now = monotonicTimeSec()
+        if self.lastSyncSec is None:
+            self.lastSyncSec = now
+        if ( self.unsyncedRecords >= self.syncEveryRecords or
+             now - self.lastSyncSec >= self.syncEverySec ):
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        try:
+            os.fsync(self.file.fileno())
+        except (AttributeError, OSError, TypeError):
+            # not every Jython file object can be synced - the flush
+            # above still gets the data out of our process
+            pass
+        self.unsyncedRecords = 0
+        self.lastSyncSec = monotonicTimeSec()
+
+    """
+    returns: list of (sensor, next sensor, time in seconds) recorded for
+             one CV value in one direction
+    """
+    def getSamples(self, forward, cvValue):
+        return self.samples.get((forward, cvValue), [])
+
+    def isCvValueComplete(self, forward, cvValue):
+        return (forward, cvValue) in self.completeCvValues
+
+    def isFinished(self):
+        return self.finished
+
+    """
+    returns: (block time measurements, next sensors) for one direction, in
+             the format of LayoutBlocks - {cvValue : {sensor : [times]}} and
+             {sensor : next sensor}
+    """
+    def getMeasurements(self, forward):
+        measurements = {}
+        nextSensor = {}
+        for key in self.cvValueOrder:
+            if not key[0] == forward:
+                continue
+            blockTimes = {}
+            for sensor, following, timeSec in self.samples[key]:
+                blockTimes.setdefault(sensor, []).append(timeSec)
+                nextSensor[sensor] = following
+            measurements[key[1]] = blockTimes
+        return measurements, nextSensor
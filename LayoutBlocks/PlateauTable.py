@@ -0,0 +1,63 @@
+"""
+A speed table made of plateaus, for measuring several CV values without
+programming between them.
+
+Throttle.driveCv programs the CV value into the 9 speed table steps around
+step 14 and drives at step 14, so the decoder's interpolation between steps
+can't get in the way - and it does that for every CV value. A plateau table
+instead holds a few CV values at once, each on its own run of plateauWidth
+steps. Driving at the middle step of a plateau (Throttle.driveStep) runs
+at that CV value, with as many steps of margin on either side as driveCv
+has. Moving between the CV values of a table is then only a change of
+throttle setting.
+
+A whole table takes 28 writes, about as many as driveCv takes for three CV
+values. So it pays off when it holds many CV values that are known before
+measuring starts: with 3 steps per plateau, nine CV values fit, the whole
+fixed grid but its top value (see LayoutBlocks._programPlateauTable).
+Decoders that interpolate over more steps need wider plateaus, and fit
+fewer CV values.
+
+The CV values go onto the plateaus in ascending order, so the table never
+decreases, as decoders expect. The steps after the last plateau repeat its
+value.
+"""
+
+class PlateauTable:
+    def __init__(self, plateauWidth=3):
+        self.plateauWidth = plateauWidth
+        self.plateaus = 28 // plateauWidth
+        # CV value of each plateau, ascending
+        self.cvValues = []
+
+    """
+    returns: the throttle step in the middle of the plateau holding
+             cvValue, or None if it's not on the table
+    """
+    def stepFor(self, cvValue):
+        if cvValue not in self.cvValues:
+            return None
+        plateau = self.cvValues.index(cvValue)
+        return plateau * self.plateauWidth + (self.plateauWidth + 1) // 2
+
+    """
+    puts the first CV values on the plateaus, as many as fit
+
+    cvValues: CV values in the order they are going to be measured
+    """
+    def setCvValues(self, cvValues):
+        unique = []
+        for cvValue in cvValues:
+            if cvValue not in unique:
+                unique.append(cvValue)
+        self.cvValues = sorted(unique[:self.plateaus])
+
+    """
+    returns: the 28 step speed table
+    """
+    def table(self):
+        table = []
+        for step in range(1, 29):
+            plateau = min((step - 1) // self.plateauWidth, len(self.cvValues) - 1)
+            table.append(self.cvValues[plateau])
+        return table
@@ -0,0 +1,113 @@
+"""
+Orders the (direction, CV value) visits of a run so the locomotive spends
+as little time as possible between them.
+
+Every visit starts the locomotive at its CV value and direction. What that
+costs depends on where it comes from:
+
+- a new CV value has to be programmed (writesPerCvValue writes, see
+  Throttle.driveCv), unless it's the CV value the decoder already has
+- a change of direction stops the locomotive and gets it going again
+- either way, the locomotive needs a moment to settle at its new speed,
+  longer for a bigger change of speed
+
+Measuring every CV value forward and then every one in reverse programs
+each CV value twice, but only turns around once. Measuring forward and
+reverse back to back at each CV value programs it once, and alternating
+which direction goes first ("F16 R16 R29 F29 ...") costs one turn per CV
+value. Which one is cheaper depends on how slow the programming is
+compared to turning around, so plan() works out the cost of both orders,
+going up or down the CV values, and picks the cheapest.
+"""
+
+class VisitScheduler:
+    """
+    writeSec: time for one CV write, e.g. the mean from ProgrammingLatency
+    reversalSec: time to stop and get going the other way, beyond the wait
+                 every visit has for the locomotive to settle (see
+                 Throttle.settle) - with the momentum CVs at 1 for
+                 measuring, that wait covers most of it
+    settleSecPerCv: extra settling time per CV value of speed change
+    """
+    def __init__(self, writeSec=0.5, writesPerCvValue=9, reversalSec=0.5,
+                 settleSecPerCv=0.01):
+        self.writeSec = writeSec
+        self.writesPerCvValue = writesPerCvValue
+        self.reversalSec = reversalSec
+        self.settleSecPerCv = settleSecPerCv
+
+    """
+    returns: time in seconds to go from one visit to the next. Either may
+             have a CV value of None, for a stopped locomotive.
+    """
+    def transitionCost(self, fromVisit, toVisit):
+        fromForward, fromCv = fromVisit
+        toForward, toCv = toVisit
+        cost = 0.0
+        if not toCv == fromCv:
+            cost += self.writesPerCvValue * self.writeSec
+        if fromCv is not None and not toForward == fromForward:
+            cost += self.reversalSec
+        cost += self.settleSecPerCv * abs((toCv or 0) - (fromCv or 0))
+        return cost
+
+    """
+    returns: the total transition time of visits, starting from start
+    """
+    def cost(self, visits, start=(True, None)):
+        total = 0.0
+        position = start
+        for visit in visits:
+            total += self.transitionCost(position, visit)
+            position = visit
+        return total
+
+    """
+    cvValues: CV values to measure in both directions
+    start: (forward, cvValue) the locomotive is at now; cvValue None if it
+           isn't running
+
+    returns: list of (forward, cvValue) visits, the cheapest order we found
+    """
+    def plan(self, cvValues, start=(True, None)):
+        cvValues = sorted(set(cvValues))
+        if not cvValues:
+            return []
+        candidates = []
+        for order in [cvValues, list(reversed(cvValues))]:
+            candidates.append(self.interleavedPlan(order, start[0]))
+            candidates.append(self.sequentialPlan(order, start[0]))
+        # the CV value we're at first, if it's one of them
+        if start[1] in cvValues:
+            rest = [el for el in cvValues if not el == start[1]]
+            for order in [rest, list(reversed(rest))]:
+                candidates.append(self.interleavedPlan([start[1]] + order, start[0]))
+        return min(candidates, key=lambda el: self.cost(el, start))
+
+    """
+    returns: forward and reverse back to back at each CV value, alternating
+             which goes first so that the direction only changes within a
+             CV value
+    """
+    def interleavedPlan(self, cvValues, forward=True):
+        visits = []
+        for cvValue in cvValues:
+            visits.append((forward, cvValue))
+            visits.append((not forward, cvValue))
+            forward = not forward
+        return visits
+
+    """
+    returns: every CV value in one direction, then back the other way,
+             like measureBlockTimes did before the visits were planned
+    """
+    def sequentialPlan(self, cvValues, forward=True):
+        return [(forward, el) for el in cvValues] + \
+               [(not forward, el) for el in reversed(cvValues)]
+
+    """
+    returns: the visits as text, e.g. "Fwd 16, Rev 16, Rev 29"
+    """
+    def describe(self, visits):
+        return ", ".join([('Fwd' if forward else 'Rev') + " " + str(cvValue)
+                          for forward, cvValue in visits])
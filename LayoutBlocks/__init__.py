@@ -1 +1,7 @@
-from LayoutBlocks import LayoutBlocks
+from .LayoutBlocks import LayoutBlocks
+from .LayoutProfile import LayoutProfile
+from .MeasurementJournal import MeasurementJournal
+from .EtaPredictor import EtaPredictor
+from .VisitScheduler import VisitScheduler
+from .DetectionFilter import DetectionFilter
+from .PlateauTable import PlateauTable
@@ -0,0 +1,203 @@
+"""
+Records where a calibration spends its time, so we know which speedups
+matter on a given layout.
+
+A run is split into phases (programming the decoder for measuring,
+warm-up, finding the loop, measuring, computing the table, ...), and the
+measuring phase into one section per direction and CV value. Sections
+nest: whatever is counted while a section is open is added to it and to
+every section around it. For each one we record
+
+- the wall time, by the clock the sensor monitor uses (so the Simulator's
+  virtual time works too)
+- the CV writes sent and skipped as unchanged (see CvShadow), and the
+  time spent waiting for the command station to confirm them
+- the time spent waiting for the locomotive to settle at a new speed
+- the laps driven (passes of the first measured block) and the block
+  time samples taken
+
+The idle time of a section is the CV write and settle time - the time the
+locomotive wasn't taking samples.
+
+summary() gives a table to print at the end of the run, and save() writes
+the sections as JSON and CSV next to the measurements.
+"""
+import csv
+import json
+import os
+import time
+
+from Utils import monotonicTimeSec, dataFolder
+
+# column order of the CSV export
+FIELDS = ["Section", "Depth", "Direction", "CV Value", "Start (s)", "Wall Time (s)",
+          "CV Writes", "CV Writes Skipped", "CV Write Time (s)", "Settle Time (s)",
+          "Idle Time (s)", "Laps", "Samples"]
+
+class RunProfiler:
+    """
+    clock: function returning the current time in seconds
+    """
+    def __init__(self, clock=monotonicTimeSec):
+        self.clock = clock
+        self.startTime = clock()
+        # every section, in the order they were begun
+        self.sections = []
+        # the sections that are open, outermost first
+        self.openSections = []
+
+    """
+    opens a section inside the currently open one
+
+    forward, cvValue: direction and CV value measured in this section, if any
+    """
+    def begin(self, name, forward=None, cvValue=None):
+        direction = None
+        if forward is not None:
+            direction = "Fwd" if forward else "Rev"
+        section = {"Section" : name,
+                   "Depth" : len(self.openSections),
+                   "Direction" : direction,
+                   "CV Value" : cvValue,
+                   "Start (s)" : self.clock() - self.startTime,
+                   "Wall Time (s)" : 0.0,
+                   "CV Writes" : 0,
+                   "CV Writes Skipped" : 0,
+                   "CV Write Time (s)" : 0.0,
+                   "Settle Time (s)" : 0.0,
+                   "Idle Time (s)" : 0.0,
+                   "Laps" : 0,
+                   "Samples" : 0}
+        self.sections.append(section)
+        self.openSections.append(section)
+
+    """
+    closes the innermost open section
+    """
+    def end(self):
+        section = self.openSections.pop()
+        section["Wall Time (s)"] = self.clock() - self.startTime - section["Start (s)"]
+
+    def _add(self, field, value):
+        for section in self.openSections:
+            section[field] += value
+
+    """
+    sent: False if the write was skipped since the decoder already holds the value
+    seconds: time until the command station confirmed the write
+    """
+    def countCvWrite(self, sent, seconds=0.0):
+        if sent:
+            self._add("CV Writes", 1)
+            self._add("CV Write Time (s)", seconds)
+            self._add("Idle Time (s)", seconds)
+        else:
+            self._add("CV Writes Skipped", 1)
+
+    """
+    time spent waiting for the locomotive to get to a new speed
+    """
+    def countSettle(self, seconds):
+        self._add("Settle Time (s)", seconds)
+        self._add("Idle Time (s)", seconds)
+
+    """
+    lap: True if this sample completed a lap
+    """
+    def countSample(self, lap=False):
+        self._add("Samples", 1)
+        if lap:
+            self._add("Laps", 1)
+
+    """
+    returns: the sections, in the order they were begun. Sections that are
+             still open have no wall time yet.
+    """
+    def getSections(self):
+        return self.sections
+
+    """
+    returns: the total wall time of the run so far in seconds
+    """
+    def totalTime(self):
+        return self.clock() - self.startTime
+
+    """
+    returns: list of lines with the time per phase, the slowest CV values,
+             and the totals
+    """
+    def summary(self, slowestCount=5):
+        total = self.totalTime()
+        lines = ["Run profile (" + _hours(total) + " total):"]
+        lines.append("    %-28s %9s %6s %7s %9s %5s %7s" %
+                     ("Phase", "Time", "Share", "Writes", "Idle", "Laps", "Samples"))
+        phases = [el for el in self.sections if el["Direction"] is None]
+        for section in phases:
+            lines.append(_line("  " * section["Depth"] + section["Section"], section, total))
+        cvValues = [el for el in self.sections if el["Direction"] is not None]
+        if cvValues:
+            slowest = sorted(cvValues, key=lambda el: -el["Wall Time (s)"])[:slowestCount]
+            lines.append("    Slowest CV values:")
+            for section in slowest:
+                lines.append(_line(section["Direction"] + " " + str(section["CV Value"]),
+                                   section, total))
+        return lines
+
+    """
+    writes the sections to <basename>.json and <basename>.csv, by default
+    Profile<DCC address><suffix>-<date and time> in the data folder
+
+    returns: (JSON filename, CSV filename)
+    """
+    def save(self, basename):
+        jsonFilename = basename + ".json"
+        f = open(jsonFilename, "w")
+        try:
+            json.dump({"Total Time (s)" : self.totalTime(), "Sections" : self.sections},
+                      f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+        csvFilename = basename + ".csv"
+        f = open(csvFilename, "w")
+        try:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(FIELDS)
+            for section in self.sections:
+                writer.writerow([_csvValue(section[el]) for el in FIELDS])
+        finally:
+            f.close()
+        return jsonFilename, csvFilename
+
+    """
+    prints the summary and saves the profile, for the end of a run
+    """
+    def report(self, basename):
+        for line in self.summary():
+            print(line)
+        jsonFilename, csvFilename = self.save(basename)
+        print("Run profile saved to: " + jsonFilename + " and " + csvFilename)
+
+"""
+returns: the basename RunProfiler.save() writes a locomotive's profile to
+"""
+def profileBasename(data):
+    return os.path.join(dataFolder(), "Profile" + str(data["DCC Address"]) +
+                        str(data["Filename Suffix"]) + "-" +
+                        time.strftime("%Y%m%d-%H%M%S"))
+
+def _hours(seconds):
+    return str(round(seconds / 3600.0, 2)) + " h"
+
+def _line(label, section, total):
+    share = section["Wall Time (s)"] / total if total > 0 else 0.0
+    return "    %-28s %8.0fs %5.1f%% %7d %8.0fs %5d %7d" % (
+        label, section["Wall Time (s)"], 100.0 * share, section["CV Writes"],
+        section["Idle Time (s)"], section["Laps"], section["Samples"])
+
+def _csvValue(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return "%.3f" % value
+    return value
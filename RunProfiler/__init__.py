@@ -0,0 +1 @@
+from .RunProfiler import RunProfiler, profileBasename
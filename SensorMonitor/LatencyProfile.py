@@ -0,0 +1,151 @@
+"""
+Per-detector reporting latency, learned from block time measurements.
+
+Some block detectors take longer than others to report that a locomotive
+has entered. Since a block time is the difference between the activation
+times of two detectors, a slow detector makes the block in front of it
+look short and the block behind it look long, by the same number of
+seconds at every speed.
+
+That constant offset is what we learn here. Summed over a full loop the
+latencies cancel, so the lap time is a clean measure of how slow the
+locomotive is running at each CV value. Fitting each block time against
+the lap time, block time = slope * lap time + intercept, the intercept is
+the latency of the detector at the end of the block minus the latency of
+the detector at the start of it. With the intercepts of every block in both
+directions we solve for the individual detector latencies by least squares.
+Only differences between latencies can be known, so they're reported
+relative to the average detector.
+
+This assumes that each block takes a fixed fraction of a lap at every
+speed. A block on a steep grade can bend that a little at the slowest
+speeds, which is why the latency profile is optional.
+
+The SensorMonitor subtracts the latency from each activation time stamp.
+If the measurements were already corrected by a profile, learning from
+them again refines the existing profile.
+"""
+import os
+import pickle
+
+from Utils import median, dataFolder
+
+class LatencyProfile:
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(dataFolder(), "DetectorLatency.dlp")
+        self.filename = filename
+        # sensor name : latency in seconds, relative to the average detector
+        self.latencySec = {}
+
+    def getLatency(self, sensor):
+        return self.latencySec.get(sensor, 0.0)
+
+    def load(self):
+        if os.path.exists(self.filename):
+            self.latencySec = pickle.load(open(self.filename, "rb"))
+            print("Detector latency profile loaded from: " + self.filename)
+        return
+
+    def save(self):
+        pickle.dump(self.latencySec, open(self.filename, "wb"))
+        print("Detector latency profile written to disk at: " + self.filename)
+
+    """
+    Updates the profile from one run worth of measurements.
+
+    measurements: list of (timeSecPerBlockMeasurements, nextSensor) tuples,
+                  one per direction. timeSecPerBlockMeasurements is the
+                  nested dict from LayoutBlocks, [cvValue][sensor] = [times],
+                  and nextSensor maps each sensor to the sensor that ended
+                  its block in that direction.
+    minimumCvValues: blocks measured at fewer CV values than this are skipped
+
+    returns: True if the profile was updated
+    """
+    def learn(self, measurements, minimumCvValues=3):
+        # each equation reads: latency[endSensor] - latency[startSensor] = offset
+        equations = []
+        for timeSecPerBlockMeasurements, nextSensor in measurements:
+            equations += self._blockOffsets(timeSecPerBlockMeasurements,
+                                            nextSensor, minimumCvValues)
+        if not equations:
+            print("Not enough data to learn detector latencies.")
+            return False
+
+        correction = self._solveLatencies(equations)
+        for sensor in correction.keys():
+            self.latencySec[sensor] = self.getLatency(sensor) + correction[sensor]
+
+        # keep the profile centered on the average detector
+        mean = sum(self.latencySec.values()) * 1.0 / len(self.latencySec)
+        for sensor in self.latencySec.keys():
+            self.latencySec[sensor] -= mean
+
+        print("Detector latencies (sec): " + str(self.latencySec))
+        return True
+
+    """
+    fits the median time of each block against the lap time and returns
+    the intercepts as (startSensor, endSensor, offsetSec) tuples
+    """
+    def _blockOffsets(self, timeSecPerBlockMeasurements, nextSensor, minimumCvValues):
+        # only use CV values where every block of the loop was measured,
+        # otherwise the lap time is missing a piece
+        loopSensors = {}
+        for cv in timeSecPerBlockMeasurements.keys():
+            for sensor in timeSecPerBlockMeasurements[cv].keys():
+                loopSensors[sensor] = True
+        completeCvs = [cv for cv in timeSecPerBlockMeasurements.keys()
+                       if len(timeSecPerBlockMeasurements[cv]) == len(loopSensors)]
+        if len(completeCvs) < minimumCvValues:
+            return []
+
+        blockTimes = {}
+        lapTimes = {}
+        for cv in completeCvs:
+            blockTimes[cv] = {}
+            for sensor in loopSensors.keys():
+                blockTimes[cv][sensor] = median(timeSecPerBlockMeasurements[cv][sensor])
+            lapTimes[cv] = sum(blockTimes[cv].values())
+
+        lapMean = sum(lapTimes.values()) * 1.0 / len(completeCvs)
+        lapVariance = sum([(lapTimes[cv] - lapMean) ** 2 for cv in completeCvs])
+        if lapVariance == 0:
+            return []
+
+        offsets = []
+        for sensor in loopSensors.keys():
+            if sensor not in nextSensor:
+                continue
+            blockMean = sum([blockTimes[cv][sensor] for cv in completeCvs]) * 1.0 / len(completeCvs)
+            covariance = sum([(lapTimes[cv] - lapMean) * (blockTimes[cv][sensor] - blockMean)
+                              for cv in completeCvs])
+            slope = covariance / lapVariance
+            intercept = blockMean - slope * lapMean
+            offsets.append((sensor, nextSensor[sensor], intercept))
+        return offsets
+
+    """
+    least squares solution of latency[end] - latency[start] = offset, using
+    Gauss-Seidel iterations on the normal equations. Latencies are only
+    defined up to a constant, so the solution is kept at zero mean.
+    """
+    def _solveLatencies(self, equations, iterations=2000):
+        latency = {}
+        involved = {}
+        for start, end, offset in equations:
+            latency[start] = 0.0
+            latency[end] = 0.0
+            involved.setdefault(start, []).append((end, -offset))
+            involved.setdefault(end, []).append((start, offset))
+
+        for i in range(iterations):
+            for sensor in involved.keys():
+                estimates = [latency[other] + offset for other, offset in involved[sensor]]
+                latency[sensor] = sum(estimates) * 1.0 / len(estimates)
+
+        mean = sum(latency.values()) * 1.0 / len(latency)
+        for sensor in latency.keys():
+            latency[sensor] -= mean
+        return latency
@@ -0,0 +1,151 @@
+"""
+Watches the block detection sensors and queues every activation in the
+order that JMRI reports it.
+
+Rather than waking up on any sensor change and polling every sensor to
+find out which one went active, we attach a property change listener to
+each sensor. JMRI calls the listener as soon as the sensor state changes,
+and the listener only has to put the sensor name on a thread-safe queue.
+The measurement code then reads one activation at a time off the queue, so
+handling an event doesn't depend on how many sensors are being watched, and
+two sensors going active at nearly the same time simply arrive as two
+events in a row.
+
+Each activation is time stamped inside the listener, using a monotonic
+high resolution clock, so block times don't pick up however long it took
+the measurement thread to wake up. An optional LatencyProfile subtracts
+the known reporting delay of each detector from its time stamps.
+
+Once the sensors of the loop are known (see LayoutBlocks._scopeSensors),
+watchOnly() drops the listeners on every other sensor, so activity
+elsewhere on the layout never reaches the queue.
+"""
+from Utils import monotonicTimeSec
+try:
+    from java.beans import PropertyChangeListener
+except ImportError:
+    # running outside JMRI, e.g. in the Simulator, which calls
+    # propertyChange() on plain Python objects
+    PropertyChangeListener = object
+try:
+    from Queue import Queue, Empty # Jython 2.7
+except ImportError:
+    from queue import Queue, Empty
+
+
+"""
+Gets called by JMRI whenever a property of one sensor changes. We only
+care about the sensor going active.
+"""
+class _SensorListener(PropertyChangeListener):
+    def __init__(self, monitor, sensorName):
+        self.monitor = monitor
+        self.sensorName = sensorName
+
+    def propertyChange(self, event):
+        if ( event.getPropertyName() == "KnownState" and
+             event.getNewValue() == self.monitor.activeState ):
+            self.monitor._addActivation(self.sensorName)
+
+
+class SensorMonitor:
+    """
+    jmriSensors: dict of sensor name to JMRI sensor objects
+    activeState: the JMRI constant for an active sensor (ACTIVE)
+    latencyProfile: optional LatencyProfile used to correct time stamps
+    clock: function returning the current time in seconds
+    idle: optional function to call while waiting for an activation instead
+          of blocking on the queue. The Simulator uses this to move its
+          virtual clock forward.
+    """
+    def __init__(self, jmriSensors, activeState, latencyProfile=None,
+                 clock=monotonicTimeSec, idle=None):
+        self.jmriSensors = jmriSensors
+        self.activeState = activeState
+        self.latencyProfile = latencyProfile
+        self.clock = clock
+        self.idle = idle
+        self.listeners = {}
+        self.activations = Queue()
+        # sensor names to watch, None for all of jmriSensors
+        self.watched = None
+
+    """
+    attaches a listener to each sensor. Activations are queued from here on.
+    """
+    def start(self):
+        for sensor in self.jmriSensors.keys():
+            if self.watched is not None and sensor not in self.watched:
+                continue
+            if sensor not in self.listeners:
+                listener = _SensorListener(self, sensor)
+                self.jmriSensors[sensor].addPropertyChangeListener(listener)
+                self.listeners[sensor] = listener
+        return
+
+    """
+    removes all listeners from the sensors
+    """
+    def stop(self):
+        for sensor in list(self.listeners.keys()):
+            self.jmriSensors[sensor].removePropertyChangeListener(self.listeners[sensor])
+            del self.listeners[sensor]
+        return
+
+    """
+    watches only these sensors from now on, e.g. the ones around the loop.
+    None watches all of them again from the next start().
+    """
+    def watchOnly(self, sensorNames):
+        self.watched = None if sensorNames is None else set(sensorNames)
+        for sensor in list(self.listeners.keys()):
+            if self.watched is not None and sensor not in self.watched:
+                self.jmriSensors[sensor].removePropertyChangeListener(self.listeners[sensor])
+                del self.listeners[sensor]
+        return
+
+    def watchedSensors(self):
+        return sorted(self.listeners.keys())
+
+    """
+    throws away any activations that haven't been read yet, e.g. ones that
+    happened while the locomotive was still changing speed
+    """
+    def clear(self):
+        while True:
+            try:
+                self.activations.get(False)
+            except Empty:
+                break
+        return
+
+    def _addActivation(self, sensor):
+        timeSec = self.clock()
+        if self.latencyProfile:
+            timeSec -= self.latencyProfile.getLatency(sensor)
+        self.activations.put((sensor, timeSec))
+
+    """
+    returns (sensor name, activation time in seconds) for the next sensor
+    that became active, waiting for one if needed
+
+    timeoutSec: raise an exception if nothing activates for this long.
+                None waits forever.
+    """
+    def waitForActivation(self, timeoutSec=None):
+        startTime = self.clock()
+        while True:
+            if self.idle:
+                if not self.activations.empty():
+                    return self.activations.get(False)
+                self.idle()
+            else:
+                # wait in short slices so that stopping the script in JMRI
+                # isn't blocked by a thread waiting on the queue forever
+                try:
+                    return self.activations.get(True, 1.0)
+                except Empty:
+                    pass
+            if (timeoutSec is not None) and (self.clock() - startTime >= timeoutSec):
+                raise Exception("No sensor activation within " +
+                                str(timeoutSec) + " seconds. Is the locomotive stalled?")
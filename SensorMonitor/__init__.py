@@ -0,0 +1,2 @@
+from .SensorMonitor import SensorMonitor
+from .LatencyProfile import LatencyProfile
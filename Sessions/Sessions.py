@@ -0,0 +1,204 @@
+"""
+Calibrates several locomotives at once on a layout with more than one
+independent loop of track, one session per loop.
+
+Each session owns a set of sensors, its measured blocks, and one
+locomotive with its own throttle and programmer, and runs in its own
+automaton thread (see SpeedMatchSession in SpeedMatch.py). The sessions
+share the programming track lock (see ProgrammingQueue) and the fleet
+store, which are safe to use from several threads. Each loop keeps its own
+layout profile and detector latencies, since its blocks and detectors have
+nothing to do with the other loops'.
+
+The sessions are set up in Sessions.json in the data folder. Without that
+file, SpeedMatch calibrates one locomotive as before. For example:
+
+    {"Sessions" : [
+        {"Name" : "Upper",
+         "Sensors" : ["LS1-LS128"],
+         "Ignored Sensors" : ["LS23"],
+         "Measured Block Sensors" : ["LS35"],
+         "Measured Block Lengths (Inches)" : [20.4375],
+         "Locomotive" : {"DCC Address" : 4012, "Maximum Speed" : 60}},
+        {"Name" : "Lower",
+         "Sensors" : ["LS201-LS264"],
+         "Measured Block Sensors" : ["LS235"],
+         "Measured Block Lengths (Inches)" : [20.4375],
+         "Locomotive" : {"DCC Address" : 3, "Filename Suffix" : "B"}}]}
+
+"Locomotive" holds any of the settings from the GUI, which are used for
+whatever a session doesn't set. Every session needs its own DCC address.
+
+From the SpeedMatch-JMRI directory, to check the file:
+    python -m Sessions
+"""
+import json
+import os
+import sys
+
+from Utils import dataFolder
+
+class Session:
+    def __init__(self, name, sensors, measuredBlocks, ignoredSensors=None, locomotive=None):
+        self.name = name
+        # sensor names, in the order they were listed
+        self.sensors = list(sensors)
+        # sensor : length in inches
+        self.measuredBlocks = dict(measuredBlocks)
+        self.ignoredSensors = list(ignoredSensors or [])
+        # settings that replace the ones from the GUI
+        self.locomotive = dict(locomotive or {})
+
+    """
+    returns: the session's sensors without the ignored and bad ones
+    """
+    def monitoredSensors(self, badDetectors=None):
+        bad = set(self.ignoredSensors + list(badDetectors or []))
+        return [el for el in self.sensors if el not in bad]
+
+    """
+    returns: the SpeedMatch data dict of this session - the GUI settings,
+             with the session's locomotive settings and measured blocks
+    """
+    def buildData(self, guiData):
+        data = dict(guiData)
+        data.update(self.locomotive)
+        data["Session"] = self.name
+        data["Measured Block Sensors"] = sorted(self.measuredBlocks.keys())
+        data["Measured Block Lengths (Inches)"] = [self.measuredBlocks[el] for el in
+                                                   data["Measured Block Sensors"]]
+        return data
+
+    def layoutProfileFilename(self):
+        return os.path.join(dataFolder(), "Layout" + self._fileName() + ".lop")
+
+    def latencyProfileFilename(self):
+        return os.path.join(dataFolder(), "DetectorLatency" + self._fileName() + ".dlp")
+
+    def _fileName(self):
+        return "".join([el for el in self.name if el.isalnum()])
+
+"""
+expands sensor ranges like "LS1-LS128" into LS1, LS2, ... LS128. Other
+names are kept as they are.
+"""
+def expandSensorNames(entries):
+    names = []
+    for entry in entries:
+        entry = str(entry)
+        parts = entry.split("-")
+        if len(parts) == 2:
+            first = _splitSensorName(parts[0])
+            last = _splitSensorName(parts[1])
+            if first[0] is not None and first[0] == last[0]:
+                names.extend([first[0] + str(el) for el in range(first[1], last[1] + 1)])
+                continue
+        names.append(entry)
+    return names
+
+"""
+returns: (prefix, number) of a sensor name like LS235, or (None, None)
+"""
+def _splitSensorName(name):
+    digits = len(name)
+    while digits > 0 and name[digits - 1].isdigit():
+        digits -= 1
+    if digits == 0 or digits == len(name):
+        return None, None
+    return name[:digits], int(name[digits:])
+
+def _text(value):
+    # json gives unicode strings under Jython 2.7
+    if isinstance(value, list):
+        return [_text(el) for el in value]
+    if isinstance(value, dict):
+        return dict([(_text(key), _text(value[key])) for key in value.keys()])
+    if not isinstance(value, (int, float, bool)) and value is not None:
+        return str(value)
+    return value
+
+"""
+reads the sessions from Sessions.json in the data folder
+
+returns: list of Session, empty if there's no file
+"""
+def loadSessions(filename=None):
+    if filename is None:
+        filename = os.path.join(dataFolder(), "Sessions.json")
+    if not os.path.exists(filename):
+        return []
+    f = open(filename, "r")
+    try:
+        config = _text(json.load(f))
+    finally:
+        f.close()
+    sessions = []
+    for entry in config.get("Sessions", []):
+        measuredSensors = entry.get("Measured Block Sensors", [])
+        measuredLengths = entry.get("Measured Block Lengths (Inches)", [])
+        if not len(measuredSensors) == len(measuredLengths):
+            raise Exception("Session " + str(entry.get("Name")) + " in " + filename +
+                            ": measured block sensors and lengths don't match up")
+        sessions.append(Session(entry.get("Name", "Session" + str(len(sessions) + 1)),
+                                expandSensorNames(entry.get("Sensors", [])),
+                                dict(zip(measuredSensors, measuredLengths)),
+                                expandSensorNames(entry.get("Ignored Sensors", [])),
+                                entry.get("Locomotive")))
+    return sessions
+
+"""
+returns: list of problems that keep the sessions from running side by
+         side, empty if there are none
+"""
+def checkSessions(sessions):
+    problems = []
+    names = {}
+    owners = {}
+    locomotives = {}
+    for session in sessions:
+        if session.name in names:
+            problems.append("Session name " + session.name + " is used twice")
+        names[session.name] = session
+        if not session.sensors:
+            problems.append("Session " + session.name + " has no sensors")
+        if not session.measuredBlocks:
+            problems.append("Session " + session.name + " has no measured blocks")
+        for sensor in session.sensors:
+            if sensor in owners and not owners[sensor] == session.name:
+                problems.append("Sensor " + sensor + " is in sessions " + owners[sensor] +
+                                " and " + session.name)
+            owners[sensor] = session.name
+        for sensor in session.measuredBlocks.keys():
+            if sensor not in session.monitoredSensors():
+                problems.append("Measured block " + sensor + " of session " + session.name +
+                                " isn't one of its (working) sensors")
+        address = session.locomotive.get("DCC Address")
+        if address is None:
+            problems.append("Session " + session.name + " has no DCC Address")
+            continue
+        key = (address, str(session.locomotive.get("Filename Suffix", "")))
+        if key in locomotives:
+            problems.append("Sessions " + locomotives[key] + " and " + session.name +
+                            " both drive locomotive " + str(address) + key[1])
+        locomotives[key] = session.name
+    return problems
+
+def main():
+    sessions = loadSessions()
+    if not sessions:
+        print("No sessions in " + os.path.join(dataFolder(), "Sessions.json") +
+              " - SpeedMatch calibrates one locomotive at a time")
+        return
+    for session in sessions:
+        print(session.name + ": " + str(len(session.monitoredSensors())) + " sensors, " +
+              "measured blocks " + ", ".join(sorted(session.measuredBlocks.keys())) +
+              ", locomotive " + str(session.locomotive.get("DCC Address")) +
+              str(session.locomotive.get("Filename Suffix", "")))
+    problems = checkSessions(sessions)
+    for problem in problems:
+        print("ERROR: " + problem)
+    if problems:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+from .Sessions import Session, loadSessions, checkSessions, expandSensorNames
@@ -0,0 +1,3 @@
+from .Sessions import main
+
+main()
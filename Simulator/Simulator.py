@@ -0,0 +1,533 @@
+"""
+Headless stand-in for a layout, so that a calibration can run without JMRI.
+
+The Simulator plays the part of the SpeedMatch automaton: it provides
+waitMsec, getThrottle and addressedProgrammers, and its sensors, throttle
+and programmer behave like the JMRI objects the rest of the code talks to.
+Time is virtual - waitMsec moves a simulated locomotive around a loop of
+blocks instead of sleeping - so a calibration that takes hours on the
+layout finishes in seconds, and EngineWarmer, LayoutBlocks and
+SpeedTableBuilder run unchanged through Calibration.
+
+The loop is a list of blocks, each with a sensor name, a length in inches
+and a grade in percent (uphill when driving forward). The locomotive's
+speed follows the decoder CVs the way a real decoder does: the throttle
+setting picks a point in the 28 step speed table (CV67-94), scaled by the
+forward or reverse trim (CV66/CV95), and CV3/CV4 momentum slow down speed
+changes. The motor needs some voltage before it moves at all, climbs
+slower on grades, and can run at a different speed in reverse. Detectors
+report with a fixed latency per sensor plus random jitter, and the
+locomotive occasionally stalls on dirty track. Sensors elsewhere on the
+layout can go active at random, as if other trains were running, and
+flaky detectors on the loop flicker while occupied and go active now and
+then while they aren't.
+
+Run a simulated calibration from the repository directory with
+    python -m Simulator
+"""
+import heapq
+import random
+import tempfile
+from math import exp
+
+from SensorMonitor import SensorMonitor
+from RunProfiler import RunProfiler, profileBasename
+from Utils import setDataFolder
+
+ACTIVE = 2
+INACTIVE = 4
+
+"""
+Time in the simulation, in seconds. Stands in for the monotonic clock.
+"""
+class VirtualClock:
+    def __init__(self):
+        self.timeSec = 0.0
+
+    def now(self):
+        return self.timeSec
+
+
+class _PropertyChangeEvent:
+    def __init__(self, source, propertyName, oldValue, newValue):
+        self.source = source
+        self.propertyName = propertyName
+        self.oldValue = oldValue
+        self.newValue = newValue
+
+    def getSource(self):
+        return self.source
+
+    def getPropertyName(self):
+        return self.propertyName
+
+    def getOldValue(self):
+        return self.oldValue
+
+    def getNewValue(self):
+        return self.newValue
+
+
+class SimulatedSensor:
+    def __init__(self, name):
+        self.name = name
+        self.state = INACTIVE
+        self.listeners = []
+
+    def getKnownState(self):
+        return self.state
+
+    def setKnownState(self, state):
+        if state == self.state:
+            return
+        event = _PropertyChangeEvent(self, "KnownState", self.state, state)
+        self.state = state
+        for listener in list(self.listeners):
+            listener.propertyChange(event)
+
+    def addPropertyChangeListener(self, listener):
+        self.listeners.append(listener)
+
+    def removePropertyChangeListener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+
+"""
+Throttle. Like the JMRI throttle in Jython, speedSetting is set as an
+attribute; 0.0 to 1.0.
+"""
+class SimulatedThrottle:
+    def __init__(self):
+        self.speedSetting = 0.0
+        self.isForward = True
+        self.functions = {}
+
+    def setIsForward(self, forward):
+        self.isForward = forward
+
+    def getIsForward(self):
+        return self.isForward
+
+    def setF2(self, state):
+        self.functions[2] = state
+
+
+"""
+Ops mode programmer. Each write takes writeLatencySec of simulated time
+and is then confirmed to the listener, like a JMRI ProgListener reply.
+"""
+class SimulatedProgrammer:
+    def __init__(self, simulator, writeLatencySec=0.1):
+        self.simulator = simulator
+        self.writeLatencySec = writeLatencySec
+        self.writes = 0
+
+    def writeCV(self, cvName, value, listener):
+        self.simulator.advance(self.writeLatencySec)
+        self.simulator.locomotive.cvs[int(cvName)] = int(value)
+        self.writes += 1
+        if listener is not None:
+            listener.programmingOpReply(int(value), 0)
+
+
+class SimulatedProgrammerManager:
+    def __init__(self, programmer):
+        self.programmer = programmer
+
+    def getAddressedProgrammer(self, longAddress, address):
+        return self.programmer
+
+
+"""
+maxSpeedInchesPerSec: speed at full voltage on level track
+startVoltage: fraction of full voltage needed before the motor turns
+curveExponent: above the start voltage, speed ~ voltage ** curveExponent
+reverseGain: reverse speed relative to forward speed
+gradeSensitivity: speed lost per percent of grade, as a fraction
+lengthInches: length of the locomotive, for block occupancy
+"""
+class SimulatedLocomotive:
+    def __init__(self, maxSpeedInchesPerSec=16.0, startVoltage=0.04,
+                 curveExponent=1.1, reverseGain=0.95, gradeSensitivity=0.04,
+                 lengthInches=8.0, coldSlowdown=0.0, warmUpMinutes=4.0):
+        self.maxSpeedInchesPerSec = maxSpeedInchesPerSec
+        self.startVoltage = startVoltage
+        self.curveExponent = curveExponent
+        self.reverseGain = reverseGain
+        self.gradeSensitivity = gradeSensitivity
+        self.lengthInches = lengthInches
+        # a cold engine runs this fraction slower, warming up with a time
+        # constant of warmUpMinutes of running
+        self.coldSlowdown = coldSlowdown
+        self.warmUpMinutes = warmUpMinutes
+        self.runningSec = 0.0
+        # factory reset decoder: CV29 = 6 means no speed table
+        self.cvs = {2: 0, 3: 0, 4: 0, 5: 255, 29: 6, 66: 0, 95: 0}
+        for cv in range(67, 95):
+            self.cvs[cv] = int(round(255.0 * (cv - 66) / 28))
+        # motor voltage that momentum is moving towards / currently at
+        self.voltage = 0.0
+        self.forward = True
+
+    """
+    decoder output voltage (0.0 to 1.0) for a throttle setting
+    """
+    def targetVoltage(self, speedSetting, forward):
+        if speedSetting <= 0:
+            return 0.0
+        if self.cvs.get(29, 6) & 16:
+            # speed table, interpolated between the 28 steps
+            step = min(speedSetting * 28, 28.0)
+            low = int(step)
+            fraction = step - low
+            lowValue = self.cvs.get(66 + low, 0) if low > 0 else 0
+            highValue = self.cvs.get(66 + min(low + 1, 28), 0)
+            value = lowValue + fraction * (highValue - lowValue)
+        else:
+            vStart = self.cvs.get(2, 0)
+            value = vStart + speedSetting * (255 - vStart)
+
+        trim = self.cvs.get(66 if forward else 95, 0)
+        if trim > 0:
+            value = value * trim / 128.0
+        return min(value, 255.0) / 255.0
+
+    """
+    moves the motor voltage towards the target, limited by momentum
+    """
+    def updateVoltage(self, speedSetting, forward, dtSec):
+        if not forward == self.forward:
+            # decoders stop before changing direction
+            self.forward = forward
+            self.voltage = 0.0
+        target = self.targetVoltage(speedSetting, forward)
+        momentumCv = self.cvs.get(3, 0) if target > self.voltage else self.cvs.get(4, 0)
+        if momentumCv == 0:
+            self.voltage = target
+            return
+        # NMRA: CV3/CV4 * 0.896 seconds from stop to full speed
+        maxChange = dtSec / (momentumCv * 0.896)
+        if abs(target - self.voltage) <= maxChange:
+            self.voltage = target
+        elif target > self.voltage:
+            self.voltage += maxChange
+        else:
+            self.voltage -= maxChange
+
+    """
+    speed in inches per second on a block with this grade
+    """
+    def speed(self, gradePercent):
+        if self.voltage <= self.startVoltage:
+            return 0.0
+        effective = (self.voltage - self.startVoltage) / (1.0 - self.startVoltage)
+        speed = self.maxSpeedInchesPerSec * effective ** self.curveExponent
+        speed *= 1.0 - self.coldSlowdown * exp(-self.runningSec / (60.0 * self.warmUpMinutes))
+        if not self.forward:
+            speed *= self.reverseGain
+            gradePercent = -gradePercent
+        return max(speed * (1.0 - self.gradeSensitivity * gradePercent), 0.0)
+
+
+"""
+blocks: list of (sensor name, length in inches, grade in percent), in the
+        order the locomotive passes them when driving forward
+detectorLatencySec: dict of sensor name to reporting delay in seconds
+jitterSec: standard deviation of random detector delay
+stallsPerHour: how often the locomotive stalls on dirty track
+stallSec: how long a stall lasts, at most
+locomotive: SimulatedLocomotive, or None for the defaults
+timeStepSec: integration step of the simulation
+seed: random seed, for repeatable runs
+"""
+class Simulator:
+    def __init__(self, blocks, detectorLatencySec=None, jitterSec=0.005,
+                 stallsPerHour=2.0, stallSec=1.5, locomotive=None,
+                 timeStepSec=0.02, seed=1, otherSensors=None, otherActivationsPerHour=0.0,
+                 flakySensors=None, flickersPerSec=0.0):
+        self.blocks = blocks
+        self.detectorLatencySec = detectorLatencySec or {}
+        self.jitterSec = jitterSec
+        self.stallsPerHour = stallsPerHour
+        self.stallSec = stallSec
+        self.locomotive = locomotive or SimulatedLocomotive()
+        self.timeStepSec = timeStepSec
+        self.random = random.Random(seed)
+
+        self.clock = VirtualClock()
+        self.sensors = {}
+        for sensor, length, grade in blocks:
+            self.sensors[sensor] = SimulatedSensor(sensor)
+        # sensors that aren't on the loop, with random activity
+        self.otherSensors = list(otherSensors or [])
+        self.otherActivationsPerHour = otherActivationsPerHour
+        for sensor in self.otherSensors:
+            self.sensors[sensor] = SimulatedSensor(sensor)
+        # loop sensors with bad detectors
+        self.flakySensors = list(flakySensors or [])
+        self.flickersPerSec = flickersPerSec
+        self.throttle = SimulatedThrottle()
+        self.programmer = SimulatedProgrammer(self)
+        self.addressedProgrammers = SimulatedProgrammerManager(self.programmer)
+        self.data = None
+
+        # block start positions along the loop
+        self.blockStarts = []
+        position = 0.0
+        for sensor, length, grade in blocks:
+            self.blockStarts.append(position)
+            position += length
+        self.loopLength = position
+
+        # front of the locomotive, in inches along the loop, and the
+        # number of ends of the locomotive inside each block
+        self.position = blocks[0][1] * 0.5
+        self.stalledUntil = -1.0
+        self.pendingSensorChanges = []
+        self.sequence = 0
+        self._setInitialOccupancy()
+
+    def _blockIndexAt(self, position):
+        position = position % self.loopLength
+        for i in range(len(self.blockStarts) - 1, -1, -1):
+            if position >= self.blockStarts[i]:
+                return i
+        return 0
+
+    def _setInitialOccupancy(self):
+        front = self._blockIndexAt(self.position)
+        rear = self._blockIndexAt(self.position - self.locomotive.lengthInches)
+        i = rear
+        while True:
+            self.sensors[self.blocks[i][0]].state = ACTIVE
+            if i == front:
+                break
+            i = (i + 1) % len(self.blocks)
+
+    """
+    automaton calls
+    """
+    def waitMsec(self, milliseconds):
+        self.advance(milliseconds / 1000.0)
+
+    def waitChange(self, sensorList):
+        states = [sensor.getKnownState() for sensor in sensorList]
+        while states == [sensor.getKnownState() for sensor in sensorList]:
+            self.advance(self.timeStepSec)
+
+    def getThrottle(self, address, longAddress):
+        return self.throttle
+
+    def _scheduleSensorChange(self, timeSec, sensor, state):
+        delay = self.detectorLatencySec.get(sensor, 0.0)
+        delay += abs(self.random.gauss(0.0, self.jitterSec))
+        self.sequence += 1
+        heapq.heappush(self.pendingSensorChanges,
+                       (timeSec + delay, self.sequence, sensor, state))
+
+    def _deliverSensorChanges(self, untilSec):
+        while self.pendingSensorChanges and self.pendingSensorChanges[0][0] <= untilSec:
+            timeSec, sequence, sensor, state = heapq.heappop(self.pendingSensorChanges)
+            # listeners time stamp the change, so it has to happen "now"
+            self.clock.timeSec = max(self.clock.timeSec, timeSec)
+            self.sensors[sensor].setKnownState(state)
+
+    """
+    which block boundaries one end of the locomotive crossed, moving from
+    oldPosition to newPosition
+
+    returns: list of (fraction of the step, block index entered, block
+             index left)
+    """
+    def _boundaryCrossings(self, oldPosition, newPosition):
+        crossings = []
+        n = len(self.blocks)
+        low = min(oldPosition, newPosition)
+        high = max(oldPosition, newPosition)
+        lap = int(low // self.loopLength) * self.loopLength
+        while lap <= high:
+            for i in range(n):
+                boundary = lap + self.blockStarts[i]
+                if low < boundary <= high:
+                    fraction = (boundary - oldPosition) / (newPosition - oldPosition)
+                    if newPosition > oldPosition:
+                        crossings.append((fraction, i, (i - 1) % n))
+                    else:
+                        crossings.append((fraction, (i - 1) % n, i))
+            lap += self.loopLength
+        crossings.sort()
+        return crossings
+
+    """
+    a flaky detector drops out for a moment while occupied, and goes active
+    by itself now and then (a twentieth as often) while it isn't
+    """
+    def _flicker(self, sensor, timeSec, dt):
+        occupied = self.sensors[sensor].state == ACTIVE
+        rate = self.flickersPerSec if occupied else self.flickersPerSec / 20.0
+        if self.random.random() >= rate * dt:
+            return
+        first, second = (INACTIVE, ACTIVE) if occupied else (ACTIVE, INACTIVE)
+        for delay, state in [(0.0, first), (0.1, second)]:
+            self.sequence += 1
+            heapq.heappush(self.pendingSensorChanges,
+                           (timeSec + delay, self.sequence, sensor, state))
+
+    """
+    runs the simulation forward by durationSec
+    """
+    def advance(self, durationSec):
+        endTime = self.clock.timeSec + durationSec
+        while self.clock.timeSec < endTime:
+            startTime = self.clock.timeSec
+            dt = min(self.timeStepSec, endTime - startTime)
+            loco = self.locomotive
+            loco.updateVoltage(self.throttle.speedSetting, self.throttle.isForward, dt)
+            if loco.voltage > loco.startVoltage:
+                loco.runningSec += dt
+
+            grade = self.blocks[self._blockIndexAt(self.position)][2]
+            speed = loco.speed(grade)
+            if speed > 0 and startTime >= self.stalledUntil:
+                if self.random.random() < self.stallsPerHour * dt / 3600.0:
+                    self.stalledUntil = startTime + self.random.uniform(0.2, self.stallSec)
+            if startTime < self.stalledUntil:
+                speed = 0.0
+
+            distance = speed * dt if loco.forward else -speed * dt
+            if distance:
+                front = self.position
+                rear = self.position - loco.lengthInches
+                # the leading end activates blocks, the trailing end frees them
+                if loco.forward:
+                    leading, trailing = front, rear
+                else:
+                    leading, trailing = rear, front
+                for fraction, entered, left in self._boundaryCrossings(leading, leading + distance):
+                    self._scheduleSensorChange(startTime + fraction * dt,
+                                               self.blocks[entered][0], ACTIVE)
+                for fraction, entered, left in self._boundaryCrossings(trailing, trailing + distance):
+                    self._scheduleSensorChange(startTime + fraction * dt,
+                                               self.blocks[left][0], INACTIVE)
+                self.position = (self.position + distance) % self.loopLength
+
+            if self.otherSensors and \
+               self.random.random() < self.otherActivationsPerHour * dt / 3600.0:
+                sensor = self.random.choice(self.otherSensors)
+                self._scheduleSensorChange(startTime, sensor, ACTIVE)
+                self._scheduleSensorChange(startTime + 5.0, sensor, INACTIVE)
+
+            for sensor in self.flakySensors:
+                self._flicker(sensor, startTime, dt)
+
+            self._deliverSensorChanges(startTime + dt)
+            self.clock.timeSec = max(self.clock.timeSec, startTime + dt)
+        return
+
+    """
+    Builds the data dict that the GUI and SpeedMatch would, for this layout.
+
+    measuredBlocks: dict of sensor name to measured length in inches
+    settings: GUI values to override, e.g. {"Maximum Speed" : 40}
+    """
+    def buildData(self, measuredBlocks, settings=None, latencyProfile=None,
+                  layoutProfile=None):
+        data = {"DCC Address" : 3,
+                "Filename Suffix" : "",
+                "Save Measurements" : True,
+                "Load Measurements" : False,
+                "Resume Measurements" : False,
+                "Warm Up Until Stable" : True,
+                "Use Roster CVs" : False,
+                "Decoder" : "Other",
+                "Scale" : 87.1,
+                "CV3" : 5,
+                "CV4" : 5,
+                "vStart" : 0,
+                "Maximum Speed" : 60}
+        if settings:
+            data.update(settings)
+        measuredSensors = sorted(measuredBlocks.keys())
+        data["Measured Block Sensors"] = measuredSensors
+        data["Measured Block Lengths (Inches)"] = [measuredBlocks[el] for el in measuredSensors]
+        data["JMRI Sensors"] = self.sensors
+        data["JMRI Sensor Active Const"] = ACTIVE
+        data["Sensor Monitor"] = SensorMonitor(self.sensors, ACTIVE, latencyProfile,
+                                               clock=self.clock.now,
+                                               idle=lambda: self.advance(0.05))
+        data["Detector Latency Profile"] = latencyProfile
+        data["Layout Profile"] = layoutProfile
+        data["Ignored Sensors"] = []
+        data["Run Profiler"] = RunProfiler(clock=self.clock.now)
+        self.data = data
+        return data
+
+
+"""
+An 80 foot loop of 24 blocks of different lengths, with a grade on one
+side, and a couple of slow detectors
+"""
+def exampleLayout():
+    blocks = []
+    for i in range(24):
+        length = 30.0 + 10.0 * ((i * 7) % 5)
+        grade = 1.5 if 4 <= i < 10 else (-1.5 if 14 <= i < 20 else 0.0)
+        blocks.append(("LS" + str(201 + 2 * i), length, grade))
+    latency = {"LS209" : 0.25, "LS231" : 0.12}
+    return blocks, latency
+
+
+def main():
+    import argparse
+    from Calibration import Calibration
+    from LayoutBlocks import LayoutProfile
+
+    parser = argparse.ArgumentParser(description="Simulated speed matching calibration")
+    parser.add_argument("--smph", type=float, default=60, help="maximum speed to calibrate to")
+    parser.add_argument("--max-speed", type=float, default=16.0,
+                        help="locomotive top speed in inches per second")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cold", type=float, default=0.0,
+                        help="fraction slower the locomotive runs before it's warmed up")
+    parser.add_argument("--timed-warm-up", action="store_true",
+                        help="warm up for 5 minutes rather than until lap times settle")
+    parser.add_argument("--plateaus", action="store_true",
+                        help="measure on a plateau speed table rather than programming "
+                             "every CV value")
+    parser.add_argument("--plateau-width", type=int, default=3,
+                        help="speed steps per plateau")
+    parser.add_argument("--other-traffic", type=float, default=0.0,
+                        help="activations per hour of sensors elsewhere on the layout")
+    parser.add_argument("--flaky", type=float, default=0.0,
+                        help="flickers per second of two bad detectors on the loop")
+    parser.add_argument("--runs", type=int, default=1,
+                        help="calibrate this many locomotives one after the other, "
+                             "sharing the layout profile")
+    args = parser.parse_args()
+
+    setDataFolder(tempfile.mkdtemp(prefix="SpeedMatchSimulation"))
+    blocks, latency = exampleLayout()
+    measuredSensor, measuredLength, grade = blocks[12]
+    layoutProfile = LayoutProfile()
+    tables = []
+    for run in range(args.runs):
+        locomotive = SimulatedLocomotive(maxSpeedInchesPerSec=args.max_speed,
+                                         coldSlowdown=args.cold)
+        simulator = Simulator(blocks, latency, locomotive=locomotive, seed=args.seed + run,
+                              otherSensors=["LS" + str(el) for el in range(1, 41)],
+                              otherActivationsPerHour=args.other_traffic,
+                              flakySensors=["LS213", "LS239"], flickersPerSec=args.flaky)
+        data = simulator.buildData({measuredSensor : measuredLength},
+                                   {"Maximum Speed" : args.smph, "DCC Address" : 3 + run,
+                                    "Warm Up Until Stable" : not args.timed_warm_up,
+                                    "Plateau Speed Table" : args.plateaus,
+                                    "Plateau Width" : args.plateau_width},
+                                   layoutProfile=layoutProfile)
+        tables.append(Calibration(simulator, data).run())
+        data["Run Profiler"].report(profileBasename(data))
+        print("Simulated time: " + str(round(simulator.clock.now() / 3600.0, 2)) + " hours")
+    return tables
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+from .Simulator import Simulator, SimulatedLocomotive, VirtualClock, exampleLayout
@@ -0,0 +1,3 @@
+from .Simulator import main
+
+main()
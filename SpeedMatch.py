@@ -1,8 +1,7 @@
 import jmri
 import os
 import sys
-import java #needed?
-import javax.swing #needed?
+import threading
 
 # This package needs to be placed in the JMRI scripts directory
 # set subdirectory as appropriate below
@@ -15,12 +14,37 @@ if package_path not in sys.path:
 
 
 from GUI import GUI
-from Throttle import Throttle, EngineWarmer, Program
-from LayoutBlocks import LayoutBlocks
-from SpeedTableBuilder import SpeedTableBuilder
+from Calibration import Calibration
+from LayoutBlocks import LayoutProfile
+from SensorMonitor import SensorMonitor, LatencyProfile
+from Sessions import loadSessions, checkSessions
+from RunProfiler import RunProfiler, profileBasename
 from Utils import RedirectStdErr
 
 
+"""
+Looks up the sensors to watch and sets up a SensorMonitor for them.
+
+sensorNames: all sensors that may be watched
+ignoredSensors: faulty sensors to leave out
+layoutProfile: LayoutProfile (already loaded) whose bad detectors are left
+               out too, or None
+latencyProfile: LatencyProfile (already loaded) to correct the sensor time
+                stamps with, or None
+
+returns: ({sensor name : JMRI sensor}, SensorMonitor)
+"""
+def setUpSensors(sensorNames, ignoredSensors, layoutProfile, latencyProfile):
+    badDetectors = list(ignoredSensors)
+    if layoutProfile:
+        badDetectors += layoutProfile.getBadDetectors()
+    jmriSensors = {}
+    for sensor in sensorNames:
+        if not sensor in badDetectors:
+            jmriSensors[sensor] = sensors.provideSensor(sensor)
+    return jmriSensors, SensorMonitor(jmriSensors, ACTIVE, latencyProfile)
+
+
 class SpeedMatch(jmri.jmrit.automat.AbstractAutomaton):
     def __init__(self):
         self.data = None
@@ -31,39 +55,114 @@ class SpeedMatch(jmri.jmrit.automat.AbstractAutomaton):
         self.measuredBlocks = {"Measured Block Sensors" : ["LS235", ],
                                "Measured Block Lengths (Inches)" : [20.4375, ]}
         self.ignoredSensors = ["LS223", "LS225", "LS227", "LS253", "LS264"] # faulty sensors to ignore
+        # sensors that may be on the loop, watched until the loop is known.
+        # Set this to cover your loop's sensors.
+        self.sensorNames = ["LS" + str(el) for el in range(1, 513)]
+        # correct sensor time stamps for detectors that are slow to report.
+        # The per-detector latencies are learned from every calibration run.
+        self.useDetectorLatencyProfile = True
+        # remember block lengths, the sensor sequence and bad detectors
+        # from one calibration to the next (see LayoutProfile)
+        self.useLayoutProfile = True
 
         self._sensorSetup()
         return
 
     @RedirectStdErr
     def _sensorSetup(self):
-        # we want to watch any block, but the JMRI API asks us to
-        # list the block names. So just list a lot of them here. Note that
-        # each block starts a new listener thread (??), so when one lists
-        # all 4096 blocks, at least my machine - a 6 core intel i5-10500T -
-        # manages to have JMRI hang when firing up the script.
-        self.completeSensorList = list(range(1,513))
-        self.completeSensorList = ["LS" + str(el) for el in self.completeSensorList]
-        self.monitoredSensors = [el for el in self.completeSensorList
-                                 if not el in self.ignoredSensors ]
-        self.jmriSensors = {}
-        for sensor in self.monitoredSensors:
-            self.jmriSensors[sensor] = sensors.provideSensor(sensor)
+        # we want to watch any block. Sensors are watched with property
+        # change listeners that queue activations (see SensorMonitor), which
+        # is cheap per sensor, so a long list is fine. JMRI's sensor table
+        # isn't enough: after a fresh start it only has the sensors that
+        # reported already, so the sensors are provided by name. Once the
+        # layout profile knows the loop, only its sensors are needed. During
+        # a calibration, only the sensors around the loop are watched: those
+        # the layout profile knows, or those seen on a discovery lap (see
+        # LayoutBlocks._scopeSensors). The earlier approach of calling
+        # waitChange() on every sensor hung JMRI when all 4096 blocks were
+        # listed.
+        self.layoutProfile = None
+        if self.useLayoutProfile:
+            self.layoutProfile = LayoutProfile()
+            self.layoutProfile.load()
+        self.completeSensorList = list(self.measuredBlocks["Measured Block Sensors"])
+        if self.layoutProfile and self.layoutProfile.getSequence():
+            loopSensors = self.layoutProfile.getSequence()
+        else:
+            loopSensors = self.sensorNames
+        self.completeSensorList += [el for el in loopSensors
+                                    if el not in self.completeSensorList]
+        self.latencyProfile = None
+        if self.useDetectorLatencyProfile:
+            self.latencyProfile = LatencyProfile()
+            self.latencyProfile.load()
+        self.jmriSensors, self.sensorMonitor = setUpSensors(
+            self.completeSensorList, self.ignoredSensors, self.layoutProfile, self.latencyProfile)
+
+        # one locomotive per loop at the same time, if Sessions.json says so
+        self.sessions = [SpeedMatchSession(el, self) for el in self.loadSessions()]
+
+    """
+    returns: the Sessions from Sessions.json in the data folder, empty
+             without one
+    """
+    def loadSessions(self):
+        sessions = loadSessions()
+        problems = checkSessions(sessions)
+        if problems:
+            raise Exception("Can't run the sessions in Sessions.json: " + "; ".join(problems))
+        return sessions
 
     @RedirectStdErr
     def main(self):
         def runTest(guiInstance):
+            if self.sessions:
+                self._startSessions(guiInstance.getData())
+                return
             self.data = guiInstance.getData()
             # TODO move measured blocks to a config file or the GUI
             self.data = dict(self.data.items() + self.measuredBlocks.items())
             self.data["JMRI Sensors"] = self.jmriSensors
             self.data["JMRI Sensor Active Const"] = ACTIVE
+            self.data["Sensor Monitor"] = self.sensorMonitor
+            self.data["Detector Latency Profile"] = self.latencyProfile
+            self.data["Layout Profile"] = self.layoutProfile
+            self.data["Ignored Sensors"] = self.ignoredSensors
+            self.data["GUI"] = self.gui
             self.start() #calls self.handle() via JMRI
 
         self.gui = GUI(runTest)
         self.gui.displayGui()
         return
 
+    def _startSessions(self, guiData):
+        print("Calibrating " + str(len(self.sessions)) + " locomotives at once: " +
+              ", ".join([el.session.name for el in self.sessions]))
+        self.sessionsRunning = len(self.sessions)
+        self.sessionLock = threading.Lock()
+        jmri.InstanceManager.getDefault(jmri.PowerManager).setPower(jmri.PowerManager.ON)
+        for session in self.sessions:
+            session.setData(guiData)
+            session.setName("SpeedMatch " + session.session.name)
+            session.start()
+
+    """
+    called by each SpeedMatchSession when it's done, successful or not.
+    The last one turns the layout power off.
+    """
+    def sessionFinished(self, session):
+        self.sessionLock.acquire()
+        try:
+            self.sessionsRunning -= 1
+            last = self.sessionsRunning == 0
+        finally:
+            self.sessionLock.release()
+        print("Session " + session.session.name + " done")
+        if last:
+            jmri.InstanceManager.getDefault(jmri.PowerManager).setPower(jmri.PowerManager.OFF)
+            print("Speed Match Script Done")
+            self.gui.closeWindow()
+
     """
     This method runs when the user clicks the 'start' button
     """
@@ -71,48 +170,18 @@ class SpeedMatch(jmri.jmrit.automat.AbstractAutomaton):
     def handle(self):
         print(self.data)
 
-        # get throttle
         self.addressedProgrammers = addressedProgrammers #TODO: Not very elegant
-        t = Throttle(speedMatchInstance=self, dccaddress=self.data["DCC Address"])
-        p = Program(speedMatchInstance=self, throttleInstance = t)
+        # record where the time goes
+        self.data["Run Profiler"] = RunProfiler()
         # turn on layout power
         jmri.InstanceManager.getDefault(jmri.PowerManager).setPower(jmri.PowerManager.ON)
 
-        # set momentum CVs to 1 for measurements
-        p.programCv(cvNumber=3, cvValue=1)
-        p.programCv(cvNumber=4, cvValue=1)
-        p.programCv(cvNumber=2, cvValue=int(self.data["vStart"]))
-        p.disableTrim()
-        p.disableManufacturerSpeedTables()
-
-        # warm up engine
-        ew = EngineWarmer(speedMatchInstance=self, throttleInstance=t)
-        if not self.data["Load Measurements"]:
-            ew.warmUp(minutes=5)
-
-        # measure layout blocks
-        p.enableSpeedTable()
-        lb = LayoutBlocks(speedMatchInstance=self, throttleInstance=t, data=self.data)
-        lb.computeMeasuredBlockTopSpeedTime()
-        lb.measureBlockTimes()
-
-        # Compute speed table
-        stb = SpeedTableBuilder(layoutBlocksInstance = lb)
-        stb.preprocessCvToBlockTimeDataTables()
-        table28Steps = stb.buildSpeedTableForMeasuredBlocks()
-        print("Computed Speed Table: ", table28Steps)
-
-        # Program speed table and requested momentum cvs
-        p.programSpeedTable(table28Steps)
-        p.programCv(cvNumber=3, cvValue=self.data["CV3"])
-        p.programCv(cvNumber=4, cvValue=self.data["CV4"])
-        print("Table programming complete. Locomotive programmed to " +
-              str(self.data["Maximum Speed"]) + "SMPH")
+        Calibration(speedMatchInstance=self, data=self.data).run()
 
         # Turn off layout power
         jmri.InstanceManager.getDefault(jmri.PowerManager).setPower(jmri.PowerManager.OFF)
 
-
+        self.data["Run Profiler"].report(profileBasename(self.data))
 
         print("Speed Match Script Done")
         self.gui.closeWindow()
@@ -121,5 +190,55 @@ class SpeedMatch(jmri.jmrit.automat.AbstractAutomaton):
         return False
 
 
+"""
+Calibrates one locomotive on one loop, alongside other sessions (see
+Sessions). Each session is its own automaton, so its throttle and
+programmer calls run on its own thread, and has its own sensors, sensor
+monitor, layout profile and detector latencies.
+"""
+class SpeedMatchSession(jmri.jmrit.automat.AbstractAutomaton):
+    def __init__(self, session, speedMatch):
+        self.session = session
+        self.speedMatch = speedMatch
+        self.data = None
+        self._sensorSetup()
+
+    @RedirectStdErr
+    def _sensorSetup(self):
+        self.layoutProfile = None
+        if self.speedMatch.useLayoutProfile:
+            self.layoutProfile = LayoutProfile(self.session.layoutProfileFilename())
+            self.layoutProfile.load()
+        self.latencyProfile = None
+        if self.speedMatch.useDetectorLatencyProfile:
+            self.latencyProfile = LatencyProfile(self.session.latencyProfileFilename())
+            self.latencyProfile.load()
+        self.jmriSensors, self.sensorMonitor = setUpSensors(
+            self.session.sensors, self.session.ignoredSensors,
+            self.layoutProfile, self.latencyProfile)
+
+    def setData(self, guiData):
+        self.data = self.session.buildData(guiData)
+        self.data["JMRI Sensors"] = self.jmriSensors
+        self.data["JMRI Sensor Active Const"] = ACTIVE
+        self.data["Sensor Monitor"] = self.sensorMonitor
+        self.data["Detector Latency Profile"] = self.latencyProfile
+        self.data["Layout Profile"] = self.layoutProfile
+        self.data["Ignored Sensors"] = self.session.ignoredSensors
+        self.data["GUI"] = self.speedMatch.gui
+
+    @RedirectStdErr
+    def handle(self):
+        print(self.data)
+        self.addressedProgrammers = addressedProgrammers
+        self.data["Run Profiler"] = RunProfiler()
+        try:
+            Calibration(speedMatchInstance=self, data=self.data).run()
+            self.data["Run Profiler"].report(profileBasename(self.data))
+        finally:
+            self.speedMatch.sessionFinished(self)
+        return False
+
+
 s = SpeedMatch()
 s.main()
@@ -0,0 +1,52 @@
+"""
+Picks the implementation of the number crunching in SpeedTableBuilder and
+BlockLengthSolver: the robust means of the raw block times and the
+alternating least squares fit.
+
+Inside JMRI there's no numpy (see README.md), so the plain Python code in
+those classes is what runs there. Under CPython with numpy installed, the
+same computations run vectorized in NumpyBackend, which is much faster
+once there are thousands of block times, e.g. when rebuilding a whole
+fleet or sweeping simulations. Both give the same speed tables; see
+Benchmarks --golden.
+
+getBackend() returns None for plain Python, which the classes take to
+mean their own code.
+"""
+PYTHON = "python"
+NUMPY = "numpy"
+
+_backendOverride = None
+
+"""
+uses this backend from now on: PYTHON, NUMPY, or None for the default,
+which is numpy if it's installed
+"""
+def setBackend(name):
+    global _backendOverride
+    if name not in (None, PYTHON, NUMPY):
+        raise Exception("Unknown backend: " + str(name))
+    if name == NUMPY and not numpyAvailable():
+        raise Exception("The numpy backend needs numpy, which isn't installed")
+    _backendOverride = name
+
+def numpyAvailable():
+    try:
+        import numpy
+    except ImportError:
+        return False
+    return True
+
+def backendName():
+    if _backendOverride is not None:
+        return _backendOverride
+    return NUMPY if numpyAvailable() else PYTHON
+
+"""
+returns: a NumpyBackend, or None to use plain Python
+"""
+def getBackend():
+    if backendName() == NUMPY:
+        from .NumpyBackend import NumpyBackend
+        return NumpyBackend()
+    return None
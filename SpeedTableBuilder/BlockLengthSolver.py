@@ -0,0 +1,305 @@
+"""
+Estimates the length of every block from the measured ones, so that every
+block on the loop can be used as a speed sample.
+
+The time through a block is its length times the time the locomotive takes
+per inch at that CV value. In log space that's a sum:
+    log(time[block, cv]) = log(length[block]) + log(timePerInch[cv])
+Measured blocks have a known length, which fixes the scale, and every
+other block's length and the time per inch at every CV value follow from
+a weighted least squares fit over all the measurements. We solve it by
+alternating least squares: with the lengths fixed, each time per inch is a
+weighted mean, and the other way around. That converges in a few dozen
+passes and needs no matrix library.
+
+Each direction is solved on its own. A block on a grade, or one whose next
+detector is missing or slow, looks longer in one direction than the other,
+and that's fine as long as it looks the same at every speed.
+
+Each block time is the robust mean of its samples (see Utils.robustMean),
+weighted by the number of good samples. Blocks whose times don't fit the
+model well - flaky detectors, dirty track - are weighted down by their
+residual variance, which is re-estimated on every pass.
+"""
+from math import log, exp, sqrt
+
+from Utils import inliers, robustMean, median
+from .Backend import getBackend
+
+"""
+measuredLengths: dict of sensor : measured block length in inches
+iterations: most alternating least squares passes
+tolerance: stop once no log value changes by more than this in a pass
+rejectSigmas: leave out block times this many standard deviations off
+              the model
+"""
+class BlockLengthSolver:
+    def __init__(self, measuredLengths, iterations=200, tolerance=1e-8, rejectSigmas=5.0):
+        self.measuredLengths = measuredLengths
+        self.rejectSigmas = rejectSigmas
+        self.iterations = iterations
+        self.tolerance = tolerance
+        # forward (True / False) : {sensor : ...}
+        self.lengths = {}
+        self.lengthErrors = {}
+        # forward : {cv : ...}
+        self.timePerInch = {}
+        # forward : {sensor : variance of one sample of log time}
+        self.blockVariances = {}
+        # NumpyBackend, or None for the plain Python below
+        self.backend = getBackend()
+
+    """
+    forwardMeasurements, reverseMeasurements: measurements[cv][sensor] =
+        list of block times in seconds, as recorded by LayoutBlocks. Either
+        may be None or empty.
+    """
+    def solve(self, forwardMeasurements, reverseMeasurements):
+        for forward, measurements in [(True, forwardMeasurements), (False, reverseMeasurements)]:
+            if measurements:
+                self._solveOneDirection(forward, measurements)
+        return
+
+    """
+    returns: dict of sensor : length in inches, for one direction
+    """
+    def getLengths(self, forward):
+        return self.lengths.get(forward, {})
+
+    """
+    returns: dict of sensor : standard error of the length, relative to the
+             length. 0.0 for measured blocks.
+    """
+    def getLengthErrors(self, forward):
+        return self.lengthErrors.get(forward, {})
+
+    """
+    returns: dict of CV value : seconds per inch, for one direction
+    """
+    def getTimePerInch(self, forward):
+        return self.timePerInch.get(forward, {})
+
+    """
+    blocks whose times scatter around the model much more than the typical
+    block's: at least factor times the median variance. Often a flaky
+    detector at one end.
+
+    returns: list of sensors, for one direction
+    """
+    def getNoisyBlocks(self, forward, factor=10.0):
+        variances = self.blockVariances.get(forward, {})
+        if not variances:
+            return []
+        typicalVariance = median(list(variances.values()))
+        return [el for el in variances.keys() if variances[el] > factor * typicalVariance]
+
+    """
+    (sensor, cv, log of robust mean time, number of good samples) for every
+    block and CV value with a usable time, plus the pooled variance of log
+    time within the samples of one block and CV value
+    """
+    def _observations(self, measurements):
+        if self.backend is not None:
+            return self.backend.observations(measurements)
+        observations = []
+        squares = 0.0
+        degrees = 0
+        for cv in measurements.keys():
+            for sensor in measurements[cv].keys():
+                samples = [el for el in measurements[cv][sensor] if el > 0]
+                if not samples:
+                    continue
+                good = inliers(samples)
+                logMean = log(robustMean(samples))
+                observations.append((sensor, cv, logMean, len(good)))
+                if len(good) > 1:
+                    squares += sum([(log(el) - logMean) ** 2 for el in good])
+                    degrees += len(good) - 1
+        sampleVariance = 0.03 ** 2
+        if degrees > 0:
+            sampleVariance = max(squares / degrees, 0.005 ** 2)
+        return observations, sampleVariance
+
+    def _solveOneDirection(self, forward, measurements):
+        observations, sampleVariance = self._observations(measurements)
+        fixed = {}
+        for sensor in self.measuredLengths.keys():
+            fixed[sensor] = log(self.measuredLengths[sensor])
+        measured = [el for el in set([el[0] for el in observations]) if el in fixed]
+        if not measured:
+            raise Exception("No measured block has any block times, can't solve for block lengths")
+
+        # Fit the relative lengths with every length free first. With only
+        # a measured block or two holding the scale, alternating least
+        # squares would take thousands of passes to move everything to the
+        # right scale on a big layout. So we shift to the measured lengths
+        # afterwards, then refine with the measured lengths fixed.
+        logLengths, logTimePerInch = self._initialGuess(observations, fixed)
+        observations = [el for el in observations if el[0] in logLengths]
+        blockVariance = {}
+        for sensor in logLengths.keys():
+            blockVariance[sensor] = sampleVariance
+        blockVariance, used = self._alternate(observations, logLengths, logTimePerInch,
+                                              blockVariance, {}, sampleVariance)
+
+        shift = self._meanByKey([(0, fixed[sensor] - logLengths[sensor], 1.0)
+                                 for sensor in measured])[0]
+        for sensor in logLengths.keys():
+            logLengths[sensor] = fixed.get(sensor, logLengths[sensor] + shift)
+        for cv in logTimePerInch.keys():
+            logTimePerInch[cv] -= shift
+        blockVariance, used = self._alternate(observations, logLengths, logTimePerInch,
+                                              blockVariance, fixed, sampleVariance)
+
+        self.blockVariances[forward] = blockVariance
+
+        # standard errors, from the weights at the solution
+        lengthWeights = {}
+        for sensor, cv, y, n in used:
+            lengthWeights[sensor] = lengthWeights.get(sensor, 0.0) + n / blockVariance[sensor]
+
+        self.lengths[forward] = {}
+        self.lengthErrors[forward] = {}
+        for sensor in logLengths.keys():
+            self.lengths[forward][sensor] = exp(logLengths[sensor])
+            if sensor in fixed:
+                self.lengthErrors[forward][sensor] = 0.0
+            else:
+                self.lengthErrors[forward][sensor] = 1.0 / sqrt(lengthWeights.get(sensor, 1e-12))
+        self.timePerInch[forward] = {}
+        for cv in logTimePerInch.keys():
+            self.timePerInch[forward][cv] = exp(logTimePerInch[cv])
+        return
+
+    """
+    alternating least squares passes until nothing changes. Updates
+    logLengths (except the fixed ones) and logTimePerInch in place.
+
+    Observations far off the model - e.g. a block where most samples were
+    stalls, so that even the robust mean is off - are left out, judged
+    against the typical variance of all blocks so that one bad observation
+    can't hide itself by inflating its block's variance.
+
+    returns: (variance of one sample of log time for each block, the
+             observations that were used)
+    """
+    def _alternate(self, observations, logLengths, logTimePerInch, blockVariance,
+                   fixed, sampleVariance):
+        if self.backend is not None:
+            return self.backend.alternate(observations, logLengths, logTimePerInch,
+                                          blockVariance, fixed, sampleVariance,
+                                          self.iterations, self.tolerance, self.rejectSigmas)
+        used = None
+        for iteration in range(self.iterations):
+            typicalVariance = max(median(list(blockVariance.values())), sampleVariance)
+            newUsed = [el for el in observations
+                       if (el[2] - logLengths[el[0]] - logTimePerInch[el[1]]) ** 2 * el[3] <=
+                          self.rejectSigmas ** 2 * typicalVariance]
+            if used is not None and change < self.tolerance and len(newUsed) == len(used):
+                break
+            used = newUsed
+
+            change = 0.0
+            # lengths, with the times per inch fixed
+            newLogLengths = self._meanByKey(
+                [(sensor, y - logTimePerInch[cv], n / blockVariance[sensor])
+                 for sensor, cv, y, n in used if sensor not in fixed])
+            for sensor in newLogLengths.keys():
+                change = max(change, abs(newLogLengths[sensor] - logLengths[sensor]))
+                logLengths[sensor] = newLogLengths[sensor]
+
+            # times per inch, with the lengths fixed
+            newLogTimePerInch = self._meanByKey(
+                [(cv, y - logLengths[sensor], n / blockVariance[sensor])
+                 for sensor, cv, y, n in used])
+            for cv in newLogTimePerInch.keys():
+                change = max(change, abs(newLogTimePerInch[cv] - logTimePerInch[cv]))
+                logTimePerInch[cv] = newLogTimePerInch[cv]
+
+            blockVariance = self._blockVariances(used, logLengths, logTimePerInch,
+                                                 fixed, sampleVariance)
+        return blockVariance, used
+
+    """
+    weighted mean of values with the same key
+
+    items: list of (key, value, weight)
+    returns: dict of key : weighted mean
+    """
+    def _meanByKey(self, items):
+        sums = {}
+        weights = {}
+        for key, value, weight in items:
+            sums[key] = sums.get(key, 0.0) + weight * value
+            weights[key] = weights.get(key, 0.0) + weight
+        means = {}
+        for key in sums.keys():
+            if weights[key] > 0:
+                means[key] = sums[key] / weights[key]
+        return means
+
+    """
+    A first guess that's already on the right scale, working outwards from
+    the measured blocks: their times give the time per inch at the CV
+    values they were seen at, those give the lengths of the other blocks
+    seen at the same CV values, and so on. Medians, so that a few bad
+    observations can't pull the guess far enough off to make good ones look
+    bad.
+
+    Blocks that can't be reached this way (e.g. only seen at a CV value
+    where no block of known length was seen) are left out.
+    """
+    def _initialGuess(self, observations, fixed):
+        logLengths = {}
+        for sensor, cv, y, n in observations:
+            if sensor in fixed:
+                logLengths[sensor] = fixed[sensor]
+        logTimePerInch = {}
+        while True:
+            newLogTimePerInch = self._medianByKey(
+                [(cv, y - logLengths[sensor]) for sensor, cv, y, n in observations
+                 if sensor in logLengths and cv not in logTimePerInch])
+            logTimePerInch.update(newLogTimePerInch)
+            newLogLengths = self._medianByKey(
+                [(sensor, y - logTimePerInch[cv]) for sensor, cv, y, n in observations
+                 if cv in logTimePerInch and sensor not in logLengths])
+            logLengths.update(newLogLengths)
+            if not newLogTimePerInch and not newLogLengths:
+                return logLengths, logTimePerInch
+
+    """
+    items: list of (key, value)
+    returns: dict of key : median value
+    """
+    def _medianByKey(self, items):
+        values = {}
+        for key, value in items:
+            values.setdefault(key, []).append(value)
+        medians = {}
+        for key in values.keys():
+            medians[key] = median(values[key])
+        return medians
+
+    """
+    variance of one sample of log time for each block, from how well the
+    block fits the model. Blocks with few measurements lean on the variance
+    within the samples, like a prior worth two measurements.
+    """
+    def _blockVariances(self, observations, logLengths, logTimePerInch, fixed, sampleVariance):
+        squares = {}
+        counts = {}
+        for sensor, cv, y, n in observations:
+            residual = y - logLengths[sensor] - logTimePerInch[cv]
+            # the mean of n samples has 1 / n of the variance of one sample
+            squares[sensor] = squares.get(sensor, 0.0) + n * residual * residual
+            counts[sensor] = counts.get(sensor, 0) + 1
+        # blocks with every observation left out keep the prior
+        variances = {}
+        for sensor in logLengths.keys():
+            variances[sensor] = sampleVariance
+        for sensor in squares.keys():
+            # a free length uses up one measurement
+            degrees = counts[sensor] - (0 if sensor in fixed else 1)
+            variances[sensor] = ( (squares[sensor] + 2.0 * sampleVariance) /
+                                  (max(degrees, 0) + 2.0) )
+        return variances
@@ -0,0 +1,92 @@
+"""
+Block time as a function of (CV value * trim) for one sensor and direction,
+interpolated linearly in log(time) between measurements.
+
+SpeedTableBuilder asks this function for up to 255 CV values for each of
+the 28 speed steps, for every sensor, direction and SMPH setting. So all
+the work that doesn't depend on the CV value is done once, here: the
+measured CV values are sorted, the logs taken and the slope of every
+segment computed. A lookup is then a bisection plus one exp(), and the
+arithmetic is the same as the original per-call code, so the results are
+identical to the last bit.
+
+For the table itself, the block times at every integer CV value 0..255 are
+computed once, along with their running minimum. The first CV value that
+is fast enough for a desired time is then found by bisection on the
+running minimum, which gives the same answer as scanning upwards from 1
+even when noisy measurements make the times go up and down.
+"""
+from bisect import bisect_left
+from math import log, exp
+
+# block time reported at or below the slowest measurement. See
+# SpeedTableBuilder._funcCvValueTimesTrimToTime
+BELOW_MINIMUM_TIME = 9999999999999999
+
+"""
+data: dict of CV value to block time in seconds, at least two entries
+"""
+class LogInterpolator:
+    def __init__(self, data):
+        if len(data) < 2:
+            raise Exception("Need at least two measured CV values to interpolate, got " +
+                            str(sorted(data.keys())))
+        self.cvs = sorted(list(data.keys()))
+        self.logTimes = [log(data[cv]) for cv in self.cvs]
+        # slope of log(time) per CV value, of the segment ending at cvs[i]
+        self.slopes = [0.0]
+        for i in range(1, len(self.cvs)):
+            self.slopes.append( (self.logTimes[i] - self.logTimes[i-1]) *
+                                1.0 / (self.cvs[i] - self.cvs[i-1]) )
+        self._timeGrid = None
+        self._runningMinimum = None
+
+    """
+    cvValueTimesTrim: speed table CV value * decoder trim
+
+    returns: block time in seconds
+    """
+    def timeAt(self, cvValueTimesTrim):
+        cvs = self.cvs
+        if cvValueTimesTrim <= cvs[0]:
+            return BELOW_MINIMUM_TIME
+        elif cvValueTimesTrim > cvs[-1]:
+            # extrapolate with the slope of the top two measurements
+            run = cvValueTimesTrim - cvs[-1]
+            return exp(self.slopes[-1] * run + self.logTimes[-1])
+        # cvs[i-1] < cvValueTimesTrim <= cvs[i]
+        i = bisect_left(cvs, cvValueTimesTrim)
+        run = cvValueTimesTrim - cvs[i-1]
+        return exp(self.slopes[i] * run + self.logTimes[i-1])
+
+    def _buildTimeGrid(self):
+        self._timeGrid = [self.timeAt(cv) for cv in range(256)]
+        self._runningMinimum = [self._timeGrid[0]]
+        for cv in range(1, 256):
+            self._runningMinimum.append(min(self._runningMinimum[-1], self._timeGrid[cv]))
+
+    """
+    Speed table CV value for a desired block time: the first integer CV
+    value from 1 up whose block time is at or below desiredTime, or the one
+    below it if that one is closer to desiredTime. 255 if we never get
+    there.
+    """
+    def tableCvValue(self, desiredTime):
+        if self._timeGrid is None:
+            self._buildTimeGrid()
+        # running minimum is non-increasing; find the first entry <= desiredTime
+        low = 1
+        high = 256
+        while low < high:
+            middle = (low + high) // 2
+            if self._runningMinimum[middle] <= desiredTime:
+                high = middle
+            else:
+                low = middle + 1
+        if low == 256:
+            return 255
+        newTime = self._timeGrid[low]
+        oldTime = self._timeGrid[low - 1]
+        if abs(newTime - desiredTime) < abs(oldTime - desiredTime):
+            return low
+        return low - 1
@@ -0,0 +1,186 @@
+"""
+Vectorized versions of the heavy loops in SpeedTableBuilder and
+BlockLengthSolver, for CPython with numpy. See Backend.py.
+
+Every function does the same arithmetic, in the same order, as the plain
+Python code it replaces, so results agree to the last bit or close to it:
+sums that have to match a Python loop use cumsum and bincount, which add
+in order, rather than sum, which doesn't. Only numpy's log can differ from
+math.log in the last bit.
+
+The interpolation and trims are left to the plain Python code. They work
+on 28 steps and a 2x2 matrix, where numpy's overhead per call is more
+than the work.
+"""
+from math import log
+
+import numpy
+
+from Utils import median
+
+class NumpyBackend:
+    """
+    robust mean of each list of samples, as Utils.robustMean, plus what
+    BlockLengthSolver needs from the good samples
+
+    sampleLists: list of lists of positive block times
+    returns: (means, number of good samples, sum of squares of log(sample) -
+             log(mean) over the good samples) - one list entry per sample
+             list, None / 0 / 0.0 for empty lists
+    """
+    def robustMeans(self, sampleLists):
+        count = len(sampleLists)
+        means = numpy.zeros(count)
+        goodCounts = numpy.zeros(count, dtype=int)
+        logSquares = numpy.zeros(count)
+        byLength = {}
+        for i in range(count):
+            byLength.setdefault(len(sampleLists[i]), []).append(i)
+        for length in byLength.keys():
+            if length == 0:
+                continue
+            indices = numpy.array(byLength[length], dtype=int)
+            samples = numpy.array([sampleLists[i] for i in byLength[length]], dtype=float)
+            good = self._inlierMask(samples)
+            goodCount = good.sum(axis=1)
+            # cumsum adds left to right, like sum() in Utils.robustMean
+            mean = numpy.cumsum(numpy.where(good, samples, 0.0), axis=1)[:, -1] * 1.0 / goodCount
+            deviations = (numpy.log(samples) - numpy.log(mean)[:, None]) ** 2
+            means[indices] = mean
+            goodCounts[indices] = goodCount
+            logSquares[indices] = numpy.cumsum(numpy.where(good, deviations, 0.0), axis=1)[:, -1]
+        means = means.tolist()
+        for i in byLength.get(0, []):
+            means[i] = None
+        return means, goodCounts.tolist(), logSquares.tolist()
+
+    """
+    Utils.inliers for every row of samples at once
+
+    returns: boolean array, True for the good samples
+    """
+    def _inlierMask(self, samples, madMultiplier=3.0, minimumFraction=0.05):
+        length = samples.shape[1]
+        if length < 3:
+            return numpy.ones(samples.shape, dtype=bool)
+        middle = self._medianOfRows(samples)
+        deviations = numpy.abs(samples - middle[:, None])
+        mad = 1.4826 * self._medianOfRows(deviations)
+        threshold = numpy.maximum(madMultiplier * mad, minimumFraction * numpy.abs(middle))
+        return deviations <= threshold[:, None]
+
+    """
+    Utils.median of every row. numpy.median averages the two middle values
+    as (a + b) / 2 rather than a / 2 + b / 2, which can differ in the last
+    bit.
+    """
+    def _medianOfRows(self, values):
+        length = values.shape[1]
+        ordered = numpy.sort(values, axis=1)
+        if length % 2:
+            return ordered[:, length // 2]
+        return ordered[:, length // 2 - 1] / 2.0 + ordered[:, length // 2] / 2.0
+
+    """
+    BlockLengthSolver._observations
+    """
+    def observations(self, measurements):
+        sensors = []
+        cvs = []
+        sampleLists = []
+        for cv in measurements.keys():
+            blockTimes = measurements[cv]
+            for sensor in blockTimes.keys():
+                samples = blockTimes[sensor]
+                if samples and min(samples) <= 0:
+                    samples = [el for el in samples if el > 0]
+                if samples:
+                    sensors.append(sensor)
+                    cvs.append(cv)
+                    sampleLists.append(samples)
+        means, goodCounts, logSquares = self.robustMeans(sampleLists)
+        # math.log rather than numpy.log, which can differ in the last bit
+        observations = list(zip(sensors, cvs, [log(el) for el in means], goodCounts))
+        several = numpy.array(goodCounts, dtype=int) > 1
+        squares = 0.0
+        if several.any():
+            squares = float(numpy.cumsum(numpy.array(logSquares)[several])[-1])
+        degrees = int((numpy.array(goodCounts)[several] - 1).sum())
+        sampleVariance = 0.03 ** 2
+        if degrees > 0:
+            sampleVariance = max(squares / degrees, 0.005 ** 2)
+        return observations, sampleVariance
+
+    """
+    BlockLengthSolver._alternate, on arrays indexed by block and CV value
+    """
+    def alternate(self, observations, logLengths, logTimePerInch, blockVariance,
+                  fixed, sampleVariance, iterations, tolerance, rejectSigmas):
+        sensors = list(logLengths.keys())
+        cvs = list(logTimePerInch.keys())
+        sensorIndex = dict([(sensors[i], i) for i in range(len(sensors))])
+        cvIndex = dict([(cvs[i], i) for i in range(len(cvs))])
+        numSensors = len(sensors)
+        numCvs = len(cvs)
+
+        s = numpy.array([sensorIndex[el[0]] for el in observations], dtype=int)
+        c = numpy.array([cvIndex[el[1]] for el in observations], dtype=int)
+        y = numpy.array([el[2] for el in observations], dtype=float)
+        n = numpy.array([el[3] for el in observations], dtype=float)
+        lengths = numpy.array([logLengths[el] for el in sensors], dtype=float)
+        timePerInch = numpy.array([logTimePerInch[el] for el in cvs], dtype=float)
+        variances = numpy.array([blockVariance[el] for el in sensors], dtype=float)
+        isFixed = numpy.array([el in fixed for el in sensors], dtype=bool)
+        # fewer degrees of freedom for the free lengths, see _blockVariances
+        freeDegrees = numpy.where(isFixed, 0, 1)
+
+        used = None
+        change = 0.0
+        for iteration in range(iterations):
+            typicalVariance = max(median(variances.tolist()), sampleVariance)
+            residuals = y - lengths[s] - timePerInch[c]
+            newUsed = residuals ** 2 * n <= rejectSigmas ** 2 * typicalVariance
+            if used is not None and change < tolerance and newUsed.sum() == used.sum():
+                break
+            used = newUsed
+
+            change = 0.0
+            weights = n / variances[s]
+            # lengths, with the times per inch fixed
+            free = used & ~isFixed[s]
+            sums = numpy.bincount(s[free], weights=(weights * (y - timePerInch[c]))[free],
+                                  minlength=numSensors)
+            weightSums = numpy.bincount(s[free], weights=weights[free], minlength=numSensors)
+            update = weightSums > 0
+            newLengths = sums[update] / weightSums[update]
+            if newLengths.size:
+                change = max(change, float(numpy.abs(newLengths - lengths[update]).max()))
+            lengths[update] = newLengths
+
+            # times per inch, with the lengths fixed
+            sums = numpy.bincount(c[used], weights=(weights * (y - lengths[s]))[used],
+                                  minlength=numCvs)
+            weightSums = numpy.bincount(c[used], weights=weights[used], minlength=numCvs)
+            update = weightSums > 0
+            newTimePerInch = sums[update] / weightSums[update]
+            if newTimePerInch.size:
+                change = max(change, float(numpy.abs(newTimePerInch - timePerInch[update]).max()))
+            timePerInch[update] = newTimePerInch
+
+            # block variances, see BlockLengthSolver._blockVariances
+            residuals = y - lengths[s] - timePerInch[c]
+            squares = numpy.bincount(s[used], weights=(n * residuals * residuals)[used],
+                                     minlength=numSensors)
+            counts = numpy.bincount(s[used], minlength=numSensors)
+            degrees = numpy.maximum(counts - freeDegrees, 0)
+            variances = numpy.where(counts > 0,
+                                    (squares + 2.0 * sampleVariance) / (degrees + 2.0),
+                                    sampleVariance)
+
+        for i in range(numSensors):
+            logLengths[sensors[i]] = float(lengths[i])
+        for i in range(numCvs):
+            logTimePerInch[cvs[i]] = float(timePerInch[i])
+        usedObservations = [observations[i] for i in numpy.nonzero(used)[0]]
+        return dict([(sensors[i], float(variances[i])) for i in range(numSensors)]), \
+               usedObservations
@@ -2,14 +2,32 @@
 Builds the speed table using the measured block data from LayoutBlocks.
 
 Normally you'd do this with numpy and scipy for a SVD, but those are difficult
-to integrate into Jython (see notes README.md).
+to integrate into Jython (see notes README.md). Where numpy is available,
+the robust means and the block length fit run vectorized (see Backend.py).
 """
-from math import log, exp
-from Utils import median
+from math import floor
+
+from Utils import robustMean
+from .LogInterpolator import LogInterpolator
+from .TrimSolver import TrimSolver
+from .BlockLengthSolver import BlockLengthSolver
+from .Backend import getBackend
+
+# processed measurements key for the time per inch over all blocks
+ALL_BLOCKS = "All Blocks"
 
 class SpeedTableBuilder:
     def __init__(self, layoutBlocksInstance):
         self.layoutBlocksInstance = layoutBlocksInstance
+        # (sensor, forward) : LogInterpolator
+        self.interpolators = {}
+        self.forwardTrim = None
+        self.reverseTrim = None
+        self.blockLengthSolver = None
+        self.processedMeasurementsForward = {}
+        self.processedMeasurementsReverse = {}
+        # NumpyBackend, or None for plain Python
+        self.backend = getBackend()
 
     """
     Takes raw measurements from LayoutBlocks and outputs nested dicts of
@@ -19,9 +37,11 @@ class SpeedTableBuilder:
      ... }
 
     Note that each CV value generally has multiple time measurements for each
-    block. We take the median time measurement, so as to filter out blocks
-    where an engine stalled or other issues occur (only really effective if
-    you have 3 or more datapoints per block).
+    block. We take the mean of the measurements after rejecting outliers
+    (see Utils.inliers), so as to filter out blocks where an engine stalled
+    or other issues occur (only really effective if you have 3 or more
+    datapoints per block). This is the same estimate that LayoutBlocks uses
+    to decide when a CV value has been measured well enough.
 
     Also, if the forward and reverse times for a block are wildly different,
     this is typically because the block next to the block in question either
@@ -51,16 +71,18 @@ class SpeedTableBuilder:
         sensorCountMax = max(sensorCount.values())
         sensors = [el for el in sensorCount.keys() if sensorCount[el] == sensorCountMax]
 
-        # compute medians and filter blocks with different fwd / rev times
+        # compute robust means and filter blocks with different fwd / rev times
         self.processedMeasurementsForward = {}
         self.processedMeasurementsReverse = {}
+        self.interpolators = {}
+        robustMeans = self._robustMeans(sensors, forwardMeasurements, reverseMeasurements)
         for sensor in sensors:
             forwardTimes = {}
             reverseTimes = {}
             saveFlag = True
             for cv in forwardMeasurements.keys():
-                forwardMedianBlockTime = median(forwardMeasurements[cv][sensor])
-                reverseMedianBlockTime = median(reverseMeasurements[cv][sensor])
+                forwardMedianBlockTime = robustMeans[(sensor, cv, True)]
+                reverseMedianBlockTime = robustMeans[(sensor, cv, False)]
                 forwardTimes[cv] = forwardMedianBlockTime
                 reverseTimes[cv] = reverseMedianBlockTime
                 # Note: On some brass steam engines, especially at lower
@@ -87,6 +109,21 @@ class SpeedTableBuilder:
 
         return
 
+    """
+    returns: dict of (sensor, cv, forward) : robust mean block time, for
+             every sensor and CV value in both directions
+    """
+    def _robustMeans(self, sensors, forwardMeasurements, reverseMeasurements):
+        keys = [(sensor, cv, forward) for sensor in sensors
+                for cv in forwardMeasurements.keys() for forward in [True, False]]
+        sampleLists = [(forwardMeasurements if forward else reverseMeasurements)[cv][sensor]
+                       for sensor, cv, forward in keys]
+        if self.backend is not None:
+            means = self.backend.robustMeans(sampleLists)[0]
+        else:
+            means = [robustMean(el) for el in sampleLists]
+        return dict(zip(keys, means))
+
     """
     Returns an estimated block time given a (CV value * trim)
 
@@ -100,6 +137,10 @@ class SpeedTableBuilder:
     in log space. Since distance = speed * time,
     time is proportional to 1/speed.
 
+    At or below the lowest measurement, returns a very large time; the
+    bottom of the table is filled in afterwards instead (see
+    _speedTableBuilderOneDirection).
+
     sensor: name of sensor for block time estimate
     cvValueTimesTrim: speed table CV value * decoder trim
     forward: forward if True; reverse otherwise
@@ -107,49 +148,21 @@ class SpeedTableBuilder:
     returns: time in seconds
     """
     def _funcCvValueTimesTrimToTime(self, sensor, cvValueTimesTrim, forward):
-        if forward:
-            data = self.processedMeasurementsForward[sensor]
-        else:
-            data = self.processedMeasurementsReverse[sensor]
-
-        measuredCvs = sorted(list(data.keys()))
-
-        # if below or at minimum measurement
-        if cvValueTimesTrim <= measuredCvs[0]:
-            # linearly interpolate below lowest speed measurement
-            # TODO: Could replace lower data value with "big honking number"
-            slope = ( (log(data[measuredCvs[1]]) - log(data[measuredCvs[0]])) *
-                      1.0 / (measuredCvs[1] - measuredCvs[0]) )
-            run = measuredCvs[0] - cvValueTimesTrim
-            belowMinMeasurement = exp(log(data[measuredCvs[0]]) - slope * run)
-            # return belowMinMeasurement
-            # Note: the above tends to result in CV values that are much
-            # too small. Instead, we're going to return (big) here and then
-            # linearly interpolate the CV values from the lowest nonchanging
-            # CV value once the final table is built later.
-            return 9999999999999999
-        # if above max measurement
-        elif cvValueTimesTrim > measuredCvs[-1]:
-                # linearly interpolate based on slope of top two measurements
-                # probably never hit this case
-                slope = ( (log(data[measuredCvs[-1]]) - log(data[measuredCvs[-2]])) *
-                          1.0 / (measuredCvs[-1] - measuredCvs[-2]) )
-                run = cvValueTimesTrim - measuredCvs[-1]
-                aboveMaxMeasurement = exp(slope * run + log(data[measuredCvs[-1]]))
-                return aboveMaxMeasurement
-        else:
-            # we're between two points
-            # find bottom point
-            for i in range(len(measuredCvs)):
-                if ( cvValueTimesTrim > measuredCvs[i] and
-                     cvValueTimesTrim <= measuredCvs[i+1]):
-                     lowCv = measuredCvs[i]
-                     highCv = measuredCvs[i+1]
-                     slope = ( (log(data[highCv]) - log(data[lowCv])) *
-                                1.0 / (highCv - lowCv) )
-                     run = cvValueTimesTrim - lowCv
-                     betweenMeasurements = exp(slope * run + log(data[lowCv]))
-                     return betweenMeasurements
+        return self._interpolator(sensor, forward).timeAt(cvValueTimesTrim)
+
+    """
+    The interpolation for one sensor and direction, built on first use.
+    See LogInterpolator.
+    """
+    def _interpolator(self, sensor, forward):
+        key = (sensor, forward)
+        if key not in self.interpolators:
+            if forward:
+                data = self.processedMeasurementsForward[sensor]
+            else:
+                data = self.processedMeasurementsReverse[sensor]
+            self.interpolators[key] = LogInterpolator(data)
+        return self.interpolators[key]
 
     """
     Builds the engine CV 28 step speed table for one direction
@@ -171,27 +184,10 @@ class SpeedTableBuilder:
         # set desired block time for each step, 1-28
         steps = range(1,29)
         desiredTimes = [maxSmphTime * 28 * 1.0/step for step in steps ]
-        tableCvs = []
-        for i in range(len(steps)):
-            # incrementing the CV value decreases the block time estimate
-            for cvValueTimesTrim in range(1,256):
-                newBlockTimeEstiamte = self._funcCvValueTimesTrimToTime(
-                                       sensor, cvValueTimesTrim, forward)
-                #print('step: ' + str(i) + " cvValueTimesTrim: " + str(cvValueTimesTrim) + " newBlockTimeEstimate: " + str(newBlockTimeEstiamte) + " desiredTimes[step]: " + str(desiredTimes[i]))
-                if newBlockTimeEstiamte <= desiredTimes[i]:
-                    # we're done - add nearest neighbor cv to table
-                    oldBlockTimeEstimate = self._funcCvValueTimesTrimToTime(
-                                           sensor, cvValueTimesTrim - 1, forward)
-                    if ( abs(newBlockTimeEstiamte - desiredTimes[i]) <
-                         abs(oldBlockTimeEstimate - desiredTimes[i]) ):
-                         tableCvs.append(cvValueTimesTrim)
-                    else:
-                         tableCvs.append(cvValueTimesTrim - 1)
-                    break
-                elif cvValueTimesTrim == 255:
-                    # we're at the top speed step, but still not moving
-                    # quickly enough to hit the desiredTime target.
-                    tableCvs.append(255)
+        # first CV value that gets the block time down to the desired time,
+        # or the one below it if that's closer. See LogInterpolator.
+        interpolator = self._interpolator(sensor, forward)
+        tableCvs = [interpolator.tableCvValue(desiredTime) for desiredTime in desiredTimes]
 
         if not len(tableCvs) == 28:
             print("tableCvs: " + str(tableCvs))
@@ -205,7 +201,8 @@ class SpeedTableBuilder:
                 break
         slope = (tableCvs[i] - vStart) * 1.0 / (i + 1)
         for cv in range(0,i):
-            tableCvs[cv] = int(round(slope * (cv + 1)))
+            # halves round up, as in Jython, see TrimSolver.solveForDecoder
+            tableCvs[cv] = int(floor(slope * (cv + 1) + 0.5))
 
         return tableCvs
 
@@ -213,41 +210,30 @@ class SpeedTableBuilder:
     Builds the engine CV 28 step speed table based on data collected
     from one sensor.
 
-    TODO: Note that you have a forward and reverse speed table based on the
-    measurements from the block. However, the DCC standard only specifies one
-    table and two trim values. The correct way to solve this is to create a
-    rank-2 matrix of the two speed tables, then use a singular value
-    decomposition to decompose that into one vector (the 28 step table) and
-    two gain values (the trims). Unfortunately, we don't get numpy's SVD
-    function due to use of Jython here. One could manually implement even
-    a slow SVD method here.
-
-    For now, we're going to average the forward and reverse tables and ignore
-    the trim. Depending on how well engines actually run together in practice,
-    this may be revised later.
-
+    The DCC standard only has one table plus a forward and a reverse trim,
+    so the two tables are combined later by TrimSolver.
 
     sensor: name of sensor for this block
     maxSmphTime: time calculated to correspond with the calibration
                  to a maximum number of scale miles per hour. This is
                  based on the measured length of the block.
 
-    returns: 28 element list of CV values
+    returns: (forward, reverse) 28 element lists of CV values * trim
     """
     def _blockSpeedTableBuilder(self, sensor, maxSmphTime):
         table_fwd = self._speedTableBuilderOneDirection(forward=True,
                                     sensor=sensor, maxSmphTime=maxSmphTime)
         table_rev = self._speedTableBuilderOneDirection(forward=False,
                                     sensor=sensor, maxSmphTime=maxSmphTime)
-        table = []
-        for i in range(len(table_fwd)):
-            table.append(0.5 * (table_fwd[i] + table_rev[i]))
-
-        return table
+        return table_fwd, table_rev
 
     """
     builds a 28 step seed table based on times for measured-length blocks
 
+    The forward and reverse tables of each block are averaged over the
+    blocks, then split into one table plus trims (see TrimSolver). The trim
+    CV values are kept for getTrimCvValues.
+
     returns: 28 element list of CV values
     """
     def buildSpeedTableForMeasuredBlocks(self):
@@ -263,14 +249,74 @@ class SpeedTableBuilder:
             speedTables[sensor] = self._blockSpeedTableBuilder(sensor, measuredBlockTimes[sensor])
 
         # TODO: something better than averaging the speed tables
-        # TODO: Also return trim values (see comments on SVD above)
-        numTables = len(list(speedTables.keys()))
-        finalTable = []
-        # 28 steps
-        for cv in range(len(speedTables[relevantSensors[0]])):
-            val = 0
-            for sensor in speedTables.keys():
-                val += speedTables[sensor][cv] * 1.0 / numTables
-            finalTable.append(int(round(val)))
+        return self._tableAndTrims(list(speedTables.values()))
+
+    """
+    builds a 28 step speed table using the block times of every block, not
+    just the measured ones
+
+    The length of every block is estimated from the measured blocks (see
+    BlockLengthSolver), which turns all the block times at a CV value into
+    one weighted estimate of the time per inch. The table is built from
+    that, as if for a one inch measured block. The solver is kept for
+    getBlockLengthSolver.
+
+    Doesn't need preprocessCvToBlockTimeDataTables; every block time is
+    used, including blocks that were only seen in one direction.
+
+    returns: 28 element list of CV values
+    """
+    def buildSpeedTableForAllBlocks(self):
+        data = self.layoutBlocksInstance.data
+        measuredLengths = {}
+        for i in range(len(data["Measured Block Sensors"])):
+            measuredLengths[data["Measured Block Sensors"][i]] = \
+                data["Measured Block Lengths (Inches)"][i]
+        self.blockLengthSolver = BlockLengthSolver(measuredLengths)
+        self.blockLengthSolver.solve(self.layoutBlocksInstance.getForwardMeasurements(),
+                                     self.layoutBlocksInstance.getReverseMeasurements())
+
+        # time per inch at the maximum speed
+        measuredBlockTimes = self.layoutBlocksInstance.getTopSpeedTimePerMeasuredBlock()
+        sensor = list(measuredBlockTimes.keys())[0]
+        maxSmphTimePerInch = measuredBlockTimes[sensor] / measuredLengths[sensor]
+
+        self.processedMeasurementsForward[ALL_BLOCKS] = self.blockLengthSolver.getTimePerInch(True)
+        self.processedMeasurementsReverse[ALL_BLOCKS] = self.blockLengthSolver.getTimePerInch(False)
+        for key in [(ALL_BLOCKS, True), (ALL_BLOCKS, False)]:
+            if key in self.interpolators:
+                del self.interpolators[key]
+        return self._tableAndTrims([self._blockSpeedTableBuilder(ALL_BLOCKS, maxSmphTimePerInch)])
 
+    def getBlockLengthSolver(self):
+        return self.blockLengthSolver
+
+    """
+    averages (forward, reverse) tables over blocks and splits the result
+    into one table plus trims, see TrimSolver
+
+    returns: 28 element list of CV values
+    """
+    def _tableAndTrims(self, speedTables):
+        numTables = len(speedTables)
+        forwardTable = []
+        reverseTable = []
+        # 28 steps
+        for cv in range(28):
+            forwardValue = 0
+            reverseValue = 0
+            for forwardAndReverse in speedTables:
+                forwardValue += forwardAndReverse[0][cv] * 1.0 / numTables
+                reverseValue += forwardAndReverse[1][cv] * 1.0 / numTables
+            forwardTable.append(forwardValue)
+            reverseTable.append(reverseValue)
+
+        finalTable, self.forwardTrim, self.reverseTrim = \
+            TrimSolver().solveForDecoder(forwardTable, reverseTable)
         return finalTable
+
+    """
+    returns: (CV66, CV95) trim values that go with the last table built
+    """
+    def getTrimCvValues(self):
+        return self.forwardTrim, self.reverseTrim
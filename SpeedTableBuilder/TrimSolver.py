@@ -0,0 +1,93 @@
+"""
+Splits a forward and a reverse speed table into the one table and two trim
+values (CV66 forward, CV95 reverse) that a DCC decoder actually has.
+
+The decoder runs at (table value * trim / 128) in each direction, so we
+want the table T and gains gF, gR for which gF * T and gR * T are as close
+as possible to the forward and reverse tables. That's the best rank-1
+approximation of the 28 x 2 matrix [forward reverse], which is what the
+SVD would give us. We don't have numpy, but we don't need it either: the
+right singular vector is the top eigenvector of the 2 x 2 matrix
+[forward reverse]^T [forward reverse], which has a closed form. So a solve
+is three dot products and a square root.
+
+The gains are scaled so that the larger one is 1.0. The table then never
+goes above what the slower direction needs, and the faster direction gets
+trimmed down. Trims are CV values, so after rounding them the table is fit
+again to the rounded trims.
+"""
+from math import sqrt, floor
+
+class TrimSolver:
+    """
+    forwardTable, reverseTable: 28 step speed tables (CV value * trim), as
+                                built for each direction
+
+    returns: (table, forward gain, reverse gain), table as floats
+    """
+    def solve(self, forwardTable, reverseTable):
+        if not len(forwardTable) == len(reverseTable):
+            raise Exception("Forward and reverse tables must have the same length")
+        a = 0.0
+        b = 0.0
+        c = 0.0
+        for i in range(len(forwardTable)):
+            a += forwardTable[i] * forwardTable[i]
+            b += forwardTable[i] * reverseTable[i]
+            c += reverseTable[i] * reverseTable[i]
+        forwardGain, reverseGain = self._topEigenvector(a, b, c)
+
+        # largest gain is 1.0
+        scale = max(forwardGain, reverseGain)
+        forwardGain = forwardGain / scale
+        reverseGain = reverseGain / scale
+        return self._fitTable(forwardTable, reverseTable, forwardGain, reverseGain), \
+               forwardGain, reverseGain
+
+    """
+    Like solve, but with everything rounded to what goes into the decoder
+
+    returns: (table as ints, CV66 value, CV95 value)
+    """
+    def solveForDecoder(self, forwardTable, reverseTable):
+        table, forwardGain, reverseGain = self.solve(forwardTable, reverseTable)
+        forwardTrim = self.trimCvValue(forwardGain)
+        reverseTrim = self.trimCvValue(reverseGain)
+        table = self._fitTable(forwardTable, reverseTable,
+                               forwardTrim / 128.0, reverseTrim / 128.0)
+        # halves round up, as round() does in Jython - not to even, as in Python 3
+        table = [min(max(int(floor(el + 0.5)), 0), 255) for el in table]
+        return table, forwardTrim, reverseTrim
+
+    """
+    trim CV value for a gain, 1 - 255 (0 would turn the trim off)
+    """
+    def trimCvValue(self, gain):
+        return min(max(int(floor(gain * 128 + 0.5)), 1), 255)
+
+    """
+    unit eigenvector for the largest eigenvalue of [[a, b], [b, c]], with
+    non-negative entries (a, c >= 0 and b >= 0 for speed tables)
+    """
+    def _topEigenvector(self, a, b, c):
+        largest = 0.5 * (a + c) + sqrt(0.25 * (a - c) * (a - c) + b * b)
+        # two ways to write the eigenvector; use the one further from 0 / 0
+        x1, y1 = b, largest - a
+        x2, y2 = largest - c, b
+        if x1 * x1 + y1 * y1 >= x2 * x2 + y2 * y2:
+            x, y = x1, y1
+        else:
+            x, y = x2, y2
+        length = sqrt(x * x + y * y)
+        if length == 0:
+            # b == 0 and a == c: both directions equally good
+            return 1.0, 1.0
+        return abs(x) / length, abs(y) / length
+
+    """
+    least squares table for given gains
+    """
+    def _fitTable(self, forwardTable, reverseTable, forwardGain, reverseGain):
+        norm = forwardGain * forwardGain + reverseGain * reverseGain
+        return [(forwardTable[i] * forwardGain + reverseTable[i] * reverseGain) / norm
+                for i in range(len(forwardTable))]
@@ -1 +1,5 @@
-from SpeedTableBuilder import SpeedTableBuilder
+from .SpeedTableBuilder import SpeedTableBuilder
+from .LogInterpolator import LogInterpolator
+from .TrimSolver import TrimSolver
+from .BlockLengthSolver import BlockLengthSolver
+from .Backend import setBackend, backendName
@@ -0,0 +1,83 @@
+"""
+Keeps a copy of the CV values we believe the decoder holds, so that
+Program can skip writes that wouldn't change anything.
+
+The copy starts out empty and is filled in as CVs get written. Optionally,
+it can be seeded from the JMRI roster entry of the locomotive - only do
+that if the roster is known to match what's actually in the decoder, since
+a stale roster value means a CV we need never gets written.
+"""
+import os
+import xml.etree.ElementTree as ElementTree
+
+class CvShadow:
+    def __init__(self):
+        self.cvValues = {}
+        self.writesSent = 0
+        self.writesSkipped = 0
+
+    """
+    returns the CV value we believe the decoder holds, or None if unknown
+    """
+    def get(self, cvNumber):
+        return self.cvValues.get(int(cvNumber))
+
+    def set(self, cvNumber, cvValue):
+        self.cvValues[int(cvNumber)] = int(cvValue)
+
+    """
+    forget a CV, e.g. after a write that may not have made it
+    """
+    def invalidate(self, cvNumber):
+        if int(cvNumber) in self.cvValues:
+            del self.cvValues[int(cvNumber)]
+
+    """
+    returns: True if writing cvValue to cvNumber would change the decoder
+    """
+    def needsWrite(self, cvNumber, cvValue):
+        return not self.get(cvNumber) == int(cvValue)
+
+    def countWrite(self, sent):
+        if sent:
+            self.writesSent += 1
+        else:
+            self.writesSkipped += 1
+
+    """
+    Reads CV values from a JMRI roster file. Indexed CVs (names such as
+    "16.2.3") are skipped.
+
+    returns: number of CVs read
+    """
+    def loadFromRosterFile(self, filename):
+        count = 0
+        root = ElementTree.parse(filename).getroot()
+        for element in root.iter("CVvalue"):
+            try:
+                cvNumber = int(element.get("name"))
+                cvValue = int(element.get("value"))
+            except (TypeError, ValueError):
+                continue
+            self.set(cvNumber, cvValue)
+            count += 1
+        return count
+
+    """
+    Seeds the shadow copy from the JMRI roster entry with this DCC address.
+    Does nothing unless exactly one roster entry matches.
+
+    returns: number of CVs read
+    """
+    def loadFromRoster(self, dccaddress):
+        import jmri
+        roster = jmri.jmrit.roster.Roster.getDefault()
+        entries = roster.matchingList(None, None, str(dccaddress), None, None, None, None)
+        if not len(entries) == 1:
+            print("Found " + str(len(entries)) + " roster entries for address " +
+                  str(dccaddress) + ". Not using roster CV values.")
+            return 0
+        filename = os.path.join(roster.getRosterFilesLocation(), entries[0].getFileName())
+        count = self.loadFromRosterFile(filename)
+        print("Read " + str(count) + " CV values from roster entry " + str(entries[0].getId()))
+        return count
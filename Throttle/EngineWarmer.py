@@ -1,6 +1,9 @@
 """
 This class "warms up" the engine by running it in forward and reverse
 for a set number of minutes
+
+LayoutBlocks can instead warm up the engine by driving laps until the lap
+times settle (see LayoutBlocks._warmUp); wakeUp() gets it ready for that.
 """
 
 class EngineWarmer:
@@ -10,15 +13,7 @@ class EngineWarmer:
 
     def warmUp(self, minutes=2):
         t = self.throttle.getActiveJmriThrottle()
-        p = self.throttle.getActiveJmriProgrammer()
-
-        # stop, in case already moving
-        t.speedSetting = 0.0
-        self.speedMatchInstance.waitMsec(2000)
-        t.speedSetting = 0.1 # "turns on" some types of sound decoders
-        self.speedMatchInstance.waitMsec(1000)
-        t.speedSetting = 0.0
-        self.speedMatchInstance.waitMsec(1000)
+        self.wakeUp()
 
         # forward
         #self._whistle(2)
@@ -45,6 +40,19 @@ class EngineWarmer:
         return
 
 
+    """
+    stops the engine, in case it's already moving, and nudges the throttle
+    to "turn on" some types of sound decoders
+    """
+    def wakeUp(self):
+        t = self.throttle.getActiveJmriThrottle()
+        t.speedSetting = 0.0
+        self.speedMatchInstance.waitMsec(2000)
+        t.speedSetting = 0.1 # "turns on" some types of sound decoders
+        self.speedMatchInstance.waitMsec(1000)
+        t.speedSetting = 0.0
+        self.speedMatchInstance.waitMsec(1000)
+
     def _whistle(self, toots):
         t = self.throttle.getActiveJmriThrottle()
         for i in range(toots):
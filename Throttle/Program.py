@@ -5,10 +5,36 @@ class Program:
 
     """
     Programs a raw CV
+
+    The write is skipped if the decoder already holds this value according
+    to the throttle's CvShadow. Set force to write it anyway. Otherwise we
+    wait for the command station to confirm the write (see ProgrammingQueue).
+    """
+    def programCv(self, cvNumber, cvValue, force=False):
+        cvShadow = self.throttleInstance.cvShadow
+        profiler = self.throttleInstance.profiler
+        if not force and not cvShadow.needsWrite(cvNumber, cvValue):
+            cvShadow.countWrite(sent=False)
+            profiler.countCvWrite(sent=False)
+            return
+        startTime = profiler.clock()
+        try:
+            self.throttleInstance.programmingQueue.writeCv(
+                self.throttleInstance.programmer, cvNumber, cvValue)
+        except:
+            # we no longer know what the decoder holds
+            cvShadow.invalidate(cvNumber)
+            raise
+        cvShadow.set(cvNumber, cvValue)
+        cvShadow.countWrite(sent=True)
+        profiler.countCvWrite(sent=True, seconds=profiler.clock() - startTime)
+
+    """
+    Seeds the CV shadow copy from the JMRI roster, so that CVs that already
+    hold the right value don't get written at all
     """
-    def programCv(self, cvNumber, cvValue):
-        self.throttleInstance.programmer.writeCV(str(int(cvNumber)), int(cvValue), None)
-        self.speedMatchInstance.waitMsec(750)
+    def loadCvValuesFromRoster(self):
+        self.throttleInstance.cvShadow.loadFromRoster(self.throttleInstance.dccaddress)
 
     """
     Sets trim gain to 1.0 in both directions
@@ -17,6 +43,14 @@ class Program:
         self.programCv(66, 0)
         self.programCv(95, 0)
 
+    """
+    Sets forward (CV66) and reverse (CV95) trim. The decoder multiplies the
+    speed table by trim / 128 in each direction.
+    """
+    def programTrim(self, forwardTrim, reverseTrim):
+        self.programCv(66, int(forwardTrim))
+        self.programCv(95, int(reverseTrim))
+
     def enableSpeedTable(self):
         if self.throttleInstance.longaddress:
             self.programCv(29, 50)
@@ -30,7 +64,8 @@ class Program:
         self.programCv(25, 0)
 
     """
-    writes 28 step table
+    writes 28 step table. Only the steps that differ from what the decoder
+    holds are sent.
 
     takes a 28 element list of ints as input
     """
@@ -0,0 +1,160 @@
+"""
+Writes CVs one at a time and waits for the command station to report that
+each write is done, instead of sleeping for a fixed time after every write.
+
+JMRI calls back a ProgListener when a programming operation completes. We
+wait for that callback, up to a timeout, and retry a write that fails or
+times out. A write that still fails after the retries raises an exception,
+since carrying on would produce a corrupt speed table.
+
+Command stations only run one programming operation at a time, so writes
+from every ProgrammingQueue in this JMRI instance go through one lock.
+
+How long each write took is recorded per command station and decoder, and
+kept on disk, so we can see how fast the hardware really is. Queues of
+calibration sessions running at the same time (see Sessions) add their own
+writes to what's on disk when saving, rather than overwriting each other.
+"""
+import os
+import pickle
+import threading
+
+from Utils import monotonicTimeSec, dataFolder
+try:
+    from jmri import ProgListener
+    PROGRAMMING_OK = ProgListener.OK
+except ImportError:
+    # running outside JMRI, e.g. in the Simulator
+    ProgListener = object
+    PROGRAMMING_OK = 0
+
+# shared by every queue, see above
+_programmingLock = threading.RLock()
+
+"""
+Gets called by JMRI when one programming operation is done
+"""
+class _WriteListener(ProgListener):
+    def __init__(self):
+        self.done = threading.Event()
+        self.status = None
+
+    def programmingOpReply(self, value, status):
+        self.status = status
+        self.done.set()
+
+
+"""
+Write latency statistics, per (command station, decoder)
+"""
+class ProgrammingLatency:
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(dataFolder(), "ProgrammingLatency.pl")
+        self.filename = filename
+        # key : [number of writes, total seconds, maximum seconds]
+        self.stats = {}
+
+    def load(self):
+        if os.path.exists(self.filename):
+            self.stats = pickle.load(open(self.filename, "rb"))
+
+    def save(self):
+        pickle.dump(self.stats, open(self.filename, "wb"))
+
+    """
+    adds the writes recorded in another ProgrammingLatency to this one
+    """
+    def merge(self, other):
+        for key in other.stats.keys():
+            count, total, maximum = other.stats[key]
+            if key not in self.stats:
+                self.stats[key] = [0, 0.0, 0.0]
+            self.stats[key][0] += count
+            self.stats[key][1] += total
+            self.stats[key][2] = max(self.stats[key][2], maximum)
+
+    def add(self, key, latencySec):
+        if key not in self.stats:
+            self.stats[key] = [0, 0.0, 0.0]
+        self.stats[key][0] += 1
+        self.stats[key][1] += latencySec
+        self.stats[key][2] = max(self.stats[key][2], latencySec)
+
+    """
+    returns the mean write time in seconds, or None if we've never written
+    """
+    def meanLatency(self, key):
+        if key not in self.stats:
+            return None
+        return self.stats[key][1] / self.stats[key][0]
+
+    def summary(self, key):
+        if key not in self.stats:
+            return "No CV writes recorded for " + str(key)
+        count, total, maximum = self.stats[key]
+        return ("CV write time for " + str(key) + ": mean " +
+                str(round(total / count, 3)) + " sec, max " +
+                str(round(maximum, 3)) + " sec over " + str(count) + " writes")
+
+
+"""
+commandStation: name of the command station or programmer type
+decoder: decoder type, from the GUI
+timeoutSec: how long to wait for JMRI to report that a write is done
+retries: how many times to repeat a write that failed or timed out
+"""
+class ProgrammingQueue:
+    def __init__(self, commandStation, decoder, timeoutSec=5.0, retries=2,
+                 clock=monotonicTimeSec):
+        self.latencyKey = (str(commandStation), str(decoder))
+        self.timeoutSec = timeoutSec
+        self.retries = retries
+        self.clock = clock
+        self.latency = ProgrammingLatency()
+        self.latency.load()
+        # this queue's writes, not yet saved
+        self.newLatency = ProgrammingLatency()
+
+    """
+    writes one CV and waits until the command station has finished it
+
+    raises an exception if the write still fails after all retries
+    """
+    def writeCv(self, programmer, cvNumber, cvValue):
+        _programmingLock.acquire()
+        try:
+            for attempt in range(self.retries + 1):
+                listener = _WriteListener()
+                startTime = self.clock()
+                programmer.writeCV(str(int(cvNumber)), int(cvValue), listener)
+                if listener.done.wait(self.timeoutSec):
+                    if listener.status == PROGRAMMING_OK:
+                        latencySec = self.clock() - startTime
+                        self.latency.add(self.latencyKey, latencySec)
+                        self.newLatency.add(self.latencyKey, latencySec)
+                        return
+                    print("CV" + str(cvNumber) + " write failed with status " +
+                          str(listener.status) + ". Attempt " + str(attempt + 1))
+                else:
+                    print("CV" + str(cvNumber) + " write timed out after " +
+                          str(self.timeoutSec) + " sec. Attempt " + str(attempt + 1))
+        finally:
+            _programmingLock.release()
+
+        raise Exception("Could not write CV" + str(cvNumber) + " = " + str(cvValue) +
+                        " after " + str(self.retries + 1) + " attempts.")
+
+    def saveLatency(self):
+        _programmingLock.acquire()
+        try:
+            # other queues may have saved their writes since we loaded
+            latency = ProgrammingLatency(self.latency.filename)
+            latency.load()
+            latency.merge(self.newLatency)
+            latency.save()
+            self.latency = latency
+            self.newLatency = ProgrammingLatency(self.latency.filename)
+        finally:
+            _programmingLock.release()
+        print(self.latency.summary(self.latencyKey))
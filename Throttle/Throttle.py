@@ -9,17 +9,27 @@ on the stack between SpeedMatch.handle() and methods in this class
 works fine.
 """
 
-import jmri
 from Utils import RedirectStdErr
-from Program import Program
+from RunProfiler import RunProfiler
+from .Program import Program
+from .CvShadow import CvShadow
+from .ProgrammingQueue import ProgrammingQueue
 
 class Throttle:
-    def __init__(self, speedMatchInstance, dccaddress):
+    """
+    profiler: RunProfiler that counts the CV writes and settle waits, or
+              None to keep the counts to ourselves
+    """
+    def __init__(self, speedMatchInstance, dccaddress, profiler=None):
         self.speedMatchInstance = speedMatchInstance
         self.dccaddress = dccaddress
         self.longaddress = None
         self.throttle = None
         self.programmer = None
+        # CV values we believe the decoder holds, shared by every Program
+        self.cvShadow = CvShadow()
+        self.programmingQueue = None
+        self.profiler = profiler if profiler else RunProfiler()
         # must be called here due to jmri constraints
         # see https://groups.io/g/jmriusers/topic/24732866?p=Created,,,20,2,0,0::recentpostdate%2Fsticky,,,20,2,80,24732866
         self._selectEngine()
@@ -38,6 +48,10 @@ class Throttle:
             print("Selected DCC Address ", dccnumber)
 
         self.programmer = self.speedMatchInstance.addressedProgrammers.getAddressedProgrammer(self.longaddress, dccnumber)
+        self.programmingQueue = ProgrammingQueue(
+                                commandStation=self.programmer.__class__.__name__,
+                                decoder=self.speedMatchInstance.data["Decoder"],
+                                clock=self.profiler.clock)
 
         return
 
@@ -86,5 +100,29 @@ class Throttle:
             self.getActiveJmriThrottle().setIsForward(forward)
             self.getActiveJmriThrottle().speedSetting = speedTableStep * 1.0/28
             # give the new CVs time to update locomotive speed
-            self.speedMatchInstance.waitMsec(2000)
+            self.settle(2000)
         return
+
+    """
+    Drives at one step of whatever speed table the decoder holds, without
+    programming anything. With a PlateauTable on the decoder, that runs
+    at one of its CV values (see PlateauTable.stepFor).
+
+    params:
+    step: speed step, from 1 to 28
+    forward: True for forward, False for Reverse
+    """
+    @RedirectStdErr
+    def driveStep(self, step, forward=True):
+        self.getActiveJmriThrottle().setIsForward(forward)
+        self.getActiveJmriThrottle().speedSetting = step * 1.0/28
+        # give the locomotive time to get to the new speed
+        self.settle(2000)
+
+    """
+    waits for the locomotive to get to a new speed
+    """
+    def settle(self, milliseconds):
+        startTime = self.profiler.clock()
+        self.speedMatchInstance.waitMsec(milliseconds)
+        self.profiler.countSettle(self.profiler.clock() - startTime)
@@ -1,3 +1,5 @@
-from Throttle import Throttle
-from EngineWarmer import EngineWarmer
-from Program import Program
+from .Throttle import Throttle
+from .EngineWarmer import EngineWarmer
+from .Program import Program
+from .CvShadow import CvShadow
+from .ProgrammingQueue import ProgrammingQueue
@@ -1,5 +1,12 @@
 import traceback
+import time
+import os
+from os.path import expanduser
 from functools import wraps
+try:
+    from java.lang import System as JavaSystem
+except ImportError:
+    JavaSystem = None
 
 """
 This function prints a copy of exceptions and their
@@ -28,3 +35,63 @@ def median(lst):
     n = len(lst)
     s = sorted(lst)
     return (s[n//2-1]/2.0+s[n//2]/2.0, s[n//2])[n % 2] if n else None
+
+"""
+Returns the values in lst that aren't outliers. A value is an outlier if
+it is further from the median than madMultiplier scaled median absolute
+deviations, and also further than minimumFraction of the median - the
+latter keeps a few nearly identical values from rejecting everything else.
+Outliers are only rejected once there are at least 3 values.
+"""
+def inliers(lst, madMultiplier=3.0, minimumFraction=0.05):
+    if len(lst) < 3:
+        return list(lst)
+    m = median(lst)
+    # 1.4826 scales the MAD to a standard deviation for normal data
+    mad = 1.4826 * median([abs(el - m) for el in lst])
+    threshold = max(madMultiplier * mad, minimumFraction * abs(m))
+    return [el for el in lst if abs(el - m) <= threshold]
+
+"""
+mean of the values in lst after outlier rejection (see inliers())
+"""
+def robustMean(lst):
+    good = inliers(lst)
+    return sum(good) * 1.0 / len(good) if good else None
+
+
+"""
+returns the time in seconds from a monotonic, high resolution clock.
+Only the difference between two readings means anything. Under Jython
+this is java.lang.System.nanoTime(), which unlike currentTimeMillis()
+doesn't jump when the wall clock gets adjusted. CPython 2.7 has no
+perf_counter(), so there we make do with the wall clock.
+"""
+def monotonicTimeSec():
+    if JavaSystem is not None:
+        return JavaSystem.nanoTime() * 1.0e-9
+    if hasattr(time, "perf_counter"):
+        return time.perf_counter()
+    return time.time()
+
+_dataFolderOverride = None
+
+"""
+returns the folder that holds locomotive measurements and layout data,
+creating it if needed
+"""
+def dataFolder():
+    foldername = _dataFolderOverride
+    if foldername is None:
+        foldername = os.path.join(expanduser("~"), ".SpeedMatchLocoTables")
+    if not os.path.exists(foldername):
+        os.mkdir(foldername)
+    return foldername
+
+"""
+stores data somewhere other than ~/.SpeedMatchLocoTables, e.g. so that
+simulated runs don't mix with real measurements. None restores the default.
+"""
+def setDataFolder(foldername):
+    global _dataFolderOverride
+    _dataFolderOverride = foldername
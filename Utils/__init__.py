@@ -1 +1 @@
-from Utils import RedirectStdErr, median
+from .Utils import RedirectStdErr, median, inliers, robustMean, monotonicTimeSec, dataFolder, setDataFolder
@@ -0,0 +1,39 @@
+"""
+Both table building backends against the tables and trims in
+Benchmarks/golden.json. After a change that is meant to change the
+tables, run python -m Benchmarks --save-golden and commit golden.json.
+"""
+import json
+import unittest
+
+from Benchmarks import buildTables
+from Benchmarks.Benchmarks import SCENARIOS, GOLDEN_FILE
+from SpeedTableBuilder import setBackend
+from SpeedTableBuilder.Backend import PYTHON, NUMPY, numpyAvailable
+
+
+class GoldenTablesTest(unittest.TestCase):
+    def setUp(self):
+        self.golden = json.load(open(GOLDEN_FILE, "r"))
+
+    def tearDown(self):
+        setBackend(None)
+
+    def checkBackend(self, backend):
+        setBackend(backend)
+        for name, arguments in SCENARIOS:
+            self.assertEqual(buildTables(arguments), self.golden[name], name)
+
+    def testEveryScenarioHasGoldenTables(self):
+        self.assertEqual(sorted(self.golden.keys()), sorted([el[0] for el in SCENARIOS]))
+
+    def testPythonBackend(self):
+        self.checkBackend(PYTHON)
+
+    @unittest.skipUnless(numpyAvailable(), "numpy isn't installed")
+    def testNumpyBackend(self):
+        self.checkBackend(NUMPY)
+
+
+if __name__ == "__main__":
+    unittest.main()
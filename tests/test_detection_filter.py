@@ -0,0 +1,131 @@
+"""
+DetectionFilter on scripted sensor activations: chatter, activations out
+of order, and quarantining sensors that keep acting up.
+"""
+import unittest
+
+from LayoutBlocks import DetectionFilter
+
+LOOP = ["LS1", "LS3", "LS5", "LS7", "LS9", "LS11", "LS13", "LS15"]
+
+
+"""
+Stands in for the SensorMonitor: hands out a list of (sensor, time)
+activations in order, skipping the sensors no longer watched
+"""
+class ScriptedMonitor:
+    def __init__(self, sensors):
+        self.watched = list(sensors)
+        self.activations = []
+
+    def add(self, sensor, timeSec):
+        self.activations.append((sensor, timeSec))
+
+    def waitForActivation(self, timeoutSec=None):
+        while True:
+            sensor, timeSec = self.activations.pop(0)
+            if sensor in self.watched:
+                return sensor, timeSec
+
+    def watchOnly(self, sensorNames):
+        self.watched = list(sensorNames)
+
+    def watchedSensors(self):
+        return list(self.watched)
+
+    def clear(self):
+        self.activations = []
+
+
+class DetectionFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.monitor = ScriptedMonitor(LOOP + ["LS101"])
+        self.filter = DetectionFilter(self.monitor)
+        self.filter.setSequence(LOOP, protectedSensors=["LS5"])
+        self.timeSec = 0.0
+
+    """
+    schedules activations 10 seconds apart, or gapSec
+
+    returns: the sensors the filter passes on, until the script runs out
+    """
+    def drive(self, sensors, gapSec=10.0):
+        for sensor in sensors:
+            self.timeSec += gapSec
+            self.monitor.add(sensor, self.timeSec)
+        accepted = []
+        while self.monitor.activations:
+            try:
+                accepted.append(self.filter.waitForActivation(True)[0])
+            except IndexError:
+                # the last activations were all dropped
+                break
+        return accepted
+
+    def laps(self, count, without=None):
+        return [el for el in LOOP * count if not el == without]
+
+    def testCleanLap(self):
+        self.assertEqual(self.drive(self.laps(2)), self.laps(2))
+        self.assertEqual(self.filter.report(), [])
+
+    def testChatter(self):
+        accepted = self.drive(["LS1", "LS3", "LS3", "LS1", "LS5"])
+        self.assertEqual(accepted, ["LS1", "LS3", "LS5"])
+        # going active again within debounceSec
+        accepted += self.drive(["LS7"]) + self.drive(["LS7"], gapSec=0.5) + self.drive(["LS9"])
+        self.assertEqual(accepted, ["LS1", "LS3", "LS5", "LS7", "LS9"])
+        self.assertEqual(self.filter.chatter, {"LS3" : 1, "LS1" : 1, "LS7" : 1})
+        self.assertEqual(self.filter.getQuarantinedSensors(), [])
+
+    def testOutOfOrder(self):
+        # LS13 can't be reached from LS3 without passing more than
+        # lookAhead sensors; another train set it off
+        self.assertEqual(self.drive(["LS1", "LS3", "LS13", "LS5"]), ["LS1", "LS3", "LS5"])
+        self.assertEqual(self.filter.outOfOrder, {"LS13" : 1})
+
+    def testMissedOnTheWay(self):
+        self.assertEqual(self.drive(["LS1", "LS3", "LS7", "LS9"]), ["LS1", "LS3", "LS7", "LS9"])
+        self.assertEqual(self.filter.missed, {"LS5" : 1})
+        self.assertFalse(self.filter.isExpectedBlock(True, "LS3", "LS7"))
+        self.assertTrue(self.filter.isExpectedBlock(True, "LS7", "LS9"))
+
+    def testLostTrack(self):
+        # lookAhead activations in a row out of order: the locomotive is
+        # somewhere else than we thought, carry on from there
+        accepted = self.drive(["LS1", "LS3", "LS11", "LS13", "LS15", "LS1"])
+        self.assertEqual(accepted, ["LS1", "LS3", "LS15", "LS1"])
+
+    def testQuarantineOutOfOrder(self):
+        self.drive(["LS1"])
+        for lap in range(DetectionFilter(None).quarantineStrikes):
+            # LS11 goes active again just after LS3
+            self.drive(["LS3", "LS11"] + LOOP[2:] + ["LS1"])
+        self.assertEqual(self.filter.getQuarantinedSensors(), ["LS11"])
+        self.assertNotIn("LS11", self.monitor.watchedSensors())
+        self.assertNotIn("LS11", self.filter.getSequence())
+        # the block before it now ends at the sensor after it, and that
+        # time isn't the block's
+        self.assertFalse(self.filter.isExpectedBlock(True, "LS9", "LS13"))
+        lap = LOOP[1:] + ["LS1"]
+        self.assertEqual(self.drive(lap), [el for el in lap if not el == "LS11"])
+        self.assertIn("quarantined", self.filter.report()[0])
+
+    def testQuarantineMissed(self):
+        self.drive(self.laps(1))
+        self.drive(self.laps(DetectionFilter(None).missedStrikes, without="LS9"))
+        self.assertEqual(self.filter.getQuarantinedSensors(), ["LS9"])
+        self.assertEqual(self.filter.missed, {"LS9" : 3})
+        self.assertEqual(self.drive(self.laps(1)), self.laps(1, without="LS9"))
+
+    def testMeasuredBlocksAreNeverQuarantined(self):
+        self.drive(self.laps(1))
+        # LS5 is measured, LS3 starts its block in reverse
+        for sensor in ["LS5", "LS3"]:
+            self.drive(self.laps(4, without=sensor))
+        self.assertEqual(self.filter.getQuarantinedSensors(), [])
+        self.assertEqual(self.drive(self.laps(1)), self.laps(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
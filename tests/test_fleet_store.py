@@ -0,0 +1,127 @@
+"""
+FleetStore: adding runs, finding and partly loading them, and importing
+the measurement files of earlier versions.
+"""
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from FleetStore import FleetStore
+from LayoutBlocks import MeasurementJournal
+
+FORWARD = {16 : {"LS1" : [40.5, 40.25], "LS3" : [60.0]},
+           71 : {"LS1" : [8.5], "LS3" : [12.75]},
+           127 : {"LS1" : [4.25], "LS3" : [6.5, 6.25]}}
+REVERSE = {16 : {"LS3" : [62.0]},
+           127 : {"LS3" : [6.75]}}
+
+
+def runData(address=3, suffix="", decoder="Other"):
+    return {"DCC Address" : address, "Filename Suffix" : suffix, "Decoder" : decoder,
+            "Scale" : 87.1, "Maximum Speed" : 60, "vStart" : 0, "CV3" : 5, "CV4" : 5,
+            "Measured Block Sensors" : ["LS1"], "Measured Block Lengths (Inches)" : [30.0]}
+
+
+class FleetStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="SpeedMatchTest")
+        self.storeFolder = os.path.join(self.folder, "Fleet")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testAddRun(self):
+        run = FleetStore(self.storeFolder).addRun(runData(), FORWARD, REVERSE,
+                                                  {"LS1" : "LS3"}, {"LS3" : "LS1"},
+                                                  timestamp=1000.0)
+        # everything from the files, not from the store that wrote them
+        store = FleetStore(self.storeFolder)
+        record = store.latestRun(3)
+        self.assertEqual(record["Run"], run)
+        self.assertEqual(record["Timestamp"], 1000.0)
+        self.assertEqual(record["Decoder"], "Other")
+        self.assertEqual(record["CV Values Forward"], [16, 71, 127])
+        self.assertEqual(record["CV Values Reverse"], [16, 127])
+        self.assertEqual(store.loadMeasurements(run, True), FORWARD)
+        self.assertEqual(store.loadMeasurements(run, False), REVERSE)
+        self.assertEqual(store.loadNextSensors(run, True), {"LS1" : "LS3"})
+        self.assertEqual(store.loadNextSensors(run, False), {"LS3" : "LS1"})
+
+    def testFindRuns(self):
+        store = FleetStore(self.storeFolder)
+        old = store.addRun(runData(), FORWARD, REVERSE, timestamp=1000.0)
+        new = store.addRun(runData(), FORWARD, REVERSE, timestamp=2000.0)
+        other = store.addRun(runData(suffix="A", decoder="ESU"), FORWARD, REVERSE,
+                             timestamp=1500.0)
+        self.assertEqual(store.latestRun(3)["Run"], new)
+        self.assertEqual(store.latestRun(3, "A")["Run"], other)
+        self.assertEqual(store.latestRun(4), None)
+        self.assertEqual([el["Run"] for el in store.findRuns(address=3)], [old, other, new])
+        self.assertEqual([el["Run"] for el in store.findRuns(since=1200.0, until=2000.0)],
+                         [other])
+        self.assertEqual([el["Run"] for el in store.findRuns(decoder="ESU")], [other])
+
+    def testRunNumbersAcrossStores(self):
+        first = FleetStore(self.storeFolder)
+        second = FleetStore(self.storeFolder)
+        runs = [first.addRun(runData(), FORWARD, REVERSE),
+                second.addRun(runData(address=4), FORWARD, REVERSE)]
+        self.assertEqual(len(set(runs)), 2)
+        self.assertEqual(len(FleetStore(self.storeFolder).findRuns()), 2)
+
+    def testPartialLoad(self):
+        store = FleetStore(self.storeFolder)
+        run = store.addRun(runData(), FORWARD, REVERSE)
+        self.assertEqual(store.loadMeasurements(run, True, cvMinimum=71),
+                         {71 : FORWARD[71], 127 : FORWARD[127]})
+        self.assertEqual(store.loadMeasurements(run, True, cvMinimum=20, cvMaximum=100),
+                         {71 : FORWARD[71]})
+        self.assertEqual(store.loadMeasurements(run, False, cvMinimum=200), {})
+
+        # the chunks that aren't asked for aren't even read: spoil all of
+        # forward, and reverse still loads
+        offset = min([store.chunks[run][(True, el)][0] for el in FORWARD.keys()])
+        end = max([sum(store.chunks[run][(True, el)]) for el in FORWARD.keys()])
+        f = open(os.path.join(self.storeFolder, str(run) + ".fmr"), "r+b")
+        f.seek(offset)
+        f.write(b"\0" * (end - offset))
+        f.close()
+        self.assertEqual(store.loadMeasurements(run, False), REVERSE)
+
+    def testMigrate(self):
+        # saved all at once at the end of a run, by versions before the journal
+        f = open(os.path.join(self.folder, "4012A.mbt"), "wb")
+        pickle.dump([FORWARD, REVERSE], f)
+        f.close()
+        journal = MeasurementJournal(os.path.join(self.folder, "5.mbj"))
+        journal.start({"DCC Address" : 5})
+        journal.beginCvValue(True, 16)
+        journal.addSample(True, 16, "LS1", "LS3", 40.5)
+        journal.endCvValue(True, 16)
+        journal.finish()
+        unfinished = MeasurementJournal(os.path.join(self.folder, "6.mbj"))
+        unfinished.start({"DCC Address" : 6})
+        unfinished.close()
+        f = open(os.path.join(self.folder, "Layout.mbt"), "wb")
+        pickle.dump([FORWARD, REVERSE], f)
+        f.close()
+
+        store = FleetStore(self.storeFolder)
+        self.assertEqual(len(store.migrate(self.folder)), 2)
+        record = store.latestRun(4012, "A")
+        self.assertEqual(record["Source"], os.path.join(self.folder, "4012A.mbt"))
+        self.assertEqual(store.loadMeasurements(record["Run"], True), FORWARD)
+        self.assertEqual(store.loadMeasurements(record["Run"], False), REVERSE)
+        run = store.latestRun(5)["Run"]
+        self.assertEqual(store.loadMeasurements(run, True), {16 : {"LS1" : [40.5]}})
+        self.assertEqual(store.loadNextSensors(run, True), {"LS1" : "LS3"})
+        self.assertEqual(store.latestRun(6), None)
+
+        # imported files are only imported once
+        self.assertEqual(FleetStore(self.storeFolder).migrate(self.folder), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
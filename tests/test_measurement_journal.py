@@ -0,0 +1,197 @@
+"""
+MeasurementJournal on its own, and a simulated calibration that's
+interrupted partway through a CV value and then resumed from its journal.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from LayoutBlocks import MeasurementJournal
+from Utils import setDataFolder
+
+HEADER = {"DCC Address" : 3, "Maximum Speed" : 60, "vStart" : 0}
+
+
+class MeasurementJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="SpeedMatchTest")
+        self.filename = os.path.join(self.folder, "3.mbj")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    """
+    Fwd 16 complete with two samples, Rev 16 started with one
+    """
+    def writeJournal(self):
+        journal = MeasurementJournal(self.filename)
+        journal.start(HEADER)
+        journal.beginCvValue(True, 16)
+        journal.addSample(True, 16, "LS1", "LS3", 12.25)
+        journal.addSample(True, 16, "LS3", "LS5", 0.1 + 0.2)
+        journal.endCvValue(True, 16)
+        journal.beginCvValue(False, 16)
+        journal.addSample(False, 16, "LS5", "LS3", 13.5)
+        journal.close()
+        return journal
+
+    def testReload(self):
+        self.writeJournal()
+        journal = MeasurementJournal(self.filename)
+        self.assertTrue(journal.load())
+        self.assertEqual(journal.header["DCC Address"], "3")
+        self.assertEqual(journal.getSamples(True, 16),
+                         [("LS1", "LS3", 12.25), ("LS3", "LS5", 0.1 + 0.2)])
+        self.assertEqual(journal.getSamples(False, 16), [("LS5", "LS3", 13.5)])
+        self.assertTrue(journal.isCvValueComplete(True, 16))
+        self.assertFalse(journal.isCvValueComplete(False, 16))
+        self.assertFalse(journal.isFinished())
+        self.assertEqual(journal.getMeasurements(True),
+                         ({16 : {"LS1" : [12.25], "LS3" : [0.1 + 0.2]}},
+                          {"LS1" : "LS3", "LS3" : "LS5"}))
+
+    def testLoadWithoutJournal(self):
+        self.assertFalse(MeasurementJournal(self.filename).load())
+
+    def testTruncatedLastLine(self):
+        self.writeJournal()
+        # a crash in the middle of writing a sample
+        f = open(self.filename, "a")
+        f.write("S\tR\t16\tLS3\tLS1\t9.")
+        f.close()
+        journal = MeasurementJournal(self.filename)
+        journal.load()
+        self.assertEqual(journal.getSamples(False, 16), [("LS5", "LS3", 13.5)])
+
+    def testResume(self):
+        self.writeJournal()
+        journal = MeasurementJournal(self.filename)
+        self.assertTrue(journal.resume(HEADER))
+        journal.addSample(False, 16, "LS3", "LS1", 9.75)
+        journal.endCvValue(False, 16)
+        journal.finish()
+
+        journal = MeasurementJournal(self.filename)
+        journal.load()
+        self.assertEqual(journal.getSamples(False, 16),
+                         [("LS5", "LS3", 13.5), ("LS3", "LS1", 9.75)])
+        self.assertTrue(journal.isCvValueComplete(False, 16))
+        self.assertTrue(journal.isFinished())
+
+    def testResumeAfterTruncatedLastLine(self):
+        self.writeJournal()
+        f = open(self.filename, "a")
+        f.write("S\tR\t16\tLS3\tLS1\t9.")
+        f.close()
+        journal = MeasurementJournal(self.filename)
+        self.assertTrue(journal.resume(HEADER))
+        journal.addSample(False, 16, "LS3", "LS1", 9.75)
+        journal.close()
+
+        journal = MeasurementJournal(self.filename)
+        journal.load()
+        self.assertEqual(journal.getSamples(False, 16),
+                         [("LS5", "LS3", 13.5), ("LS3", "LS1", 9.75)])
+
+    def testResumeWithOtherSettings(self):
+        self.writeJournal()
+        header = dict(HEADER)
+        header["Maximum Speed"] = 40
+        self.assertRaises(Exception, MeasurementJournal(self.filename).resume, header)
+
+    def testResumeWithoutJournal(self):
+        self.assertFalse(MeasurementJournal(self.filename).resume(HEADER))
+
+    def testStartKeepsUnfinishedJournal(self):
+        self.writeJournal()
+        journal = MeasurementJournal(self.filename)
+        journal.start(HEADER)
+        journal.close()
+        self.assertTrue(os.path.exists(self.filename + ".bak"))
+        self.assertEqual(journal.getSamples(True, 16), [])
+
+        backup = MeasurementJournal(self.filename + ".bak")
+        backup.load()
+        self.assertEqual(len(backup.getSamples(True, 16)), 2)
+
+
+class Interruption(Exception):
+    pass
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="SpeedMatchTest")
+        setDataFolder(self.folder)
+
+    def tearDown(self):
+        setDataFolder(None)
+        shutil.rmtree(self.folder)
+
+    def calibrate(self, settings):
+        from Calibration import Calibration
+        from LayoutBlocks import LayoutProfile
+        from Simulator import Simulator, exampleLayout
+
+        blocks, latency = exampleLayout()
+        measuredSensor, measuredLength, grade = blocks[12]
+        simulator = Simulator(blocks, latency)
+        data = simulator.buildData({measuredSensor : measuredLength}, settings,
+                                   layoutProfile=LayoutProfile())
+        return Calibration(simulator, data).run()
+
+    """
+    runs a calibration that stops with an Interruption at the
+    samplesUntilInterruption-th sample written to the journal
+    """
+    def calibrateUntilInterrupted(self, samplesUntilInterruption):
+        addSample = MeasurementJournal.addSample
+        written = [0]
+        def interruptedAddSample(journal, *args):
+            written[0] += 1
+            if written[0] >= samplesUntilInterruption:
+                raise Interruption()
+            addSample(journal, *args)
+        MeasurementJournal.addSample = interruptedAddSample
+        try:
+            self.assertRaises(Interruption, self.calibrate, {})
+        finally:
+            MeasurementJournal.addSample = addSample
+
+    def testResumeCarriesOnWhereItStopped(self):
+        from FleetStore import FleetStore
+
+        self.calibrateUntilInterrupted(150)
+        filename = os.path.join(self.folder, "3.mbj")
+        interrupted = MeasurementJournal(filename)
+        interrupted.load()
+        self.assertFalse(interrupted.isFinished())
+        incomplete = [el for el in interrupted.cvValueOrder
+                      if not interrupted.isCvValueComplete(el[0], el[1])]
+        self.assertEqual(len(incomplete), 1)
+        self.assertTrue(interrupted.completeCvValues)
+
+        self.calibrate({"Resume Measurements" : True})
+        # the journal is only removed once the run is stored
+        self.assertFalse(os.path.exists(filename))
+        store = FleetStore()
+        run = store.latestRun(3)["Run"]
+        for forward in [True, False]:
+            stored = store.loadMeasurements(run, forward)
+            journaled = interrupted.getMeasurements(forward)[0]
+            for cvValue in journaled.keys():
+                if interrupted.isCvValueComplete(forward, cvValue):
+                    # replayed, not driven again
+                    self.assertEqual(stored[cvValue], journaled[cvValue])
+                    continue
+                # carried on after the samples from before the interruption
+                for sensor in journaled[cvValue].keys():
+                    count = len(journaled[cvValue][sensor])
+                    self.assertEqual(stored[cvValue][sensor][:count], journaled[cvValue][sensor])
+                self.assertTrue(sum([len(el) for el in stored[cvValue].values()]) >
+                                sum([len(el) for el in journaled[cvValue].values()]))
+
+
+if __name__ == "__main__":
+    unittest.main()